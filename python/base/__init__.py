@@ -1,8 +1,12 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, InitVar
+import hashlib
+import json
+import logging
 import os
+import subprocess
 import sys
-import git
 from abc import ABC, abstractmethod
+from base.trace import span as _trace_span
 
 class BuildError(Exception):
   pass
@@ -17,26 +21,120 @@ class ConfigureError(Exception):
   pass
 
 
+CLONE_MODES = ["full", "blobless", "shallow"]
+
+
+def _gitpython():
+  """GitPython takes most of the import time, only actions which touch repos load it
+  """
+  import git
+  return git
+
+
+def _lock_file(path):
+  """exclusive lock for the lifetime of the returned file object
+  """
+  import fcntl
+  f = open(path, "w")
+  fcntl.flock(f, fcntl.LOCK_EX)
+  return f
+
+
+def _git_url(url):
+  # local clones ignore --filter/--depth unless the path is given as file://
+  if os.path.exists(url):
+    return f"file://{os.path.abspath(url)}"
+  return url
+
+
+def mirror_path(mirror_root, repo_url):
+  """the bare mirror of repo_url in mirror_root, empty without a mirror root
+  """
+  if not mirror_root:
+    return ""
+  name = os.path.basename(repo_url.rstrip("/"))
+  if not name.endswith(".git"):
+    name += ".git"
+  digest = hashlib.sha1(repo_url.encode()).hexdigest()[:12]
+  return os.path.join(mirror_root, f"{digest}-{name}")
+
+
 class Repo(object):
-  def __init__(self, repo_url, local_path, has_submodule=False):
+  def __init__(self, repo_url, local_path, has_submodule=False, mirror_root="", clone_mode="full"):
+    """_summary_
+
+    Args:
+        repo_url: upstream url or local path
+        local_path: where to clone
+        has_submodule: update submodules after clone
+        mirror_root: directory of the machine wide bare mirrors, clones borrow
+            objects from them by alternates, so the mirror must outlive the clone.
+        clone_mode: full, blobless (--filter=blob:none) or shallow (only the commit)
+    """
+    if clone_mode not in CLONE_MODES:
+      raise ConfigureError(f"Unknown clone mode {clone_mode}, must be one of {CLONE_MODES}")
     self.repo_url = repo_url
     self.path_to_clone = local_path
+    self.mirror_root = mirror_root
+    self.clone_mode = clone_mode
     self.__repo = None
     self.__has_sub = has_submodule
     par_dir = os.path.dirname(self.path_to_clone)
     if not os.path.exists(par_dir):
       print(f"Directory {par_dir} does not exist, make it.")
       os.makedirs(par_dir)
+
+  def get_mirror_path(self):
+    return mirror_path(self.mirror_root, self.repo_url)
+
+  def update_mirror(self, commit=None):
+    """create the bare mirror or fetch into it, a mirror which has the commit already
+    is not fetched.
+    """
+    mirror = self.get_mirror_path()
+    os.makedirs(self.mirror_root, exist_ok=True)
+    with _lock_file(f"{mirror}.lock"), _trace_span("mirror", "git", url=self.repo_url):
+      if not os.path.exists(mirror):
+        _gitpython().Repo.clone_from(self.repo_url, mirror, mirror=True)
+        print(f"{self.repo_url} is mirrored into {mirror}")
+      elif not (commit and _has_commit(_gitpython().Repo(mirror), commit)):
+        _gitpython().Repo(mirror).git.fetch("--prune", "--tags", "origin")
+    return mirror
+
+  def clone(self, commit=None):
+    mirror = self.update_mirror(commit) if self.mirror_root else ""
+    with _trace_span("clone", "git", url=self.repo_url, mode=self.clone_mode):
+      return self._clone(mirror, commit)
+
+  def _clone(self, mirror, commit):
+    if self.clone_mode == "shallow" and commit:
+      # fetch exactly the commit, from the local mirror if there is one
+      repo = _gitpython().Repo.init(self.path_to_clone)
+      if mirror:
+        with open(os.path.join(self.path_to_clone, ".git", "objects", "info", "alternates"), "w") as f:
+          f.write(os.path.join(os.path.abspath(mirror), "objects") + "\n")
+      repo.create_remote("origin", self.repo_url)
+      repo.git.fetch("--depth=1", "--tags", _git_url(mirror or self.repo_url), commit)
+      repo.git.checkout("FETCH_HEAD")
+      return repo
+    options = []
+    if mirror:
+      options.append(f"--reference-if-able={os.path.abspath(mirror)}")
+    if self.clone_mode == "blobless":
+      options.append("--filter=blob:none")
+    elif self.clone_mode == "shallow":
+      options.append("--depth=1")
+    return _gitpython().Repo.clone_from(_git_url(self.repo_url), self.path_to_clone, multi_options=options)
   
-  def init(self):
+  def init(self, commit=None):
     """init repo
     init repo from an exsit repo or clone it.
     if repo has submodule, update it.
     """
     if os.path.exists(self.path_to_clone):
-      self.__repo = git.Repo(self.path_to_clone)
+      self.__repo = _gitpython().Repo(self.path_to_clone)
     else:
-      self.__repo = git.Repo.clone_from(self.repo_url, self.path_to_clone)
+      self.__repo = self.clone(commit)
       print(f"{self.repo_url} is cloned into {self.path_to_clone}")
     if self.__has_sub:
       self.__repo.submodule_update(init=True, recursive=True)
@@ -45,12 +143,22 @@ class Repo(object):
   def get_repo_dir(self):
     return self.__repo.working_dir
 
+  def has_commit(self, commit:str):
+    return _has_commit(self.__repo, commit)
+
   def create_local_branch_on_commit(self, branch_name, commit:str):
     self.__repo.commit(commit)
     branch = self.__repo.create_head(branch_name)
     branch.checkout()
 
-  def apply_patches(self, patch_dir):
+  def apply_patches(self, patch_dir, base=None):
+    """apply the *.patch series of patch_dir by git am
+
+    without base, the whole series is applied on HEAD.
+    with base, the applied series is recorded, see sync_patches.
+    """
+    if base:
+      return self.sync_patches(base, patch_dir)
     # 修正 os.curdir() 为 os.getcwd()
     if not os.path.exists(patch_dir):
       print(f"Directory {patch_dir} does not exist, skip apply!")
@@ -58,21 +166,131 @@ class Repo(object):
     patch_dir = os.path.abspath(patch_dir)
     old_dir = os.getcwd()
     os.chdir(self.get_repo_dir())
-    res = os.system(f"git am --whitespace=fix --keep {patch_dir}/*.patch")
+    with _trace_span("am", "git", patches=patch_dir):
+      res = os.system(f"git am --whitespace=fix --keep {patch_dir}/*.patch")
     os.chdir(old_dir)
     if res:
       raise InitError(f"Apply patches failed for {self.get_repo_dir()} within {patch_dir}")
+
+  def get_patch_state_path(self):
+    return os.path.join(self.__repo.git_dir, "mr-patches.json")
+
+  def read_patch_state(self) -> dict:
+    try:
+      with open(self.get_patch_state_path()) as f:
+        return json.load(f)
+    except (FileNotFoundError, ValueError):
+      return {}
+
+  def sync_patches(self, base, patch_dir):
+    """make the tree `base + patch series` with as little work as possible
+
+    the base commit, the fingerprint of every applied patch and the commit it
+    produced are recorded in .git/mr-patches.json. if base and patches are
+    unchanged nothing is touched, so file timestamps and make's incremental
+    state survive. if only later patches changed, the tree is reset to the
+    commit of the last unchanged patch and the series is applied from there.
+    returns the number of patches applied.
+    """
+    base_sha = self.__repo.git.rev_parse(f"{base}^{{commit}}")
+    series = patch_series(patch_dir)
+    state = self.read_patch_state()
+    applied = state.get("patches", [])
+    keep = 0
+    if state.get("base") == base_sha and self._is_clean() and \
+        self.__repo.head.commit.hexsha == (applied[-1]["commit"] if applied else base_sha):
+      while keep < min(len(applied), len(series)) and \
+          [applied[keep]["name"], applied[keep]["sha256"]] == [series[keep]["name"], series[keep]["sha256"]]:
+        keep += 1
+      if keep == len(applied) == len(series):
+        print(f"{len(series)} patches are applied already on {base} in {self.get_repo_dir()}, skip apply")
+        return 0
+    restart = applied[keep - 1]["commit"] if keep else base_sha
+    # reset only rewrites files which differ, unchanged files keep their mtime
+    self.__repo.git.reset("--hard", restart)
+    applied = applied[:keep]
+    todo = series[keep:]
+    self._write_patch_state(base_sha, applied)
+    if todo:
+      print(f"Apply {len(todo)} of {len(series)} patches from {todo[0]['name']}")
+      try:
+        with _trace_span("am", "git", patches=len(todo)):
+          self.__repo.git.am("--whitespace=fix", "--keep", *[p["path"] for p in todo])
+      except _gitpython().GitCommandError as e:
+        self.abort_am()
+        raise InitError(f"Apply patches failed for {self.get_repo_dir()} within {patch_dir}: {e.stderr}")
+      commits = self.__repo.git.rev_list("--reverse", f"{restart}..HEAD").split()
+      for patch, commit in zip(todo, commits):
+        applied.append({"name": patch["name"], "sha256": patch["sha256"], "commit": commit})
+      self._write_patch_state(base_sha, applied)
+    return len(todo)
+
+  def _write_patch_state(self, base_sha, applied):
+    path = self.get_patch_state_path()
+    with open(f"{path}.tmp", "w") as f:
+      json.dump({"base": base_sha, "patches": applied}, f, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+  def _is_clean(self):
+    return not self.__repo.git.status("--porcelain", "--untracked-files=no")
+
+  def abort_am(self):
+    if os.path.isdir(os.path.join(self.__repo.git_dir, 'rebase-apply')):
+      self.__repo.git.am('--abort')
+
+  def ensure_commit(self, commit):
+    """fetch only if the commit is not present locally
+    """
+    if self.has_commit(commit):
+      print(f"{commit} exists in {self.get_repo_dir()}, skip fetch")
+    elif self.mirror_root:
+      self.update_mirror(commit)
+      with _trace_span("fetch", "git", commit=commit):
+        self.__repo.git.fetch("--tags", _git_url(self.get_mirror_path()), commit)
+    else:
+      self.fetch_all()
+
+  def fetch_all(self):
+    # 使用 GitPython API 实现 git fetch --all --tags
+    with _trace_span("fetch", "git"):
+      for remote in self.__repo.remotes:
+        remote.fetch(tags=True, prune=True)
   
-  def reset(self):
+  def reset(self, commit=None):
     """abort rebase and fetch all tags
+    if commit is given, the tree is reset to it and remotes are only fetched when
+    the commit is not present locally.
     """
-    if os.path.isdir(os.path.join(self.get_repo_dir(), '.git', 'rebase-apply')):
-      self.__repo.git.am('--skip')
+    self.abort_am()
+    if commit:
+      self.ensure_commit(commit)
+      self.__repo.git.reset('--hard', self.__repo.git.rev_parse(f"{commit}^{{commit}}"))
+      return
+    self.fetch_all()
     self.__repo.git.reset('--hard')
-    # 使用 GitPython API 实现 git fetch --all --tags
-    for remote in self.__repo.remotes:
-      remote.fetch(tags=True, prune=True)
-    
+
+
+def patch_series(patch_dir) -> list:
+  """name, path and sha256 of every *.patch in patch_dir, in the order git am applies them
+  """
+  if not os.path.isdir(patch_dir):
+    return []
+  series = []
+  for name in sorted(os.listdir(patch_dir)):
+    path = os.path.join(patch_dir, name)
+    if name.endswith(".patch") and os.path.isfile(path):
+      with open(path, "rb") as f:
+        series.append({"name": name, "path": os.path.abspath(path), "sha256": hashlib.sha256(f.read()).hexdigest()})
+  return series
+
+
+def _has_commit(repo, commit:str):
+  try:
+    repo.git.rev_parse("--verify", "--quiet", f"{commit}^{{commit}}")
+  except _gitpython().GitCommandError:
+    return False
+  return True
+
 @dataclass
 class BuildConfigure(object):
   platform: str
@@ -80,6 +298,15 @@ class BuildConfigure(object):
   workspace: str
   install_prefix: str
   action: str
+  # total make jobs for this configure, 0 means what the machine can afford
+  jobs: int = 0
+  # machine wide bare mirrors shared by all workspaces, see Repo
+  git_mirror_dir: str = ""
+  clone_mode: str = "full"
+  # none, auto, ccache or sccache
+  compiler_cache: str = ""
+  # the root of the artifact store which keeps the built prefixes, see base.store
+  artifact_store: str = ""
   
   def prepare(self):
     if not os.path.exists(self.workspace):
@@ -101,6 +328,13 @@ class BuildConfigure(object):
     
   def get_arch_workspace(self):
     return os.path.join(self.workspace, self.arch)
+
+  def get_arch_install_prefix(self):
+    return os.path.abspath(os.path.join(self.install_prefix, self.arch))
+
+  def get_jobs(self):
+    from base.jobserver import available_parallelism
+    return self.jobs if self.jobs > 0 else available_parallelism()
   
   def get_patch_dir(self):
     return os.path.join(self.workspace, "patches")
@@ -147,91 +381,65 @@ class ToolchainVars(object):
   sysroot: str
   make: str
   path:str
+  # ccache/sccache put in front of cc and cxx, empty if not enabled
+  launcher: str = ""
+  # target flags, e.g. -arch and the min os version on apple
+  cflags: str = ""
+  # first line of `triple_cc --version`, empty if not probed
+  cc_version: str = ""
+  # the probe of base.toolchain has checked the tools already
+  validate: InitVar[bool] = True
+
+  # fields which must exist on disk
+  CHECKED_FIELDS = ["triple_cc", "triple_cxx", "cc", "cxx", "as_tool", "yasm", "ar", "nm", "ranlib",
+                    "strip", "readelf", "size", "strings", "lipo", "sysroot"]
   
-  def __post_init__(self):
-    files= [
-      self.triple_cc,
-      self.triple_cxx,
-      self.cc,
-      self.cxx,
-      self.as_tool,
-      self.yasm,
-      self.ar,
-      self.nm,
-      self.ranlib, 
-      self.strip,
-      self.readelf,
-      self.size,
-      self.strings,
-      self.lipo,
-      self.sysroot
-    ]
-    for f in files:
+  def __post_init__(self, validate):
+    if not validate:
+      return
+    for name in self.CHECKED_FIELDS:
+      f = getattr(self, name)
       if not os.path.exists(f):
         raise ConfigureError(f"Tool {f} does not exist")
+
+  def to_env(self) -> dict:
+    """environment variables consumed by the build scripts of modules
+    """
+    return {
+      "TRIPLE_CC": self.triple_cc,
+      "TRIPLE_CXX": self.triple_cxx,
+      "AR": self.ar,
+      "NM": self.nm,
+      "STRIP": self.strip,
+      "RANLIB": self.ranlib,
+      "SYS_ROOT": self.sysroot,
+      "PATH": self.path,
+      "CC_LAUNCHER": self.launcher,
+      **({"C_FLAGS": self.cflags} if self.cflags else {}),
+    }
   
 
 def get_platform_env_android(cfg:BuildConfigure)-> tuple[ToolchainVars, HostVars]:
-  env = {}
-  ndk_home = env["ANDROID_NDK_HOME"] = os.environ["ANDROID_NDK_HOME"]
-  if not os.path.exists(env["ANDROID_NDK_HOME"]):
-    raise ConfigureError(f"ANDROID_NDK_HOME {env['ANDROID_NDK_HOME']} does not exist!")
-  triple_cc=""
-  ff_arch=""
-  android_abi=""
-  android_api_lv=21
-  host_var = detect_host()
-  if cfg.arch == "armv7a":
-    triple=f"armv7a-linux-androideabi{android_api_lv}"
-    ff_arch="armv7a"
-    android_abi="armeabi-v7a"
-  elif cfg.arch == "x86":
-    triple=f"i686-linux-android{android_api_lv}"
-    ff_arch="i686"
-    android_abi="x86"
-  elif cfg.arch == "x86_64":
-    triple=f"x86_64-linux-android{android_api_lv}"
-    ff_arch="x86_64"
-    android_abi="x86_64"
-  elif cfg.arch == "arm64":
-    triple=f"aarch64-linux-android{android_api_lv}"
-    ff_arch="aarch64"
-    android_abi="arm64-v8a"
+  # the NDK is probed once and cached on disk, see base.toolchain
+  from base.toolchain import android_toolchain
+  return android_toolchain(cfg, _find_launcher(cfg))
 
-  else:
-    raise ConfigureError(f"Unknown arch {cfg.arch} for platform {cfg.platform}")
-  
-  env["TRIPLE_CC"] = triple_cc
-  env["FF_ARCH"] = ff_arch
-  env["ANDROID_ABI"] = android_abi
-  host_tag=host_var.host_tag
-  env["TOOLCHAIN_ROOT"] = TOOLCHAIN_ROOT=f"{env['ANDROID_NDK_HOME']}/toolchains/llvm/prebuilt/{host_tag}"
-  env["SYS_ROOT"]=f"{env['TOOLCHAIN_ROOT']}/sysroot"
-  PATH_ENV=os.environ["PATH"]
-  PATH_ENV=f"{env['TOOLCHAIN_ROOT']}/bin:{PATH_ENV}"
-  env["PATH"] = PATH_ENV
-  tvar = ToolchainVars(triple_cc=f"{TOOLCHAIN_ROOT}/bin/{triple}-clang",
-                       triple_cxx=f"{TOOLCHAIN_ROOT}/bin/{triple}-clang++",
-                       cc=f"{TOOLCHAIN_ROOT}/bin/clang",
-                       cxx=f"{TOOLCHAIN_ROOT}/bin/clang++",
-                       as_tool=f"{TOOLCHAIN_ROOT}/bin/llvm-as",
-                       yasm=f"{TOOLCHAIN_ROOT}/bin/yasm",
-                       ar=f"{TOOLCHAIN_ROOT}/bin/llvm-ar",
-                       nm=f"{TOOLCHAIN_ROOT}/bin/llvm-nm",
-                       ranlib=f"{TOOLCHAIN_ROOT}/bin/llvm-ranlib",
-                       strip=f"{TOOLCHAIN_ROOT}/bin/llvm-strip",
-                       readelf=f"{TOOLCHAIN_ROOT}/bin/llvm-readelf",
-                       size=f"{TOOLCHAIN_ROOT}/bin/llvm-size",
-                       strings=f"{TOOLCHAIN_ROOT}/bin/llvm-strings",
-                       lipo=f"{TOOLCHAIN_ROOT}/bin/llvm-lipo",
-                       sysroot=f"{env['SYS_ROOT']}",
-                       make=f"{ndk_home}/prebuilt/{host_tag}/bin/make",
-                       path=PATH_ENV)
-  return (tvar, host_var)
+def get_platform_env_apple(cfg:BuildConfigure)-> tuple[ToolchainVars, HostVars]:
+  from base.toolchain import apple_toolchain
+  return apple_toolchain(cfg, _find_launcher(cfg))
+
+def _find_launcher(cfg:BuildConfigure):
+  from base.compiler_cache import find_launcher
+  launcher = find_launcher(cfg.compiler_cache)
+  if cfg.compiler_cache not in ("", "none") and not launcher:
+    logging.getLogger('build').warning(f"Compiler cache {cfg.compiler_cache} is not found, build without it")
+  return launcher
 
 def get_platform_envs(cfg:BuildConfigure):
   if cfg.platform == "android":
     return get_platform_env_android(cfg)
+  elif cfg.platform in ("apple", "ios", "tvos", "macos"):
+    return get_platform_env_apple(cfg)
   else:
     raise ConfigureError(f"Unknown platform {cfg.platform}")
 
@@ -245,7 +453,14 @@ class FFModule(ABC):
     根据repo 要创建多个arch的base，因此要保留一个作为sample， 避免重复clone
     """
     self.cfg = cfg
+    self.toolchain = toolchain
+    self.host = host
     self.repo = None
+    self.logger = logging.getLogger('build')
+    # shared by all modules when set, see base.jobserver
+    self.jobserver = None
+    # CompilerCacheStats of the last build if a compiler cache is used
+    self.compiler_cache_stats = None
     # will be initilaized by subclasses
     self.module_config = None
     
@@ -255,29 +470,130 @@ class FFModule(ABC):
   
   def init_sample_repo(self, repo_url, repo_save):
     # TODO fix the spelling
-    self.repo = Repo(repo_url, repo_save, self.module_config.get("has_submodule", False))
-    self.repo.init()
-    self.repo.reset()
-    self.repo.apply_patches(os.path.join(self.cfg.get_patch_dir(), self.module_config.get("patch_dir", "Not exist")))
+    self.repo = Repo(repo_url, repo_save, self.module_config.get("has_submodule", False),
+                     self.cfg.git_mirror_dir, self.cfg.clone_mode)
+    commit = self.get_commit()
+    self.repo.init(commit)
+    if commit:
+      # patches are synced incrementally on top of commit, see Repo.sync_patches
+      self.repo.abort_am()
+      self.repo.ensure_commit(commit)
+      self.repo.apply_patches(self.get_module_patch_dir(), base=commit)
+    else:
+      self.repo.reset()
+      self.repo.apply_patches(self.get_module_patch_dir())
 
   
+  def get_sample_dir(self):
+    if self.repo:
+      return self.repo.path_to_clone
+    return os.path.join(self.cfg.get_samples_dir(), self.module_config["repo_save_dir"])
+
+  def get_arch_source_dir(self):
+    return os.path.join(self.cfg.get_arch_workspace(), self.module_config["repo_save_dir"])
+
+  def get_commit(self):
+    """the upstream commit or tag to build, None means the current HEAD
+    """
+    return os.environ.get(self.module_config.get("commit_env", ""), self.module_config.get("commit"))
+
+  def get_module_patch_dir(self):
+    return os.path.join(self.cfg.get_patch_dir(), self.module_config.get("patch_dir", "Not exist"))
+
+  def get_build_flags(self) -> list:
+    """configure flags which affect the build output, part of the build cache key
+    """
+    return []
+
+  def get_sample_commit(self) -> str:
+    res = subprocess.run(["git", "rev-parse", "HEAD"], cwd=self.get_sample_dir(), stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE, text=True)
+    if res.returncode != 0:
+      raise InitError(f"No repo in {self.get_sample_dir()}: {res.stderr.strip()}")
+    return res.stdout.strip()
+
+  def sync_arch_source(self):
+    """make the arch source tree the sample it is built from, the build key is computed from the sample.
+    a tree made from another commit of the sample, e.g. before a patch was added, is brought to the
+    current one: a worktree checks it out and keeps the objects of the former build, a copy is made again
+    """
+    from base import planner
+    name = self.module_config["name"]
+    source_dir = self.get_arch_source_dir()
+    commit = self.get_sample_commit()
+    if os.path.exists(source_dir) and planner.read_source_commit(self.cfg, name) != commit:
+      if os.path.isfile(os.path.join(source_dir, ".git")):
+        self.logger.info(f"{source_dir} was made from another sample commit, check out {commit[:12]}")
+        # checkout writes the changed files only, with new mtimes, make rebuilds what depends on them
+        res = subprocess.run(["git", "checkout", "--detach", "--force", commit], cwd=source_dir,
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        if res.returncode != 0:
+          raise InitError(f"Check out {commit} in {source_dir} failed: {res.stdout.strip()}")
+      else:
+        self.logger.info(f"{source_dir} was made from another sample commit, make it again")
+        import shutil
+        shutil.rmtree(source_dir)
+    if not os.path.exists(source_dir):
+      self.copy_sample_to(source_dir)
+    planner.write_source_commit(self.cfg, name, commit)
+
+  def get_source_rev(self) -> str:
+    """the tree of the patched sample, identical sources give identical trees
+    even if the patches were applied again with new commit hashes
+    """
+    # plain git, a cache hit should not pay for importing GitPython
+    res = subprocess.run(["git", "rev-parse", "HEAD^{tree}"], cwd=self.get_sample_dir(), stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE, text=True)
+    if res.returncode != 0:
+      raise InitError(f"No repo in {self.get_sample_dir()}: {res.stderr.strip()}")
+    return res.stdout.strip()
+
+  def get_build_key(self) -> str:
+    from base.cache import compute_build_key
+    return compute_build_key(self.get_source_rev(), self.get_module_patch_dir(), self.get_build_flags(), self.toolchain)
+
+  def get_build_fingerprints(self) -> dict:
+    """the parts of the build key, see base.planner
+    """
+    from base.cache import build_fingerprints
+    return build_fingerprints(self.get_source_rev(), self.get_module_patch_dir(), self.get_build_flags(), self.toolchain)
+
+  def store_prefix(self):
+    """keep the files the module installed into the arch prefix in the artifact store, under
+    <platform>-<arch>-<build key>. the prefix is shared, the files of other libraries are left out
+    """
+    from base import planner
+    from base.store import open_store
+    store = open_store(self.cfg.artifact_store, self.cfg.get_jobs())
+    if not store:
+      return
+    name = self.module_config["name"]
+    files = planner.read_installed_files(self.cfg, name)
+    if not files:
+      self.logger.warning(f"No installed files of {name} are recorded, not stored")
+      return
+    key = self.get_build_key()
+    build_id = f"{self.cfg.platform}-{self.cfg.arch}-{key[:16]}"
+    store.put(name, build_id, self.cfg.get_arch_install_prefix(), files,
+              meta={"platform": self.cfg.platform, "arch": self.cfg.arch, "key": key},
+              group=f"{self.cfg.platform}-{self.cfg.arch}")
+
   def copy_sample_to(self, target_dir):
-    if not self.repo:
-      raise InitError("No repo, maybe not initialized?")
+    sample_dir = self.get_sample_dir()
+    if not os.path.exists(sample_dir):
+      raise InitError(f"No repo in {sample_dir}, maybe not initialized?")
     par = os.path.dirname(target_dir)
     if not os.path.exists(par):
       os.makedirs(par)
-    print(f"Copy {self.repo.path_to_clone} to {target_dir}")
-    ret = os.system(f"cp -rf {self.repo.path_to_clone} {target_dir}")
-    if ret != 0:
-      raise BuildError(f"Copy {self.repo.path_to_clone} to {target_dir} failed")
+    from base.materialize import default_strategies, materialize
+    return materialize(sample_dir, target_dir, default_strategies(self.module_config.get("private_files")))
   
   def copy_sample_to_arch(self, parent_dir:str):
     target = f"{parent_dir}/{self.cfg.arch}"
     self.copy_sample_to(target)
   
   @abstractmethod
-  def do_init():
+  def do_init(self):
     """do the initialization
     1. clone the source code, or download the library
     2. prepare all the patches
@@ -285,7 +601,7 @@ class FFModule(ABC):
     pass
 
   @abstractmethod
-  def do_install_prebuilt():
+  def do_install_prebuilt(self):
     """install the prebuilt libraries
     if no prebuilt, an error will be raised.
     """
@@ -316,4 +632,16 @@ class FFModule(ABC):
     """dirty works after build
     """
     pass
+
+  def assemble(self, arch_cfgs: list) -> bool:
+    """merge the install prefixes of all built archs into the universal outputs, see base.universal
+    """
+    from base.universal import assemble
+    libraries = self.module_config.get("libraries", [])
+    if not libraries:
+      return True
+    prefixes = {c.arch: c.get_arch_install_prefix() for c in arch_cfgs}
+    report = assemble(self.cfg.platform, self.module_config["name"], libraries, prefixes,
+                      os.path.abspath(self.cfg.install_prefix), self.toolchain.lipo, self.cfg.get_jobs())
+    return report.ok
   
\ No newline at end of file
@@ -0,0 +1,295 @@
+"""structured build logs and failure triage
+
+every record is one json line. the output of a build step goes to its own
+stream, one per library, arch and phase:
+
+  <arch workspace>/logs/<library>/<phase>.jsonl        {"run", "n", "t", "s", "line"}
+  <arch workspace>/logs/<library>/<phase>.index.json   the diagnostics of the last run
+  <workspace>/logs/runs/<run id>.jsonl                 the records of the `build` logger
+
+a stream is rotated by size like logging.handlers.RotatingFileHandler, the
+records of one run are told apart by their run id. when the step ends the
+stream is indexed once: the compiler diagnostics with file, line, severity and
+the command which compiled the file, the errors of make and, for configure,
+the tail of ffbuild/config.log like the error_handler of do-compile/*/ffmpeg.sh.
+`--action triage` only reads the indexes, so it answers at once however large
+the logs are.
+"""
+from collections import deque
+import glob
+import json
+import logging
+import logging.handlers
+import os
+import re
+import threading
+import time
+
+from base import trace
+
+logger = logging.getLogger('build')
+
+LOG_DIR = "logs"
+INDEX_SUFFIX = ".index.json"
+MAX_BYTES = int(os.environ.get("MR_LOG_MAX_BYTES", 64 * 1024 * 1024))
+BACKUPS = int(os.environ.get("MR_LOG_BACKUPS", 3))
+# run logs kept in <workspace>/logs/runs
+MAX_RUNS = int(os.environ.get("MR_LOG_RUNS", 20))
+# diagnostics kept per severity in an index
+MAX_DIAGNOSTICS = 100
+CONTEXT_LINES = 5
+CONFIG_LOG_TAIL = 20
+SEVERITIES = ["fatal error", "error", "warning"]
+
+# path:line[:column]: severity: message, as gcc and clang print them
+_DIAGNOSTIC_RE = re.compile(r"^(?P<file>[^\s:][^:]*):(?P<line>\d+):(?:(?P<column>\d+):)?\s*"
+                            r"(?P<severity>fatal error|error|warning):\s*(?P<message>.*)$")
+# errors without a source position, of the linker, the compiler driver or the assembler
+_TOOL_ERROR_RE = re.compile(r"(?:^|\s)(?:ld(?:\.lld)?|clang(?:\+\+)?|gcc|cc1|as|ar|nasm): (?:fatal )?error: |"
+                            r"undefined reference to|undefined symbol: ")
+_MAKE_ERROR_RE = re.compile(r"^make(?:\[\d+\])?: \*\*\* (?:\[(?P<target>[^\]]+)\] )?(?P<message>.*)$")
+# ./configure prints its failures as ERROR: ...
+_CONFIGURE_ERROR_RE = re.compile(r"^ERROR: ")
+# a compiler or assembler invocation of make V=1
+_COMMAND_RE = re.compile(r"\s-c\s|\s-o\s")
+
+
+def new_run_id() -> str:
+  return f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{threading.get_ident() % 10000:04d}"
+
+
+def stream_path(arch_workspace: str, library: str, phase: str) -> str:
+  return os.path.join(arch_workspace, LOG_DIR, library, f"{phase}.jsonl")
+
+
+def index_path(path: str) -> str:
+  return path[:-len(".jsonl")] + INDEX_SUFFIX
+
+
+class JsonFormatter(logging.Formatter):
+  """a record as one json line, with the library, arch and phase of the trace context of its thread
+  """
+  def format(self, record: logging.LogRecord) -> str:
+    data = {"t": round(record.created, 3), "level": record.levelname, "logger": record.name}
+    data.update({k: v for k, v in trace.current().items() if k in ("library", "arch", "phase")})
+    data["msg"] = record.getMessage()
+    if record.exc_info:
+      data["exc"] = self.formatException(record.exc_info)
+    return json.dumps(data, ensure_ascii=False)
+
+
+def json_handler(path: str) -> logging.Handler:
+  os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+  handler = logging.handlers.RotatingFileHandler(path, maxBytes=MAX_BYTES, backupCount=BACKUPS, encoding="utf-8")
+  handler.setFormatter(JsonFormatter())
+  return handler
+
+
+def run_log_handler(workspace: str) -> logging.Handler:
+  """the json lines of this run in <workspace>/logs/runs, the oldest runs beyond MR_LOG_RUNS are removed
+  """
+  run_dir = os.path.join(workspace, LOG_DIR, "runs")
+  os.makedirs(run_dir, exist_ok=True)
+  runs = sorted(glob.glob(os.path.join(run_dir, "*.jsonl")), key=os.path.getmtime)
+  for path in runs[:max(0, len(runs) - MAX_RUNS + 1)]:
+    for part in glob.glob(f"{path}*"):
+      os.remove(part)
+  return json_handler(os.path.join(run_dir, f"{new_run_id()}.jsonl"))
+
+
+class Stream(object):
+  def __init__(self, arch_workspace: str, library: str, arch: str, phase: str):
+    """the output of one phase, a sink of base.proc
+
+    Args:
+        phase (str): configure, make, install ...
+    """
+    self.path = stream_path(arch_workspace, library, phase)
+    self.library = library
+    self.arch = arch
+    self.phase = phase
+    self.run = new_run_id()
+    self.lines = 0
+    self.__lock = threading.Lock()
+    self.__handler = logging.handlers.RotatingFileHandler(self.path, maxBytes=MAX_BYTES, backupCount=BACKUPS,
+                                                          encoding="utf-8", delay=True)
+    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+  def write(self, stream: str, line: str):
+    with self.__lock:
+      self.lines += 1
+      record = json.dumps({"run": self.run, "n": self.lines, "t": round(time.time(), 3), "s": stream, "line": line},
+                          ensure_ascii=False)
+    # the handler rolls the file over and has its own lock
+    self.__handler.emit(logging.makeLogRecord({"msg": record}))
+
+  def close(self):
+    self.__handler.close()
+
+  def records(self):
+    """the records of this run, across the rotated files, the oldest first
+    """
+    parts = [f"{self.path}.{i}" for i in range(BACKUPS, 0, -1)] + [self.path]
+    for part in parts:
+      if not os.path.exists(part):
+        continue
+      with open(part, encoding="utf-8", errors="replace") as f:
+        for text in f:
+          # most lines are from other runs or can't be diagnostics, skip the json parsing for those
+          if self.run not in text:
+            continue
+          try:
+            record = json.loads(text)
+          except ValueError:
+            continue
+          if record.get("run") == self.run:
+            yield record
+
+
+def _command_of(commands: deque, path: str) -> str:
+  """the latest command of make which names the file
+  """
+  name = os.path.basename(path)
+  for command in reversed(commands):
+    if name in command:
+      return command
+  return ""
+
+
+def config_log_tail(source_dir: str, lines: int = CONFIG_LOG_TAIL) -> list[str]:
+  path = os.path.join(source_dir, "ffbuild", "config.log")
+  try:
+    with open(path, "rb") as f:
+      # the end of a config.log of many MB is enough
+      f.seek(max(0, os.path.getsize(path) - 64 * 1024))
+      return f.read().decode(errors="replace").splitlines()[-lines:]
+  except OSError:
+    return []
+
+
+def index_stream(stream: Stream, returncode: int, source_dir: str = "") -> dict:
+  """one pass over the run of stream, the index is written next to it
+
+  Args:
+      source_dir (str): the tree the phase ran in, its ffbuild/config.log is read when configure failed
+  """
+  start = time.monotonic()
+  diagnostics = []
+  counts = {s: 0 for s in SEVERITIES}
+  make_errors = []
+  configure_errors = []
+  commands = deque(maxlen=256)
+  before = deque(maxlen=CONTEXT_LINES)
+  root = None
+  for record in stream.records():
+    line = record.get("line", "")
+    match = _DIAGNOSTIC_RE.match(line)
+    if match:
+      severity = match.group("severity")
+      counts[severity] += 1
+      if counts[severity] <= MAX_DIAGNOSTICS:
+        diagnostics.append({
+          "n": record["n"], "file": match.group("file"), "line": int(match.group("line")),
+          "column": int(match.group("column") or 0), "severity": severity, "message": match.group("message"),
+          "command": _command_of(commands, match.group("file")),
+        })
+    elif _TOOL_ERROR_RE.search(line):
+      counts["error"] += 1
+      if counts["error"] <= MAX_DIAGNOSTICS:
+        diagnostics.append({"n": record["n"], "file": "", "line": 0, "column": 0, "severity": "error",
+                            "message": line.strip(), "command": commands[-1] if commands else ""})
+    elif _MAKE_ERROR_RE.match(line):
+      make_errors.append(line.strip())
+    elif _CONFIGURE_ERROR_RE.match(line):
+      configure_errors.append(line.strip())
+    elif _COMMAND_RE.search(line):
+      commands.append(line.strip())
+    if root is None and diagnostics and diagnostics[-1]["severity"] != "warning":
+      root = diagnostics[-1]
+      root["before"] = list(before)
+      root["after"] = []
+    elif root is not None and len(root["after"]) < CONTEXT_LINES and record["n"] > root["n"]:
+      root["after"].append(line)
+    before.append(line)
+  index = {
+    "library": stream.library,
+    "arch": stream.arch,
+    "phase": stream.phase,
+    "run": stream.run,
+    "ok": returncode == 0,
+    "returncode": returncode,
+    "lines": stream.lines,
+    "log": stream.path,
+    "finished": time.time(),
+    "counts": counts,
+    "root_cause": root,
+    "diagnostics": diagnostics,
+    "make_errors": make_errors[:MAX_DIAGNOSTICS],
+    "configure_errors": configure_errors[:MAX_DIAGNOSTICS],
+  }
+  if returncode != 0 and stream.phase == "configure" and source_dir:
+    tail = config_log_tail(source_dir)
+    # the compiler error of the check which failed last
+    errors = [l for l in tail if (m := _DIAGNOSTIC_RE.match(l)) and m.group("severity") != "warning"]
+    index["config_log"] = {"path": os.path.join(source_dir, "ffbuild", "config.log"), "tail": tail,
+                           "error": errors[-1] if errors else ""}
+  path = index_path(stream.path)
+  with open(f"{path}.tmp", "w") as f:
+    json.dump(index, f, indent=1, ensure_ascii=False)
+  os.replace(f"{path}.tmp", path)
+  logger.debug(f"indexed {stream.lines} lines of {stream.path} in {time.monotonic() - start:.2f}s")
+  return index
+
+
+def find_indexes(arch_workspace: str, library: str = "") -> list[dict]:
+  """the indexes of the phases of an arch, the newest first
+  """
+  pattern = os.path.join(arch_workspace, LOG_DIR, library or "*", f"*{INDEX_SUFFIX}")
+  res = []
+  for path in glob.glob(pattern):
+    try:
+      with open(path) as f:
+        res.append(json.load(f))
+    except (OSError, ValueError):
+      continue
+  return sorted(res, key=lambda i: -i.get("finished", 0))
+
+
+def _position(diag: dict) -> str:
+  if not diag["file"]:
+    return ""
+  return f"{diag['file']}:{diag['line']}" + (f":{diag['column']}" if diag["column"] else "") + ": "
+
+
+def format_triage(index: dict, more: int = 5) -> str:
+  """the root cause of a failed phase, then the next errors
+  """
+  counts = index["counts"]
+  errors = counts.get("fatal error", 0) + counts.get("error", 0)
+  lines = [f"{index['library']} {index['arch']} {index['phase']} failed with {index['returncode']}, "
+           f"{errors} errors, {counts.get('warning', 0)} warnings in {index['lines']} lines, log: {index['log']}"]
+  root = index.get("root_cause")
+  if root:
+    lines.append(f"root cause: {_position(root)}{root['severity']}: {root['message']}")
+    if root.get("command"):
+      lines.append(f"  command: {root['command']}")
+    context = root.get("before", []) + [f"> {_position(root)}{root['severity']}: {root['message']}"] + root.get("after", [])
+    lines.extend(f"  | {l}" for l in context)
+  elif index.get("configure_errors"):
+    lines.append(f"root cause: {index['configure_errors'][0]}")
+    if index.get("config_log", {}).get("error"):
+      lines.append(f"  the failed check: {index['config_log']['error']}")
+  elif index.get("make_errors"):
+    lines.append(f"root cause: {index['make_errors'][0]}")
+  else:
+    lines.append(f"no diagnostics found, see the end of {index['log']}")
+  if index.get("config_log", {}).get("tail"):
+    lines.append(f"{index['config_log']['path']}:")
+    lines.extend(f"  | {l}" for l in index["config_log"]["tail"])
+  others = [d for d in index["diagnostics"] if d["severity"] != "warning" and d["n"] != (root or {}).get("n")]
+  if others:
+    lines.append("next errors:")
+    lines.extend(f"  {_position(d)}{d['severity']}: {d['message']}" for d in others[:more])
+  if index.get("make_errors"):
+    lines.append(f"stopped at: {index['make_errors'][-1]}")
+  return "\n".join(lines)
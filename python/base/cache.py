@@ -0,0 +1,288 @@
+"""content addressed cache of installed prefixes
+
+the key is a sha256 of everything which affects the build output: the source
+tree, the patch series, the configure flags and the toolchain. a hit restores
+the files the module installed instead of compiling it. the arch prefix is
+shared with other libraries, only the module's own files are saved and
+restored, see planner.record_installed_files.
+"""
+from dataclasses import dataclass
+import functools
+import glob
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+from base import ToolchainVars
+
+logger = logging.getLogger('build')
+
+DEFAULT_MAX_BYTES = 10 * 1024 ** 3
+DEFAULT_MAX_AGE = 30 * 24 * 3600
+
+
+@functools.lru_cache(maxsize=None)
+def compiler_version(cc: str) -> str:
+  """first line of `cc --version`, empty if the compiler can not run
+  """
+  try:
+    res = subprocess.run([cc, "--version"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, timeout=30)
+  except (OSError, subprocess.TimeoutExpired):
+    return ""
+  return res.stdout.splitlines()[0] if res.stdout else ""
+
+
+def toolchain_fingerprint(toolchain: ToolchainVars) -> list[str]:
+  """the parts of the toolchain which affect the output, without machine specific paths
+  so the key can be shared between machines. on apple every arch uses the same clang,
+  the arch and the min os version are only in the target cflags
+  """
+  toolchain_root = os.path.dirname(os.path.dirname(toolchain.triple_cc))
+  res = [
+    toolchain.cc_version or compiler_version(toolchain.triple_cc),
+    os.path.basename(toolchain.triple_cc),
+    os.path.relpath(toolchain.sysroot, toolchain_root),
+  ]
+  # android keeps the target in the compiler name, its keys stay the same
+  if toolchain.cflags:
+    res.append(toolchain.cflags)
+  return res
+
+
+def hash_patches(patch_dir: str, hasher):
+  for patch in sorted(glob.glob(os.path.join(patch_dir, "*.patch"))):
+    hasher.update(os.path.basename(patch).encode())
+    with open(patch, "rb") as f:
+      hasher.update(hashlib.sha256(f.read()).digest())
+
+
+def compute_build_key(source_rev: str, patch_dir: str, flags: list[str], toolchain: ToolchainVars) -> str:
+  """
+  Args:
+      source_rev (str): git commit or tree of the source
+      patch_dir (str): directory of the patch series, may not exist
+      flags (list[str]): configure flags of the module
+      toolchain (ToolchainVars): the resolved toolchain
+  """
+  hasher = hashlib.sha256()
+  for part in ["source", source_rev, "patches"]:
+    hasher.update(part.encode() + b"\0")
+  if patch_dir and os.path.isdir(patch_dir):
+    hash_patches(patch_dir, hasher)
+  hasher.update(b"flags\0")
+  for flag in flags:
+    hasher.update(flag.strip().encode() + b"\0")
+  hasher.update(b"toolchain\0")
+  for part in toolchain_fingerprint(toolchain):
+    hasher.update(part.encode() + b"\0")
+  return hasher.hexdigest()
+
+
+def build_fingerprints(source_rev: str, patch_dir: str, flags: list[str], toolchain: ToolchainVars) -> dict[str, str]:
+  """a sha256 of every part of the build key, tell which part made two keys differ
+  """
+  res = {"source": hashlib.sha256(source_rev.encode()).hexdigest()}
+  hasher = hashlib.sha256()
+  if patch_dir and os.path.isdir(patch_dir):
+    hash_patches(patch_dir, hasher)
+  res["patches"] = hasher.hexdigest()
+  res["flags"] = hashlib.sha256(b"\0".join(f.strip().encode() for f in flags)).hexdigest()
+  res["toolchain"] = hashlib.sha256("\0".join(toolchain_fingerprint(toolchain)).encode()).hexdigest()
+  return res
+
+
+class LocalCacheBackend(object):
+  def __init__(self, root: str, max_bytes: int = DEFAULT_MAX_BYTES, max_age: float = DEFAULT_MAX_AGE):
+    self.root = os.path.abspath(root)
+    self.max_bytes = max_bytes
+    self.max_age = max_age
+    os.makedirs(self.root, exist_ok=True)
+
+  def _path(self, key: str):
+    return os.path.join(self.root, key[:2], f"{key}.tar.gz")
+
+  def has(self, key: str) -> bool:
+    return os.path.exists(self._path(key))
+
+  def get(self, key: str, dst_file: str) -> bool:
+    path = self._path(key)
+    if not os.path.exists(path):
+      return False
+    shutil.copyfile(path, dst_file)
+    # mtime is the last use time, used by eviction
+    os.utime(path)
+    return True
+
+  def put(self, key: str, src_file: str):
+    path = self._path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    shutil.copyfile(src_file, tmp)
+    os.replace(tmp, path)
+    self.evict()
+
+  def entries(self) -> list[tuple[str, float, int]]:
+    res = []
+    for path in glob.glob(os.path.join(self.root, "*", "*.tar.gz")):
+      try:
+        st = os.stat(path)
+      except FileNotFoundError:
+        continue
+      res.append((path, st.st_mtime, st.st_size))
+    return res
+
+  def evict(self):
+    """drop entries older than max_age, then the least recently used ones until
+    the cache is smaller than max_bytes
+    """
+    now = time.time()
+    entries = []
+    for path, mtime, size in self.entries():
+      if now - mtime > self.max_age:
+        self._remove(path)
+      else:
+        entries.append((path, mtime, size))
+    total = sum(size for _, _, size in entries)
+    for path, _, size in sorted(entries, key=lambda e: e[1]):
+      if total <= self.max_bytes:
+        break
+      self._remove(path)
+      total -= size
+
+  def _remove(self, path: str):
+    try:
+      os.remove(path)
+      logger.info(f"[cache] evict {os.path.basename(path)}")
+    except FileNotFoundError:
+      pass
+
+
+class HttpCacheBackend(object):
+  """GET/PUT `<url>/<key>.tar.gz`, any static file server works for reading
+  """
+  def __init__(self, url: str, timeout: float = 60):
+    self.url = url.rstrip("/")
+    self.timeout = timeout
+
+  def has(self, key: str) -> bool:
+    req = urllib.request.Request(f"{self.url}/{key}.tar.gz", method="HEAD")
+    try:
+      urllib.request.urlopen(req, timeout=self.timeout).close()
+    except (urllib.error.URLError, OSError):
+      return False
+    return True
+
+  def get(self, key: str, dst_file: str) -> bool:
+    try:
+      with urllib.request.urlopen(f"{self.url}/{key}.tar.gz", timeout=self.timeout) as resp, open(dst_file, "wb") as f:
+        shutil.copyfileobj(resp, f)
+    except urllib.error.HTTPError as e:
+      if e.code != 404:
+        logger.warning(f"[cache] get {key} from {self.url} failed: {e}")
+      return False
+    except (urllib.error.URLError, OSError) as e:
+      logger.warning(f"[cache] get {key} from {self.url} failed: {e}")
+      return False
+    return True
+
+  def put(self, key: str, src_file: str):
+    with open(src_file, "rb") as f:
+      req = urllib.request.Request(f"{self.url}/{key}.tar.gz", data=f.read(), method="PUT")
+    try:
+      urllib.request.urlopen(req, timeout=self.timeout).close()
+    except (urllib.error.URLError, OSError) as e:
+      logger.warning(f"[cache] put {key} to {self.url} failed: {e}")
+
+
+@dataclass
+class CacheStats(object):
+  hits: int = 0
+  misses: int = 0
+  saves: int = 0
+
+
+class ArtifactCache(object):
+  def __init__(self, backends: list):
+    """
+    Args:
+        backends (list): searched in order, the first one is also filled by hits of the others
+    """
+    self.backends = backends
+    self.stats = CacheStats()
+
+  def contains(self, key: str) -> bool:
+    """whether a restore of key would hit, nothing is downloaded
+    """
+    return any(backend.has(key) for backend in self.backends)
+
+  def restore(self, key: str, prefix: str, stale: list = None) -> list[str]:
+    """extract the files of key into the shared prefix, None on a miss
+
+    Args:
+        stale (list): files of the former install of the module, removed unless the entry has them too
+    Returns:
+        list[str]: the restored files, relative to prefix
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      archive = os.path.join(tmp_dir, "artifact.tar.gz")
+      for i, backend in enumerate(self.backends):
+        if not backend.get(key, archive):
+          continue
+        os.makedirs(prefix, exist_ok=True)
+        with tarfile.open(archive, "r:gz") as tar:
+          members = [m for m in tar.getmembers() if not m.isdir()]
+          files = [os.path.normpath(m.name) for m in members]
+          for rel in set(stale or []) - set(files):
+            _remove_file(os.path.join(prefix, rel))
+          for rel in files:
+            # tarfile writes into an existing file, it may be a link into the artifact store
+            _remove_file(os.path.join(prefix, rel))
+          tar.extractall(prefix, members, filter="data")
+        if i > 0:
+          self.backends[0].put(key, archive)
+        self.stats.hits += 1
+        logger.info(f"[cache] hit {key[:12]}, restored {len(files)} files into {prefix}")
+        return files
+    self.stats.misses += 1
+    logger.info(f"[cache] miss {key[:12]}")
+    return None
+
+  def save(self, key: str, prefix: str, files: list):
+    """
+    Args:
+        files (list): the files of the module in the shared prefix, relative to it, the files
+            other libraries installed there are not part of the entry
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      archive = os.path.join(tmp_dir, "artifact.tar.gz")
+      with tarfile.open(archive, "w:gz") as tar:
+        for rel in sorted(files):
+          tar.add(os.path.join(prefix, rel), arcname=rel, recursive=False)
+      for backend in self.backends:
+        backend.put(key, archive)
+    self.stats.saves += 1
+
+
+def _remove_file(path: str):
+  try:
+    os.remove(path)
+  except FileNotFoundError:
+    pass
+
+
+def create_cache(cache_dir: str = "", cache_url: str = "") -> ArtifactCache:
+  """None if neither a local directory nor an url is given
+  """
+  backends = []
+  if cache_dir:
+    backends.append(LocalCacheBackend(cache_dir))
+  if cache_url:
+    backends.append(HttpCacheBackend(cache_url))
+  return ArtifactCache(backends) if backends else None
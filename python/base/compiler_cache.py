@@ -0,0 +1,131 @@
+"""opt-in ccache/sccache launcher for the compilers of ToolchainVars
+
+the launcher is put in front of cc/cxx only, never in front of the linker.
+ccache is pinned to settings which let several workspaces and arch copies of
+the same source share hits: paths are rewritten relative to the source copy
+and the compiler is identified by its content instead of its mtime. every arch
+gets its own sccache server, the statistics of one server are the ones of its arch.
+"""
+from dataclasses import dataclass
+import json
+import os
+import shutil
+import socket
+import subprocess
+
+LAUNCHERS = ["ccache", "sccache"]
+
+# the result counters of the ccache stats log, one per compilation. ccache 4.6+ also writes
+# the storage counters (local_storage_hit, ...) and a direct miss before a preprocessed hit,
+# older ones write the descriptions
+CCACHE_HIT_COUNTERS = {"direct_cache_hit", "preprocessed_cache_hit", "cache hit (direct)", "cache hit (preprocessed)"}
+CCACHE_MISS_COUNTERS = {"cache_miss", "cache miss"}
+
+
+@dataclass
+class CompilerCacheStats(object):
+  launcher: str
+  hits: int = 0
+  misses: int = 0
+
+  def __str__(self):
+    total = self.hits + self.misses
+    rate = f"{100.0 * self.hits / total:.1f}%" if total else "n/a"
+    return f"{self.launcher}: {self.hits} hits, {self.misses} misses, hit rate {rate}"
+
+
+def find_launcher(name: str) -> str:
+  """path of the launcher, `auto` picks the first one installed, empty if none
+  """
+  if not name or name == "none":
+    return ""
+  for candidate in (LAUNCHERS if name == "auto" else [name]):
+    path = shutil.which(candidate)
+    if path:
+      return path
+  return ""
+
+
+def _free_port() -> int:
+  with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+    sock.bind(("127.0.0.1", 0))
+    return sock.getsockname()[1]
+
+
+def launcher_env(launcher: str, base_dir: str, stats_log: str) -> dict:
+  """env vars pinning cache friendly settings
+
+  Args:
+      base_dir (str): the per-arch source copy, absolute paths below it are hashed as relative ones
+      stats_log (str): ccache writes the result of every compilation here, so concurrent
+          builds sharing one cache directory still get their own statistics
+  """
+  if os.path.basename(launcher) == "sccache":
+    # the archs build at the same time, a server of their own counts only their compilations
+    return {"SCCACHE_SERVER_PORT": str(_free_port())}
+  if os.path.basename(launcher) != "ccache":
+    return {}
+  return {
+    "CCACHE_BASEDIR": os.path.abspath(base_dir),
+    "CCACHE_NOHASHDIR": "1",
+    "CCACHE_COMPILERCHECK": "content",
+    "CCACHE_SLOPPINESS": "time_macros,include_file_mtime,include_file_ctime,file_stat_matches",
+    "CCACHE_STATSLOG": os.path.abspath(stats_log),
+  }
+
+
+def _sccache(args: list, env: dict) -> str:
+  return subprocess.run(["sccache", *args], env={**os.environ, **env}, stdout=subprocess.PIPE,
+                        stderr=subprocess.DEVNULL, text=True, timeout=30).stdout
+
+
+def sccache_counts(env: dict = None) -> tuple[int, int]:
+  """hits and misses of the sccache server SCCACHE_SERVER_PORT of env points to
+  """
+  try:
+    stats = json.loads(_sccache(["--show-stats", "--stats-format=json"], env or {}))["stats"]
+  except (OSError, subprocess.TimeoutExpired, ValueError, KeyError):
+    return 0, 0
+  count = lambda key: sum(stats.get(key, {}).get("counts", {}).values())
+  return count("cache_hits"), count("cache_misses")
+
+
+class CompilerCacheSession(object):
+  """statistics of one build, by the stats log of ccache or a before/after diff of the sccache
+  server of the build
+  """
+  def __init__(self, launcher: str, stats_log: str, env: dict = None):
+    """
+    Args:
+        env (dict): the env of the build, with the SCCACHE_SERVER_PORT of launcher_env
+    """
+    self.launcher = os.path.basename(launcher)
+    self.stats_log = stats_log
+    self.env = env or {}
+    if os.path.exists(stats_log):
+      os.remove(stats_log)
+    self.start = sccache_counts(self.env) if self.launcher == "sccache" else (0, 0)
+
+  def stats(self) -> CompilerCacheStats:
+    """the statistics since the session started, the sccache server of the build is stopped
+    """
+    res = CompilerCacheStats(self.launcher)
+    if self.launcher == "sccache":
+      hits, misses = sccache_counts(self.env)
+      res.hits, res.misses = hits - self.start[0], misses - self.start[1]
+      try:
+        _sccache(["--stop-server"], self.env)
+      except (OSError, subprocess.TimeoutExpired):
+        pass
+      return res
+    try:
+      with open(self.stats_log) as f:
+        for line in f:
+          counter = line.strip()
+          if counter in CCACHE_HIT_COUNTERS:
+            res.hits += 1
+          elif counter in CCACHE_MISS_COUNTERS:
+            res.misses += 1
+    except FileNotFoundError:
+      pass
+    return res
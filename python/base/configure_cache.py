@@ -0,0 +1,125 @@
+"""snapshots of configure outputs
+
+a fingerprint of the configure command line, the env it reads and the source
+files it reads decides if configure has to run again. the outputs of every
+fingerprint are kept aside, so switching back to a former configuration only
+copies a few files instead of running configure.
+"""
+import hashlib
+import logging
+import os
+import shutil
+
+logger = logging.getLogger('build')
+
+# env vars read by configure scripts, other vars do not change the result
+CONFIGURE_ENV_KEYS = [
+  "TRIPLE_CC", "TRIPLE_CXX", "AR", "NM", "STRIP", "RANLIB", "SYS_ROOT",
+  "C_FLAGS", "LDFLAGS", "PKG_CONFIG_EXECUTABLE", "PKG_CONFIG_PATH", "PKG_CONFIG_LIBDIR",
+]
+
+FINGERPRINT_FILE = ".configure-fingerprint"
+
+
+def source_tree_fingerprint(source_path: str, inputs: list) -> str:
+  """a sha256 of the files configure reads, a missing file counts too. the rest of the tree,
+  e.g. a patched decoder or an edit in watch, needs make but not configure
+  """
+  hasher = hashlib.sha256()
+  for rel in sorted(inputs):
+    hasher.update(rel.encode() + b"\0")
+    try:
+      with open(os.path.join(source_path, rel), "rb") as f:
+        hasher.update(hashlib.sha256(f.read()).digest())
+    except FileNotFoundError:
+      hasher.update(b"-")
+  return hasher.hexdigest()
+
+
+def configure_fingerprint(command: list, env: dict, source_path: str, inputs: list) -> str:
+  """
+  Args:
+      inputs (list): the files of the source configure reads, relative to source_path
+  """
+  hasher = hashlib.sha256()
+  for arg in command:
+    hasher.update(arg.encode() + b"\0")
+  for key in CONFIGURE_ENV_KEYS:
+    hasher.update(f"{key}={env.get(key, '')}".encode() + b"\0")
+  hasher.update(source_tree_fingerprint(source_path, inputs).encode())
+  return hasher.hexdigest()
+
+
+class ConfigureCache(object):
+  def __init__(self, source_path: str, outputs: list, cache_dir: str = None):
+    """
+    Args:
+        source_path (str): the directory configure runs in
+        outputs (list): files generated by configure, relative to source_path
+        cache_dir (str): where the snapshots are kept, default is next to source_path
+    """
+    self.source_path = source_path
+    self.outputs = outputs
+    self.cache_dir = cache_dir or f"{os.path.abspath(source_path)}.configure-cache"
+
+  def current(self) -> str:
+    """the fingerprint the tree was configured with, empty if unknown
+    """
+    try:
+      with open(os.path.join(self.source_path, FINGERPRINT_FILE)) as f:
+        return f.read().strip()
+    except FileNotFoundError:
+      return ""
+
+  def is_configured(self, fingerprint: str) -> bool:
+    if self.current() != fingerprint:
+      return False
+    return all(os.path.exists(os.path.join(self.source_path, o)) for o in self.outputs)
+
+  def restore(self, fingerprint: str) -> bool:
+    snapshot = os.path.join(self.cache_dir, fingerprint)
+    if not all(os.path.exists(os.path.join(snapshot, o)) for o in self.outputs):
+      return False
+    for output in self.outputs:
+      dst = os.path.join(self.source_path, output)
+      os.makedirs(os.path.dirname(dst), exist_ok=True)
+      # never write through a hardlink shared with the sample
+      if os.path.exists(dst):
+        os.remove(dst)
+      shutil.copy(os.path.join(snapshot, output), dst)
+      # the objects built with another configuration are older, make must rebuild them
+      os.utime(dst)
+    self._mark(fingerprint)
+    logger.info(f"[configure] restored snapshot {fingerprint[:12]} into {self.source_path}")
+    return True
+
+  def save(self, fingerprint: str):
+    snapshot = os.path.join(self.cache_dir, fingerprint)
+    tmp = f"{snapshot}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    for output in self.outputs:
+      src = os.path.join(self.source_path, output)
+      if not os.path.exists(src):
+        logger.warning(f"[configure] {output} is not generated, snapshot skipped")
+        shutil.rmtree(tmp, ignore_errors=True)
+        self._mark(fingerprint)
+        return
+      dst = os.path.join(tmp, output)
+      os.makedirs(os.path.dirname(dst), exist_ok=True)
+      shutil.copy2(src, dst)
+    shutil.rmtree(snapshot, ignore_errors=True)
+    os.replace(tmp, snapshot)
+    self._mark(fingerprint)
+
+  def invalidate(self):
+    try:
+      os.remove(os.path.join(self.source_path, FINGERPRINT_FILE))
+    except FileNotFoundError:
+      pass
+
+  def _mark(self, fingerprint: str):
+    path = os.path.join(self.source_path, FINGERPRINT_FILE)
+    # replace instead of rewriting, the file may be a hardlink shared with the sample
+    with open(f"{path}.tmp", "w") as f:
+      f.write(fingerprint)
+    os.replace(f"{path}.tmp", path)
@@ -0,0 +1,344 @@
+"""long-lived build daemon on a unix socket
+
+the daemon imports the driver once and forks a worker per request, so a
+request starts with GitPython, the modules and everything loaded before the
+fork already in memory. each worker gets the env and cwd of its client and its
+own copy of the driver globals, so concurrent requests do not see each other.
+the daemon itself is one thread serving the socket, the clients and the worker
+pipes by a selector, forking from it never copies a lock held by another thread.
+
+identical requests (argv, cwd and the build related env) which arrive while
+one of them runs are attached to the running one: they get its output replayed
+and its exit code instead of building again. requests beyond `max_parallel`
+wait in a queue.
+
+the protocol is one JSON object per line. the client sends
+  {"argv": [...], "cwd": "...", "env": {...}}
+and receives
+  {"out": "..."}*  then  {"exit": 0, "shared": false}
+or {"stale": true} when the sources of the daemon changed since it started,
+the client runs the build by itself and the daemon exits once the running
+requests are done.
+"""
+import codecs
+import hashlib
+import json
+import logging
+import os
+import selectors
+import signal
+import socket
+import sys
+
+logger = logging.getLogger('build.daemon')
+
+DEFAULT_SOCKET = os.path.join(os.path.expanduser("~"), ".cache", "mr-ffbuild", "daemon.sock")
+
+# env vars which change what a request does, the others do not break dedup
+DEDUP_ENV_PREFIXES = ("MR_", "GIT_", "REPO_", "ANDROID_", "DEVELOPER_DIR", "PATH", "CC", "CXX", "C_FLAGS", "LDFLAGS")
+
+
+def get_socket_path() -> str:
+  return os.environ.get("MR_DAEMON_SOCKET") or DEFAULT_SOCKET
+
+
+def request_key(request: dict) -> str:
+  env = {k: v for k, v in request.get("env", {}).items() if k.startswith(DEDUP_ENV_PREFIXES)}
+  data = json.dumps([request.get("argv", []), request.get("cwd", ""), env], sort_keys=True)
+  return hashlib.sha256(data.encode()).hexdigest()
+
+
+def _source_mtimes() -> dict:
+  res = {}
+  for module in list(sys.modules.values()):
+    path = getattr(module, "__file__", None)
+    if path and path.endswith(".py") and not path.startswith(sys.prefix):
+      try:
+        res[path] = os.stat(path).st_mtime_ns
+      except OSError:
+        res[path] = 0
+  return res
+
+
+class Job(object):
+  """one forked worker, its output is kept for clients which attach later
+  """
+  def __init__(self, key: str, request: dict):
+    self.key = key
+    self.request = request
+    self.pid = 0
+    # the read end of the output of the worker
+    self.fd = -1
+    self.chunks = []
+    self.exit_code = None
+    self.clients = []
+    self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+
+class _Client(object):
+  def __init__(self, sock):
+    self.sock = sock
+    self.rbuf = b""
+    self.wbuf = b""
+    self.shared = False
+    # close once the buffered messages are sent
+    self.done = False
+
+  def send(self, msg: dict):
+    self.wbuf += (json.dumps(msg) + "\n").encode()
+
+
+def fork_worker(request: dict, run_func, close_fds: list) -> tuple[int, int]:
+  """run run_func(argv) in a forked child with the env and cwd of the request
+
+  Returns:
+      tuple[int, int]: pid of the child and the read end of its stdout and stderr
+  """
+  rfd, wfd = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    code = 1
+    try:
+      os.close(rfd)
+      for fd in close_fds:
+        os.close(fd)
+      os.dup2(wfd, 1)
+      os.dup2(wfd, 2)
+      os.close(wfd)
+      os.environ.clear()
+      os.environ.update(request.get("env", {}))
+      os.chdir(request.get("cwd") or "/")
+      code = run_func(request.get("argv", []))
+    except SystemExit as e:
+      code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except BaseException:
+      import traceback
+      traceback.print_exc()
+    finally:
+      sys.stdout.flush()
+      sys.stderr.flush()
+      os._exit(code or 0)
+  os.close(wfd)
+  os.set_blocking(rfd, False)
+  return pid, rfd
+
+
+class BuildDaemon(object):
+  """a single threaded loop over the socket, the clients and the worker pipes
+
+  the daemon never starts a thread, so a fork never happens while another thread
+  holds a lock of logging or of the imported modules.
+  """
+  def __init__(self, socket_path: str, run_func, max_parallel: int = 4):
+    """
+    Args:
+        run_func: runs one request in the worker, takes the argv and returns the exit code
+        max_parallel (int): workers running at the same time
+    """
+    self.socket_path = socket_path
+    self.run_func = run_func
+    self.max_parallel = max(1, max_parallel)
+    # by request key, the running and the queued ones
+    self.jobs = {}
+    self.queue = []
+    self.running = 0
+    self.stopping = False
+    self.sources = _source_mtimes()
+    self.selector = selectors.DefaultSelector()
+    os.makedirs(os.path.dirname(os.path.abspath(socket_path)), exist_ok=True)
+    if os.path.exists(socket_path):
+      # a daemon which still answers owns the socket, a dead one left it behind
+      if _ping(socket_path):
+        raise OSError(f"a daemon is already listening on {socket_path}")
+      os.remove(socket_path)
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.sock.bind(socket_path)
+    self.sock.listen(16)
+    self.sock.setblocking(False)
+    self.selector.register(self.sock, selectors.EVENT_READ)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def is_stale(self) -> bool:
+    return any(os.path.exists(p) and os.stat(p).st_mtime_ns != m for p, m in self.sources.items())
+
+  def serve_forever(self):
+    """until the sources change, then the running and queued requests are finished first
+    """
+    while not (self.stopping and not self.jobs and not self._has_output()):
+      for sel_key, events in self.selector.select(timeout=1):
+        if sel_key.fileobj is self.sock:
+          self._accept()
+        elif isinstance(sel_key.data, Job):
+          self._read_worker(sel_key.data)
+        elif events & selectors.EVENT_READ:
+          self._read_client(sel_key.data)
+        else:
+          self._flush(sel_key.data)
+
+  def _has_output(self) -> bool:
+    return any(isinstance(k.data, _Client) and k.data.wbuf for k in self.selector.get_map().values())
+
+  def _accept(self):
+    try:
+      conn, _ = self.sock.accept()
+    except BlockingIOError:
+      return
+    if self.stopping:
+      # the client runs the build by itself
+      conn.close()
+      return
+    conn.setblocking(False)
+    self.selector.register(conn, selectors.EVENT_READ, _Client(conn))
+
+  def _read_client(self, client: _Client):
+    try:
+      data = client.sock.recv(65536)
+    except (BlockingIOError, InterruptedError):
+      return
+    except OSError:
+      data = b""
+    if not data:
+      # the client went away, the worker keeps running for the other clients
+      self._drop(client)
+      return
+    client.rbuf += data
+    if b"\n" not in client.rbuf:
+      return
+    line = client.rbuf.split(b"\n", 1)[0]
+    self.selector.modify(client.sock, selectors.EVENT_WRITE, client)
+    try:
+      request = json.loads(line)
+    except ValueError:
+      client.send({"out": "daemon got a malformed request\n"})
+      client.send({"exit": 1, "shared": False})
+      client.done = True
+      return
+    if request.get("ping"):
+      client.send({"pong": os.getpid()})
+      client.done = True
+      return
+    if self.stopping or self.is_stale():
+      if not self.stopping:
+        logger.info("sources changed, the daemon exits")
+      self.stopping = True
+      client.send({"stale": True})
+      client.done = True
+      return
+    self._attach(client, request)
+
+  def _attach(self, client: _Client, request: dict):
+    """to the running job of an identical request, or a new one
+    """
+    key = request_key(request)
+    job = self.jobs.get(key)
+    client.shared = job is not None
+    logger.info(f"{'attach to' if client.shared else 'run'} {' '.join(request.get('argv', []))} in {request.get('cwd')}")
+    if not job:
+      job = self.jobs[key] = Job(key, request)
+      self.queue.append(job)
+    for chunk in job.chunks:
+      client.send({"out": chunk})
+    job.clients.append(client)
+    self._start_queued()
+
+  def _start_queued(self):
+    while self.queue and self.running < self.max_parallel:
+      job = self.queue.pop(0)
+      close_fds = [k.fd for k in self.selector.get_map().values()]
+      try:
+        job.pid, job.fd = fork_worker(job.request, self.run_func, close_fds)
+      except OSError as e:
+        self._append(job, f"daemon failed to run the request: {e}\n")
+        self._finish(job, 1)
+        continue
+      self.running += 1
+      self.selector.register(job.fd, selectors.EVENT_READ, job)
+
+  def _read_worker(self, job: Job):
+    try:
+      data = os.read(job.fd, 65536)
+    except (BlockingIOError, InterruptedError):
+      return
+    if data:
+      self._append(job, job.decoder.decode(data))
+      return
+    self.selector.unregister(job.fd)
+    os.close(job.fd)
+    _, status = os.waitpid(job.pid, 0)
+    self.running -= 1
+    self._append(job, job.decoder.decode(b"", final=True))
+    self._finish(job, os.waitstatus_to_exitcode(status))
+    self._start_queued()
+
+  def _append(self, job: Job, text: str):
+    if not text:
+      return
+    job.chunks.append(text)
+    for client in job.clients:
+      client.send({"out": text})
+      self._flush(client)
+
+  def _finish(self, job: Job, code: int):
+    job.exit_code = code
+    self.jobs.pop(job.key, None)
+    for client in job.clients:
+      client.send({"exit": code, "shared": client.shared})
+      client.done = True
+      self._flush(client)
+
+  def _flush(self, client: _Client):
+    if client.sock.fileno() < 0:
+      return
+    try:
+      sent = client.sock.send(client.wbuf) if client.wbuf else 0
+    except (BlockingIOError, InterruptedError):
+      return
+    except OSError:
+      self._drop(client)
+      return
+    client.wbuf = client.wbuf[sent:]
+    if not client.wbuf and client.done:
+      self._drop(client)
+
+  def _drop(self, client: _Client):
+    for job in self.jobs.values():
+      if client in job.clients:
+        job.clients.remove(client)
+    client.wbuf = b""
+    if client.sock.fileno() >= 0:
+      self.selector.unregister(client.sock)
+      client.sock.close()
+
+  def close(self):
+    self.selector.close()
+    self.sock.close()
+    if os.path.exists(self.socket_path):
+      os.remove(self.socket_path)
+
+
+def _ping(socket_path: str) -> bool:
+  try:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+      s.settimeout(2)
+      s.connect(socket_path)
+      s.sendall(b'{"ping": true}\n')
+      return b"pong" in s.recv(1024)
+  except OSError:
+    return False
+
+
+def serve(run_func, socket_path: str = "", max_parallel: int = 4):
+  socket_path = socket_path or get_socket_path()
+  with BuildDaemon(socket_path, run_func, max_parallel) as server:
+    logger.info(f"build daemon {os.getpid()} listening on {socket_path}")
+    # leave through the with block, so the socket is removed
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+      server.serve_forever()
+    except KeyboardInterrupt:
+      pass
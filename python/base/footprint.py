@@ -0,0 +1,322 @@
+"""binary size and symbol footprint of the built libraries
+
+after a build every .a/.so/.dylib the module installed goes through the
+size, nm and readelf of the toolchain, all of them at the same time. the size
+of each object is attributed to the components which compile it, read from the
+`OBJS-$(CONFIG_<X>) += x.o` lines of the library Makefiles, and to the patches
+which touch its sources. the report is JSON, and the report of the previous
+build is kept to diff against, so a flag which does not pay for itself or a
+patch which grows the binary shows up in the log.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+import json
+import logging
+import os
+import re
+import subprocess
+
+from base import BuildError
+
+logger = logging.getLogger('build')
+
+LIB_SUFFIXES = (".a", ".so", ".dylib")
+# CONFIG_<NAME>_<SUFFIX> -> kind of the component
+CONFIG_KINDS = {
+  "DECODER": "decoder", "ENCODER": "encoder", "DEMUXER": "demuxer", "MUXER": "muxer",
+  "PARSER": "parser", "BSF": "bsf", "PROTOCOL": "protocol", "FILTER": "filter",
+  "HWACCEL": "hwaccel", "INDEV": "indev", "OUTDEV": "outdev",
+}
+TOP_SYMBOLS = 50
+
+_OBJS_RE = re.compile(r"^[A-Z0-9_-]*OBJS(?:-\$\(CONFIG_([A-Z0-9_]+)\))?\s*[+:]?=\s*(.*)$")
+_PATCH_FILE_RE = re.compile(r"^\+\+\+ b/(\S+)", re.M)
+
+
+def component_name(config: str) -> str:
+  """decoder:h264 for H264_DECODER, the other configs are subsystems, e.g. subsystem:h264dsp
+  """
+  if not config:
+    return "core"
+  head, _, tail = config.rpartition("_")
+  if head and tail in CONFIG_KINDS:
+    return f"{CONFIG_KINDS[tail]}:{head.lower()}"
+  return f"subsystem:{config.lower()}"
+
+
+def parse_makefile_objects(text: str) -> dict[str, set]:
+  """object: components, from the OBJS lines of an ffmpeg Makefile. the object is relative
+  to the library directory, e.g. aarch64/h264dsp_neon.o
+  """
+  res = {}
+  # join the continued lines first
+  for line in text.replace("\\\n", " ").splitlines():
+    match = _OBJS_RE.match(line.strip())
+    if not match:
+      continue
+    component = component_name(match.group(1) or "")
+    for obj in match.group(2).split():
+      if obj.endswith(".o"):
+        res.setdefault(obj, set()).add(component)
+  return res
+
+
+def object_components(source_dir: str, library: str) -> dict[str, set]:
+  """object: components of lib<name>, from <source>/lib<name>/Makefile and its arch subdirs.
+  the object is relative to the source, e.g. libavcodec/aarch64/h264dsp_neon.o
+  """
+  lib_dir = os.path.join(source_dir, library)
+  res = {}
+  if not os.path.isdir(lib_dir):
+    return res
+  makefiles = [os.path.join(lib_dir, "Makefile")]
+  for entry in sorted(os.listdir(lib_dir)):
+    if os.path.isfile(os.path.join(lib_dir, entry, "Makefile")):
+      makefiles.append(os.path.join(lib_dir, entry, "Makefile"))
+  for path in makefiles:
+    try:
+      with open(path, encoding="utf-8", errors="replace") as f:
+        text = f.read()
+    except OSError:
+      continue
+    for obj, components in parse_makefile_objects(text).items():
+      res.setdefault(f"{library}/{obj}", set()).update(components)
+  return res
+
+
+def patch_objects(patch_dir: str) -> dict[str, set]:
+  """patch file: the objects built from the sources it touches, e.g. libavcodec/h264dec.o
+  """
+  res = {}
+  if not patch_dir or not os.path.isdir(patch_dir):
+    return res
+  for name in sorted(os.listdir(patch_dir)):
+    if not name.endswith(".patch"):
+      continue
+    with open(os.path.join(patch_dir, name), encoding="utf-8", errors="replace") as f:
+      files = _PATCH_FILE_RE.findall(f.read())
+    objs = {os.path.splitext(p)[0] + ".o" for p in files if p.endswith((".c", ".S", ".asm", ".cpp", ".m"))}
+    if objs:
+      res[name] = objs
+  return res
+
+
+def _run(command: list) -> str:
+  try:
+    res = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, errors="replace")
+  except OSError:
+    return ""
+  return res.stdout if res.returncode == 0 else ""
+
+
+def parse_size(output: str) -> dict[str, dict]:
+  """member (or file): {text, data, bss} of the berkeley output of size/llvm-size
+  """
+  res = {}
+  for line in output.splitlines():
+    parts = line.split(None, 5)
+    if len(parts) < 6 or not parts[0].isdigit():
+      continue
+    # "h264dec.o (ex libavcodec.a)" in archives
+    name = os.path.basename(parts[5].split(" (ex ")[0].strip())
+    entry = res.setdefault(name, {"text": 0, "data": 0, "bss": 0})
+    entry["text"] += int(parts[0])
+    entry["data"] += int(parts[1])
+    entry["bss"] += int(parts[2])
+  return res
+
+
+def parse_nm(output: str) -> list[tuple[str, str, str, int]]:
+  """(member, symbol, type, size) of `nm -S --defined-only`
+  """
+  res = []
+  member = ""
+  for line in output.splitlines():
+    if line.endswith(":") and " " not in line.strip():
+      member = os.path.basename(line[:-1])
+      continue
+    parts = line.split()
+    if len(parts) == 4:
+      try:
+        res.append((member, parts[3], parts[2], int(parts[1], 16)))
+      except ValueError:
+        pass
+  return res
+
+
+def parse_needed(output: str) -> list[str]:
+  return re.findall(r"\(NEEDED\)\s+Shared library: \[([^\]]+)\]", output)
+
+
+@dataclass
+class LibraryFootprint(object):
+  name: str
+  file_size: int = 0
+  text: int = 0
+  data: int = 0
+  bss: int = 0
+  # member: text + data, one entry for a shared library
+  objects: dict = field(default_factory=dict)
+  top_symbols: list = field(default_factory=list)
+  needed: list = field(default_factory=list)
+
+
+def analyze_library(path: str, tools: dict) -> LibraryFootprint:
+  """size, nm and readelf of one library, the three run concurrently
+  """
+  lib = LibraryFootprint(os.path.basename(path), os.path.getsize(path))
+  with open(path, "rb") as f:
+    is_elf = f.read(4) == b"\x7fELF"
+  commands = {
+    "size": [tools["size"], path] if tools.get("size") else None,
+    "nm": [tools["nm"], "-S", "--defined-only", path] if tools.get("nm") else None,
+    "readelf": [tools["readelf"], "-d", "-W", path] if tools.get("readelf") and is_elf else None,
+  }
+  with ThreadPoolExecutor(max_workers=3) as pool:
+    outputs = {k: pool.submit(_run, c) if c else None for k, c in commands.items()}
+    outputs = {k: f.result() if f else "" for k, f in outputs.items()}
+  for name, entry in parse_size(outputs["size"]).items():
+    lib.text += entry["text"]
+    lib.data += entry["data"]
+    lib.bss += entry["bss"]
+    lib.objects[name] = lib.objects.get(name, 0) + entry["text"] + entry["data"]
+  symbols = sorted(parse_nm(outputs["nm"]), key=lambda s: -s[3])
+  lib.top_symbols = [{"object": m, "symbol": s, "type": t, "size": n} for m, s, t, n in symbols[:TOP_SYMBOLS]]
+  lib.needed = parse_needed(outputs["readelf"])
+  return lib
+
+
+def find_libraries(prefix: str, files: list = None) -> list[str]:
+  """
+  Args:
+      files (list): the files of the module in the shared prefix, relative to it. the libraries
+          other modules installed there are left out, all of them without files
+  """
+  lib_dir = os.path.join(prefix, "lib")
+  if not os.path.isdir(lib_dir):
+    return []
+  own = None if files is None else {os.path.normpath(f) for f in files}
+  return sorted(os.path.join(lib_dir, f) for f in os.listdir(lib_dir)
+                if f.endswith(LIB_SUFFIXES) and os.path.isfile(os.path.join(lib_dir, f))
+                and (own is None or os.path.join("lib", f) in own))
+
+
+def _library_dir_name(lib_name: str) -> str:
+  """libavcodec for libavcodec.a and libavcodec.so
+  """
+  return lib_name.split(".")[0]
+
+
+def counted_libraries(libs: list) -> list:
+  """one artifact per library, the static archive when both are installed, its members
+  are what the components and patches are attributed from
+  """
+  res = {}
+  for lib in libs:
+    name = _library_dir_name(lib.name)
+    if name not in res or lib.name.endswith(".a"):
+      res[name] = lib
+  return [res[name] for name in sorted(res)]
+
+
+def analyze(prefix: str, tools: dict, source_dir: str = "", patch_dir: str = "", max_workers: int = 8,
+            files: list = None) -> dict:
+  """the footprint report of every library of prefix
+
+  Args:
+      tools (dict): paths of size, nm and readelf, missing ones are skipped
+      source_dir (str): the built source tree, its Makefiles attribute objects to components
+      patch_dir (str): the applied patches, attributed the objects they touch
+      files (list): the files of the module in the shared prefix, see find_libraries
+  """
+  paths = find_libraries(prefix, files)
+  with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(paths) or 1))) as pool:
+    libs = list(pool.map(lambda p: analyze_library(p, tools), paths))
+  counted = counted_libraries(libs)
+  components = {}
+  patches = {}
+  by_patch = patch_objects(patch_dir)
+  for lib in counted:
+    lib_dir = _library_dir_name(lib.name)
+    owners = object_components(source_dir, lib_dir) if source_dir else {}
+    # archive members are basenames, the Makefiles tell the path below the source
+    paths = {}
+    for path in owners:
+      paths.setdefault(os.path.basename(path), set()).add(path)
+    for obj, size in lib.objects.items():
+      obj_paths = paths.get(obj, {f"{lib_dir}/{obj}"})
+      # an object shared by several components is split between them
+      names = sorted(set().union(*(owners.get(p, set()) for p in obj_paths)) or {"unattributed"})
+      for name in names:
+        components[name] = components.get(name, 0) + size // len(names)
+      for patch, objs in by_patch.items():
+        if obj_paths & objs:
+          patches[patch] = patches.get(patch, 0) + size
+  return {
+    "prefix": prefix,
+    "total": sum(lib.text + lib.data for lib in counted),
+    "libraries": {lib.name: vars(lib) for lib in libs},
+    "components": dict(sorted(components.items(), key=lambda kv: -kv[1])),
+    "patches": dict(sorted(patches.items())),
+  }
+
+
+def diff_reports(old: dict, new: dict) -> dict:
+  """size changes from old to new, per library, component and patch, unchanged entries are left out
+  """
+  def delta(a: dict, b: dict) -> dict:
+    res = {k: b.get(k, 0) - a.get(k, 0) for k in set(a) | set(b)}
+    return dict(sorted(((k, v) for k, v in res.items() if v), key=lambda kv: -abs(kv[1])))
+  lib_sizes = lambda r: {k: v["text"] + v["data"] for k, v in r.get("libraries", {}).items()}
+  return {
+    "total": new.get("total", 0) - old.get("total", 0),
+    "libraries": delta(lib_sizes(old), lib_sizes(new)),
+    "components": delta(old.get("components", {}), new.get("components", {})),
+    "patches": delta(old.get("patches", {}), new.get("patches", {})),
+  }
+
+
+def _read_json(path: str) -> dict:
+  try:
+    with open(path) as f:
+      return json.load(f)
+  except (OSError, ValueError):
+    return {}
+
+
+def _write_json(path: str, data: dict):
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with open(f"{path}.tmp", "w") as f:
+    json.dump(data, f, indent=1)
+  os.replace(f"{path}.tmp", path)
+
+
+def write_report(report: dict, report_path: str, baseline_path: str = "") -> dict:
+  """write report and its diff against baseline, or the previous report at report_path
+
+  the previous report is kept as <name>.prev.json.
+  """
+  prev_path = re.sub(r"\.json$", "", report_path) + ".prev.json"
+  if os.path.exists(report_path):
+    os.replace(report_path, prev_path)
+  _write_json(report_path, report)
+  baseline = _read_json(baseline_path or prev_path)
+  if not baseline:
+    return {}
+  diff = diff_reports(baseline, report)
+  _write_json(re.sub(r"\.json$", "", report_path) + ".diff.json", diff)
+  changes = ", ".join(f"{k} {v:+d}" for k, v in list(diff["components"].items())[:5])
+  logger.info(f"footprint {diff['total']:+d} bytes against {baseline_path or 'the previous build'}"
+              + (f": {changes}" if changes else ""))
+  return diff
+
+
+def check_growth(diff: dict, max_growth: int, report_path: str, prefix: str):
+  """raise BuildError when the total grew by more than max_growth bytes, 0 is no limit
+
+  it runs after make install, the prefix has the grown libraries already. failing here
+  keeps them out of the artifact store and the build cache.
+  """
+  if max_growth and diff.get("total", 0) > max_growth:
+    raise BuildError(f"Binary size grew by {diff['total']} bytes, more than {max_growth}, see {report_path}, "
+                     f"the libraries are installed in {prefix} already but neither stored nor cached")
@@ -0,0 +1,202 @@
+"""library dependency graph and its executor
+
+every library declares the libraries it links against, the executor builds
+independent libraries concurrently and always starts the ready node with the
+longest remaining chain first, so the whole graph takes about as long as its
+critical path.
+"""
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
+import logging
+import os
+import subprocess
+import time
+from typing import Callable
+
+from base import BuildError, ConfigureError
+from base import trace
+
+# the same as what auto-detect-third-libs.sh and the do-compile scripts probe by pkg-config
+FFMPEG_DEPENDS = ["openssl", "opus", "dav1d", "smb2", "bluray", "dvdread", "dvdnav", "uavs3d", "xml2"]
+
+LIBRARY_DEPENDS = {
+  "ffmpeg": FFMPEG_DEPENDS,
+  "ffmpeg4": FFMPEG_DEPENDS,
+  "ffmpeg5": FFMPEG_DEPENDS,
+  "ffmpeg6": FFMPEG_DEPENDS,
+  "ffmpeg7": FFMPEG_DEPENDS,
+  "ijkffmpeg": ["openssl"],
+  "fftutorial": ["ffmpeg"],
+  "ass": ["freetype", "fribidi", "harfbuzz", "unibreak", "fontconfig"],
+  "harfbuzz": ["freetype"],
+  "fontconfig": ["freetype"],
+  "bluray": ["xml2"],
+  "dvdnav": ["dvdread"],
+}
+
+SHELL_ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+
+@dataclass
+class BuildNode(object):
+  name: str
+  action: Callable[[], None]
+  depends: list[str] = field(default_factory=list)
+  # estimated seconds, used to start the longest chain first
+  cost: float = 1.0
+
+
+@dataclass
+class NodeResult(object):
+  name: str
+  ok: bool
+  start: float = 0.0
+  end: float = 0.0
+  error: str = ""
+
+  @property
+  def elapsed(self):
+    return self.end - self.start
+
+
+class BuildGraph(object):
+  def __init__(self):
+    self.nodes: dict[str, BuildNode] = {}
+
+  def add(self, node: BuildNode):
+    if node.name in self.nodes:
+      raise ConfigureError(f"Node {node.name} is added twice")
+    self.nodes[node.name] = node
+
+  def topo_order(self) -> list[str]:
+    """Kahn's algorithm, raise ConfigureError on unknown depends or cycles
+    """
+    indegree = {}
+    for node in self.nodes.values():
+      for dep in node.depends:
+        if dep not in self.nodes:
+          raise ConfigureError(f"{node.name} depends on unknown library {dep}")
+      indegree[node.name] = len(node.depends)
+    ready = sorted(name for name, degree in indegree.items() if degree == 0)
+    order = []
+    while ready:
+      name = ready.pop(0)
+      order.append(name)
+      for dependent in self.dependents(name):
+        indegree[dependent] -= 1
+        if indegree[dependent] == 0:
+          ready.append(dependent)
+    if len(order) != len(self.nodes):
+      cycle = sorted(set(self.nodes) - set(order))
+      raise ConfigureError(f"Dependency cycle among {cycle}")
+    return order
+
+  def dependents(self, name: str) -> list[str]:
+    return sorted(n.name for n in self.nodes.values() if name in n.depends)
+
+  def remaining_costs(self) -> dict[str, float]:
+    """cost of the longest chain starting at every node (node itself included)
+    """
+    remain = {}
+    for name in reversed(self.topo_order()):
+      tail = max((remain[d] for d in self.dependents(name)), default=0.0)
+      remain[name] = self.nodes[name].cost + tail
+    return remain
+
+  def critical_path(self, durations: dict[str, float] = None) -> tuple[list[str], float]:
+    """the longest chain through the graph by `durations`, or by the estimated costs
+    """
+    cost = lambda name: durations.get(name, 0.0) if durations is not None else self.nodes[name].cost
+    best: dict[str, tuple[float, list[str]]] = {}
+    for name in self.topo_order():
+      prev = max((best[d] for d in self.nodes[name].depends), default=(0.0, []), key=lambda b: b[0])
+      best[name] = (prev[0] + cost(name), prev[1] + [name])
+    if not best:
+      return [], 0.0
+    length, path = max(best.values(), key=lambda b: b[0])
+    return path, length
+
+
+class GraphExecutor(object):
+  def __init__(self, graph: BuildGraph, max_workers: int = 0):
+    self.graph = graph
+    self.max_workers = max_workers if max_workers > 0 else (os.cpu_count() or 1)
+    self.logger = logging.getLogger('build')
+    self.results: dict[str, NodeResult] = {}
+
+  def _run_node(self, node: BuildNode) -> NodeResult:
+    start = time.monotonic()
+    try:
+      with trace.context(library=node.name), trace.span("library", "graph"):
+        node.action()
+    except Exception as e:
+      return NodeResult(node.name, False, start, time.monotonic(), str(e))
+    return NodeResult(node.name, True, start, time.monotonic())
+
+  def run(self) -> dict[str, NodeResult]:
+    """run every node after its depends, a failed node skips all its dependents
+    """
+    remain = self.graph.remaining_costs()
+    pending = {name: set(node.depends) for name, node in self.graph.nodes.items()}
+    running = {}
+    with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+      while pending or running:
+        ready = sorted((n for n, deps in pending.items() if not deps), key=lambda n: -remain[n])
+        for name in ready[:max(0, self.max_workers - len(running))]:
+          del pending[name]
+          self.logger.info(f"[graph] start {name}")
+          running[pool.submit(self._run_node, self.graph.nodes[name])] = name
+        if not running:
+          break
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+          name = running.pop(future)
+          res = self.results[name] = future.result()
+          self.logger.info(f"[graph] {name} {'done' if res.ok else 'failed: ' + res.error} in {res.elapsed:.1f}s")
+          if res.ok:
+            for deps in pending.values():
+              deps.discard(name)
+          else:
+            self._skip_dependents(name, pending)
+    return self.results
+
+  def _skip_dependents(self, name: str, pending: dict):
+    for dependent in self.graph.dependents(name):
+      if dependent in pending:
+        del pending[dependent]
+        self.results[dependent] = NodeResult(dependent, False, error=f"skipped, {name} failed")
+        self._skip_dependents(dependent, pending)
+
+  def critical_path(self) -> tuple[list[str], float]:
+    """the critical path of the last run by measured durations
+    """
+    return self.graph.critical_path({n: r.elapsed for n, r in self.results.items()})
+
+
+def shell_build_action(library: str, platform: str, arch: str) -> Callable[[], None]:
+  """build a library which has no python module yet by the shell driver
+  """
+  def action():
+    command = ["./main.sh", "compile", "-p", platform, "-c", "build", "-l", library]
+    if arch != "all":
+      command += ["-a", arch]
+    res = subprocess.run(command, cwd=SHELL_ROOT_DIR, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    if res.returncode != 0:
+      raise BuildError(f"Build {library} failed:\n{res.stdout[-4000:]}")
+  return action
+
+
+def build_library_graph(libraries: list[str], actions: dict[str, Callable[[], None]], depends: dict = None,
+                        costs: dict = None) -> BuildGraph:
+  """graph of the requested libraries, depends which are not requested are
+  expected to be installed already and are not part of the graph.
+  `depends` are the ones declared by python modules, they take precedence over LIBRARY_DEPENDS.
+  `costs` are the estimated seconds of the libraries, see base.planner
+  """
+  declared = dict(LIBRARY_DEPENDS)
+  declared.update(depends or {})
+  graph = BuildGraph()
+  for lib in libraries:
+    lib_depends = [d for d in declared.get(lib, []) if d in libraries]
+    graph.add(BuildNode(lib, actions[lib], lib_depends, (costs or {}).get(lib) or 1.0))
+  return graph
@@ -0,0 +1,148 @@
+"""resource governor and GNU make jobserver
+
+the parallelism of the machine is the smallest of the cpu count, the cpu
+affinity, the cgroup cpu quota and the memory available per compile job. it
+is handed out as tokens of one shared jobserver, every make (and ninja >= 1.13)
+started by the driver draws from the same pool, so concurrent libraries and
+archs never oversubscribe the machine.
+"""
+from contextlib import contextmanager
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+
+logger = logging.getLogger('build')
+
+# clang compiling FFmpeg peaks at about 1GB per job with -O3
+DEFAULT_MEM_PER_JOB = 1024 * 1024 * 1024
+
+
+def _read(path: str) -> str:
+  try:
+    with open(path) as f:
+      return f.read().strip()
+  except OSError:
+    return ""
+
+
+def cgroup_cpu_limit() -> float:
+  """cpus allowed by the cgroup quota, 0 means unlimited
+  """
+  quota = _read("/sys/fs/cgroup/cpu.max").split()
+  if len(quota) == 2 and quota[0] != "max":
+    return int(quota[0]) / int(quota[1])
+  quota, period = _read("/sys/fs/cgroup/cpu/cpu.cfs_quota_us"), _read("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+  if quota and period and int(quota) > 0:
+    return int(quota) / int(period)
+  return 0
+
+
+def available_memory() -> int:
+  """MemAvailable, lowered to the free part of the cgroup memory limit, 0 if unknown
+  """
+  available = 0
+  match = re.search(r"MemAvailable:\s+(\d+) kB", _read("/proc/meminfo"))
+  if match:
+    available = int(match.group(1)) * 1024
+  limit = _read("/sys/fs/cgroup/memory.max") or _read("/sys/fs/cgroup/memory/memory.limit_in_bytes")
+  usage = _read("/sys/fs/cgroup/memory.current") or _read("/sys/fs/cgroup/memory/memory.usage_in_bytes")
+  if limit.isdigit() and usage.isdigit() and int(limit) < (1 << 60):
+    cgroup_free = max(0, int(limit) - int(usage))
+    available = min(available, cgroup_free) if available else cgroup_free
+  return available
+
+
+def available_parallelism(mem_per_job: int = 0) -> int:
+  """
+  Args:
+      mem_per_job (int): bytes one compile job needs, default is MR_MEM_PER_JOB_MB or 1GB
+  """
+  if not mem_per_job:
+    mem_per_job = int(os.environ.get("MR_MEM_PER_JOB_MB", 0)) * 1024 * 1024 or DEFAULT_MEM_PER_JOB
+  limits = [os.cpu_count() or 1]
+  if hasattr(os, "sched_getaffinity"):
+    limits.append(len(os.sched_getaffinity(0)))
+  cpu_quota = cgroup_cpu_limit()
+  if cpu_quota:
+    limits.append(int(cpu_quota))
+  memory = available_memory()
+  if memory:
+    limits.append(memory // mem_per_job)
+  return max(1, min(limits))
+
+
+def make_version(make: str = "make") -> tuple:
+  """(major, minor) of GNU make, empty if make is not GNU make
+  """
+  try:
+    out = subprocess.run([make, "--version"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout
+  except OSError:
+    return ()
+  match = re.match(r"GNU Make (\d+)\.(\d+)", out)
+  return (int(match.group(1)), int(match.group(2))) if match else ()
+
+
+class JobServer(object):
+  def __init__(self, tokens: int, make: str = "make"):
+    """a pool of `tokens` job slots shared by all children
+
+    every child started with `slot()` holds one token for itself (make's implicit
+    job slot), its sub jobs take the others from the fifo.
+    """
+    self.tokens = max(1, tokens)
+    self.__dir = tempfile.mkdtemp(prefix="mr-jobserver-")
+    self.fifo = os.path.join(self.__dir, "fifo")
+    os.mkfifo(self.fifo, 0o600)
+    # O_RDWR keeps the fifo open without a reader or writer on the other side
+    self.__rfd = os.open(self.fifo, os.O_RDWR)
+    self.__wfd = os.open(self.fifo, os.O_WRONLY)
+    os.set_inheritable(self.__rfd, True)
+    os.set_inheritable(self.__wfd, True)
+    os.write(self.__wfd, b"+" * self.tokens)
+    # make < 4.4 only understands inherited file descriptors
+    self.use_fifo = make_version(make) >= (4, 4)
+    self.__lock = threading.Lock()
+
+  def makeflags(self) -> str:
+    auth = f"fifo:{self.fifo}" if self.use_fifo else f"{self.__rfd},{self.__wfd}"
+    return f"-j{self.tokens} --jobserver-auth={auth}"
+
+  def client_env(self, env: dict) -> dict:
+    env = dict(env)
+    env["MAKEFLAGS"] = f"{env.get('MAKEFLAGS', '')} {self.makeflags()}".strip()
+    return env
+
+  def pass_fds(self) -> tuple:
+    return () if self.use_fifo else (self.__rfd, self.__wfd)
+
+  @contextmanager
+  def slot(self):
+    """hold one token while a child runs
+    """
+    token = os.read(self.__rfd, 1)
+    try:
+      yield
+    finally:
+      os.write(self.__wfd, token or b"+")
+
+  def close(self):
+    with self.__lock:
+      if self.__dir:
+        os.close(self.__rfd)
+        os.close(self.__wfd)
+        shutil.rmtree(self.__dir, ignore_errors=True)
+        self.__dir = None
+
+
+def create_jobserver(tokens: int = 0, make: str = "make") -> JobServer:
+  """None if make is not GNU make, callers fall back to a fixed -jN
+  """
+  if not make_version(make):
+    return None
+  tokens = tokens or available_parallelism()
+  logger.info(f"jobserver with {tokens} tokens")
+  return JobServer(tokens, make)
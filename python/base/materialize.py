@@ -0,0 +1,183 @@
+"""materialize the sample repo into per-arch source trees
+
+a full `cp -rf` copies the whole sample, .git included, for every arch. the
+strategies below are tried in order and the first available one wins:
+
+1. git worktree, shares .git with the sample and only checks out the files
+2. reflink, copy on write clones where the filesystem supports them
+3. hardlink farm, files are linked, generated files are copied so writing them
+   never changes the sample
+4. plain copy
+"""
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+import fnmatch
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from base import BuildError
+from base.trace import span
+
+logger = logging.getLogger('build')
+
+
+@dataclass
+class MaterializeReport(object):
+  strategy: str
+  files: int
+  total_bytes: int
+  # bytes which are shared with the sample instead of being written again
+  saved_bytes: int
+  elapsed: float
+
+  def __str__(self):
+    mb = 1024 * 1024
+    return (f"{self.strategy}: {self.files} files, {self.total_bytes / mb:.1f}MB, "
+            f"{self.saved_bytes / mb:.1f}MB not copied, {self.elapsed:.2f}s")
+
+
+def tree_size(root: str, skip_git: bool = False) -> tuple[int, int]:
+  files = size = 0
+  for dirpath, dirnames, filenames in os.walk(root):
+    if skip_git and ".git" in dirnames:
+      dirnames.remove(".git")
+    for name in filenames:
+      try:
+        size += os.lstat(os.path.join(dirpath, name)).st_size
+        files += 1
+      except FileNotFoundError:
+        pass
+  return files, size
+
+
+class Strategy(ABC):
+  name = ""
+
+  def available(self, sample: str, target: str) -> bool:
+    return True
+
+  @abstractmethod
+  def materialize(self, sample: str, target: str) -> int:
+    """create target from sample, returns the bytes which are not copied
+    """
+    pass
+
+
+class WorktreeStrategy(Strategy):
+  name = "worktree"
+
+  def available(self, sample, target):
+    # submodules are not checked out by worktree add
+    return os.path.isdir(os.path.join(sample, ".git")) and not os.path.exists(os.path.join(sample, ".gitmodules"))
+
+  def materialize(self, sample, target):
+    subprocess.run(["git", "worktree", "prune"], cwd=sample, check=True)
+    subprocess.run(["git", "worktree", "add", "--detach", "--force", os.path.abspath(target), "HEAD"],
+                   cwd=sample, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    return tree_size(os.path.join(sample, ".git"))[1]
+
+
+class ReflinkStrategy(Strategy):
+  name = "reflink"
+
+  def _cp(self):
+    return ["cp", "-c", "-R"] if sys.platform == "darwin" else ["cp", "-a", "--reflink=always"]
+
+  def available(self, sample, target):
+    par = os.path.dirname(os.path.abspath(target))
+    with tempfile.TemporaryDirectory(dir=par) as probe_dir:
+      src = os.path.join(probe_dir, "src")
+      with open(src, "w") as f:
+        f.write("probe")
+      res = subprocess.run([*self._cp(), src, os.path.join(probe_dir, "dst")],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # the probe lives next to target, but sample must be on the same filesystem too
+    return res.returncode == 0 and os.stat(sample).st_dev == os.stat(par).st_dev
+
+  def materialize(self, sample, target):
+    subprocess.run([*self._cp(), sample, target], check=True, stderr=subprocess.PIPE)
+    return tree_size(target)[1]
+
+
+class HardlinkStrategy(Strategy):
+  name = "hardlink"
+
+  def __init__(self, private_globs: list = None):
+    """
+    Args:
+        private_globs (list): paths relative to the tree which are copied instead of linked,
+        for files the build writes to.
+    """
+    self.private_globs = private_globs or []
+
+  def available(self, sample, target):
+    par = os.path.dirname(os.path.abspath(target))
+    return os.stat(sample).st_dev == os.stat(par).st_dev
+
+  def materialize(self, sample, target):
+    saved = 0
+    for dirpath, dirnames, filenames in os.walk(sample):
+      if ".git" in dirnames:
+        dirnames.remove(".git")
+      rel_dir = os.path.relpath(dirpath, sample)
+      dst_dir = os.path.normpath(os.path.join(target, rel_dir))
+      os.makedirs(dst_dir, exist_ok=True)
+      for name in filenames:
+        src = os.path.join(dirpath, name)
+        dst = os.path.join(dst_dir, name)
+        rel = os.path.normpath(os.path.join(rel_dir, name))
+        if os.path.islink(src):
+          os.symlink(os.readlink(src), dst)
+        elif any(fnmatch.fnmatch(rel, g) for g in self.private_globs):
+          shutil.copy2(src, dst)
+        else:
+          os.link(src, dst)
+          saved += os.stat(src).st_size
+    return saved
+
+
+class CopyStrategy(Strategy):
+  name = "copy"
+
+  def materialize(self, sample, target):
+    shutil.copytree(sample, target, symlinks=True)
+    return 0
+
+
+def default_strategies(private_globs: list = None) -> list[Strategy]:
+  return [WorktreeStrategy(), ReflinkStrategy(), HardlinkStrategy(private_globs), CopyStrategy()]
+
+
+def materialize(sample: str, target: str, strategies: list = None) -> MaterializeReport:
+  """create target from sample by the first available strategy, `MR_MATERIALIZE`
+  forces one strategy by name
+  """
+  if os.path.exists(target):
+    raise BuildError(f"{target} exists already")
+  os.makedirs(os.path.dirname(os.path.abspath(target)), exist_ok=True)
+  strategies = strategies or default_strategies()
+  forced = os.environ.get("MR_MATERIALIZE")
+  if forced:
+    strategies = [s for s in strategies if s.name == forced]
+  for strategy in strategies:
+    if not strategy.available(sample, target):
+      continue
+    start = time.monotonic()
+    try:
+      with span("copy", "copy", strategy=strategy.name):
+        saved = strategy.materialize(sample, target)
+    except (OSError, subprocess.CalledProcessError) as e:
+      logger.warning(f"Materialize {target} by {strategy.name} failed: {e}")
+      shutil.rmtree(target, ignore_errors=True)
+      continue
+    elapsed = time.monotonic() - start
+    files, total = tree_size(target, skip_git=True)
+    report = MaterializeReport(strategy.name, files, total, saved, elapsed)
+    logger.info(f"Materialize {sample} to {target} by {report}")
+    return report
+  raise BuildError(f"No strategy could materialize {sample} to {target}")
@@ -0,0 +1,294 @@
+"""check the patch series against the library versions without building
+
+for every (library, version, series) a throwaway worktree of the version is
+made from a repo which has it: the shell's local repo (<workspace>/extra/x),
+the python sample (<workspace>/samples/<REPO_DIR>) or the git mirror. the
+patches are tried one by one the way `git am` of init applies them:
+
+  applied    git apply --check is clean, the patch is committed by git am
+  merged     only applies by the 3-way merge of git am, the patch should be refreshed
+  upstream   the reverse applies, the version has the change already
+  conflict   the 3-way merge leaves conflicts, the files are reported
+  failed     the patch does not apply and can not be merged, e.g. a missing file
+
+a patch which does not apply is skipped and the next ones are still tried, so
+one run reports the whole series. the series run concurrently in a process
+pool, the worktrees are removed afterwards.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+
+from base import mirror_path, patch_series
+
+logger = logging.getLogger('build')
+
+STATUSES = ["applied", "merged", "upstream", "conflict", "failed"]
+# the git am of init stops at all of them
+BROKEN = ["merged", "upstream", "conflict", "failed"]
+# a committer for git am in the worktrees, the user may have none configured
+GIT_IDENTITY = ["-c", "user.name=mr-check-patches", "-c", "user.email=check-patches@localhost"]
+
+_EXPORT_RE = re.compile(r"^\s*export\s+([A-Z0-9_]+)=(\S*)")
+
+
+@dataclass
+class SeriesTarget(object):
+  library: str
+  # the configs/libs/<config>.sh it comes from
+  config: str
+  commit: str
+  # the directory name of the series in patches/
+  series: str
+  patch_dir: str
+  upstream: str = ""
+  # git repos which may have the commit, the first one which has it is used
+  repos: list = field(default_factory=list)
+
+
+@dataclass
+class PatchStatus(object):
+  name: str
+  status: str
+  # conflicted files or the error of git
+  detail: str = ""
+
+
+@dataclass
+class SeriesResult(object):
+  target: SeriesTarget
+  patches: list = field(default_factory=list)
+  # the series could not be checked at all, e.g. no repo has the commit
+  error: str = ""
+  elapsed: float = 0
+
+  @property
+  def ok(self) -> bool:
+    return not self.error and all(p.status not in BROKEN for p in self.patches)
+
+  def count(self, status: str) -> int:
+    return len([p for p in self.patches if p.status == status])
+
+
+def read_lib_config(path: str, env: dict = None) -> dict:
+  """the exports of a configs/libs/*.sh, "$VAR" values are taken from env like the shell does,
+  otherwise the literal default of the else branch wins
+  """
+  env = os.environ if env is None else env
+  res = {}
+  with open(path) as f:
+    for line in f:
+      match = _EXPORT_RE.match(line)
+      if not match:
+        continue
+      name, value = match.group(1), match.group(2).strip("'\"")
+      if value.startswith("$"):
+        value = env.get(value.strip("${}"), "")
+      if value and name not in res:
+        res[name] = value
+  return res
+
+
+def series_targets(shell_dir: str, workspace: str, libraries: list = None, commits: list = None,
+                   mirror_root: str = "", env: dict = None) -> list[SeriesTarget]:
+  """the series to check of the libraries, every library which has patches without libraries
+
+  each configs/libs/*.sh gives its PATCH_DIR (and PATCH_DIR_<platform> variants) at its GIT_COMMIT.
+  every series of a library, the ones of its configs and patches/<lib>[-*], is also checked at
+  each of commits, e.g. the next release before upgrading.
+
+  Args:
+      libraries (list): LIB_NAME (ffmpeg) or config names (ffmpeg7)
+  """
+  patches_root = os.path.join(shell_dir, "patches")
+  configs_dir = os.path.join(shell_dir, "configs", "libs")
+  all_series = sorted(d for d in os.listdir(patches_root) if os.path.isdir(os.path.join(patches_root, d)))
+  targets = {}
+  # library: (series, repos, upstream of the library)
+  series_of = {}
+  for entry in sorted(os.listdir(configs_dir)):
+    if not entry.endswith(".sh"):
+      continue
+    config = entry[:-len(".sh")]
+    exports = read_lib_config(os.path.join(configs_dir, entry), env)
+    library = exports.get("LIB_NAME", config)
+    if libraries and library not in libraries and config not in libraries:
+      continue
+    repos = []
+    if exports.get("GIT_LOCAL_REPO"):
+      repos.append(os.path.join(workspace, exports["GIT_LOCAL_REPO"]))
+      repos.append(os.path.join(shell_dir, "build", exports["GIT_LOCAL_REPO"]))
+    if exports.get("REPO_DIR"):
+      repos.append(os.path.join(workspace, "samples", exports["REPO_DIR"]))
+    if exports.get("GIT_UPSTREAM"):
+      repos.append(mirror_path(mirror_root, exports["GIT_UPSTREAM"]))
+    repos = [r for r in dict.fromkeys(repos) if r]
+    known = series_of.setdefault(library, ([], [], exports.get("GIT_UPSTREAM", "")))
+    known[1].extend(r for r in repos if r not in known[1])
+    patch_dir = exports.get("PATCH_DIR")
+    if not patch_dir:
+      continue
+    # patches/<PATCH_DIR>_<platform> replaces the series on that platform, see do-init/init-repo.sh
+    for series in [s for s in all_series if s == patch_dir or s.startswith(f"{patch_dir}_")]:
+      known[0].append(series)
+      if exports.get("GIT_COMMIT"):
+        targets.setdefault((series, exports["GIT_COMMIT"]), SeriesTarget(
+          library, config, exports["GIT_COMMIT"], series, os.path.join(patches_root, series),
+          exports.get("GIT_UPSTREAM", ""), repos))
+  for library, (series_list, repos, upstream) in series_of.items():
+    series_list.extend(s for s in all_series if s == library or s.startswith(f"{library}-"))
+    for series in dict.fromkeys(series_list):
+      for commit in commits or []:
+        targets.setdefault((series, commit), SeriesTarget(
+          library, "", commit, series, os.path.join(patches_root, series), upstream, repos))
+  return [t for t in targets.values() if patch_series(t.patch_dir)]
+
+
+def _git(args: list, cwd: str) -> subprocess.CompletedProcess:
+  return subprocess.run(["git", *GIT_IDENTITY, *args], cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                        text=True, errors="replace")
+
+
+def find_repo(repos: list, commit: str) -> str:
+  for repo in repos:
+    if os.path.isdir(repo) and _git(["rev-parse", "--verify", "--quiet", f"{commit}^{{commit}}"], repo).returncode == 0:
+      return repo
+  return ""
+
+
+def update_mirrors(targets: list[SeriesTarget], mirror_root: str):
+  """fetch the upstreams whose commits no local repo has into their mirrors, once per upstream
+  """
+  import git
+  from base import Repo
+  fetched = set()
+  for target in targets:
+    if not target.upstream or target.upstream in fetched or find_repo(target.repos, target.commit):
+      continue
+    fetched.add(target.upstream)
+    try:
+      Repo(target.upstream, mirror_path(mirror_root, target.upstream), mirror_root=mirror_root).update_mirror(target.commit)
+    except (OSError, git.GitCommandError) as e:
+      logger.warning(f"can't update the mirror of {target.upstream}: {e}")
+
+
+def _error_lines(output: str, limit: int = 3) -> str:
+  lines = [l.strip() for l in output.splitlines() if l.strip().startswith(("error:", "fatal:", "CONFLICT"))]
+  if not lines and output.strip():
+    lines = output.strip().splitlines()[-1:]
+  return "; ".join(lines[:limit])
+
+
+def check_patch(worktree: str, path: str) -> PatchStatus:
+  """try one patch on the worktree, it is committed when it applies
+  """
+  name = os.path.basename(path)
+  if _git(["apply", "--check", "--whitespace=fix", path], worktree).returncode == 0:
+    res = _git(["am", "--whitespace=fix", "--keep", path], worktree)
+    if res.returncode == 0:
+      return PatchStatus(name, "applied")
+    _git(["am", "--abort"], worktree)
+    return PatchStatus(name, "failed", _error_lines(res.stdout))
+  if _git(["apply", "--check", "--reverse", path], worktree).returncode == 0:
+    return PatchStatus(name, "upstream")
+  res = _git(["am", "--3way", "--whitespace=fix", "--keep", path], worktree)
+  if res.returncode == 0:
+    return PatchStatus(name, "merged")
+  conflicts = _git(["diff", "--name-only", "--diff-filter=U"], worktree).stdout.split()
+  _git(["am", "--abort"], worktree)
+  if conflicts:
+    return PatchStatus(name, "conflict", ", ".join(conflicts))
+  return PatchStatus(name, "failed", _error_lines(res.stdout))
+
+
+def check_series(target: SeriesTarget, work_root: str) -> SeriesResult:
+  """check the series of target in a worktree of its commit, runs in a worker process
+  """
+  start = time.perf_counter()
+  result = SeriesResult(target)
+  repo = find_repo(target.repos, target.commit)
+  if not repo:
+    result.error = f"{target.commit} is in none of {', '.join(target.repos) or 'the repos'}, run init first"
+    return result
+  os.makedirs(work_root, exist_ok=True)
+  worktree = tempfile.mkdtemp(prefix=f"{target.series}@{target.commit.replace('/', '_')}-", dir=work_root)
+  try:
+    res = _git(["worktree", "add", "--detach", "--force", worktree, f"{target.commit}^{{commit}}"], repo)
+    if res.returncode != 0:
+      result.error = f"can't make a worktree of {repo}: {_error_lines(res.stdout)}"
+      return result
+    for patch in patch_series(target.patch_dir):
+      result.patches.append(check_patch(worktree, patch["path"]))
+  finally:
+    if _git(["worktree", "remove", "--force", worktree], repo).returncode != 0:
+      shutil.rmtree(worktree, ignore_errors=True)
+      _git(["worktree", "prune"], repo)
+    result.elapsed = time.perf_counter() - start
+  return result
+
+
+def check_patches(targets: list[SeriesTarget], work_root: str, max_workers: int = 4) -> list[SeriesResult]:
+  """check every target in a process pool, the results are in the order of targets
+  """
+  if not targets:
+    return []
+  with ProcessPoolExecutor(max_workers=max(1, min(max_workers, len(targets)))) as pool:
+    futures = [pool.submit(check_series, t, work_root) for t in targets]
+    return [f.result() for f in futures]
+
+
+def format_matrix(results: list[SeriesResult]) -> str:
+  """one summary line per series and version, then per series the patches which are not
+  applied cleanly with their status at every version it was checked at
+  """
+  lines = [f"{'series':<24} {'commit':<16} " + " ".join(f"{s:>8}" for s in STATUSES) + "     time"]
+  for res in results:
+    t = res.target
+    if res.error:
+      lines.append(f"{t.series:<24} {t.commit:<16} {res.error}")
+    else:
+      lines.append(f"{t.series:<24} {t.commit:<16} " + " ".join(f"{res.count(s):>8}" for s in STATUSES)
+                   + f" {res.elapsed:7.1f}s")
+  by_series = {}
+  for res in results:
+    if not res.error:
+      by_series.setdefault(res.target.series, []).append(res)
+  for series, series_results in by_series.items():
+    commits = [r.target.commit for r in series_results]
+    statuses = {}
+    for res in series_results:
+      for patch in res.patches:
+        statuses.setdefault(patch.name, {})[res.target.commit] = patch
+    rows = [(name, cells) for name, cells in statuses.items() if any(p.status != "applied" for p in cells.values())]
+    if not rows:
+      continue
+    lines.append("")
+    lines.append(f"{series}: " + " | ".join(commits))
+    for name, cells in rows:
+      cell_text = " | ".join(cells[c].status if c in cells else "-" for c in commits)
+      details = "; ".join(f"{c}: {cells[c].detail}" for c in commits if c in cells and cells[c].detail)
+      lines.append(f"  {name:<64} {cell_text}" + (f"  ({details})" if details else ""))
+  return "\n".join(lines)
+
+
+def write_report(results: list[SeriesResult], path: str):
+  data = [{
+    "library": r.target.library,
+    "config": r.target.config,
+    "series": r.target.series,
+    "commit": r.target.commit,
+    "error": r.error,
+    "elapsed": round(r.elapsed, 3),
+    "patches": [vars(p) for p in r.patches],
+  } for r in results]
+  os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+  with open(f"{path}.tmp", "w") as f:
+    json.dump(data, f, indent=1)
+  os.replace(f"{path}.tmp", path)
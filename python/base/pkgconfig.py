@@ -0,0 +1,192 @@
+"""relocate the pkg-config files of installed prefixes
+
+the python side of do-install/correct-pc.sh: an installed library is moved
+around (prebuilt archives, cache restores, other workspaces), so the absolute
+paths in its `.pc` files point to where it was built. every file is parsed
+once and prefix, exec_prefix, libdir, includedir and the -L/-I flags are
+rewritten to the prefix the file lives in, <prefix>/lib/pkgconfig/x.pc. a
+file is only written when its content changes.
+
+the Requires chains between the installed files are checked afterwards, a
+missing package or a version which does not satisfy the constraint is
+reported.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+import logging
+import os
+import re
+
+logger = logging.getLogger('build')
+
+FLAG_FIELDS = ["Libs", "Libs.private", "Cflags", "Cflags.private"]
+REQUIRES_FIELDS = ["Requires", "Requires.private"]
+
+_LINE_RE = re.compile(r"^([A-Za-z0-9_.]+)(\s*[=:]\s*)(.*)$")
+_FLAG_RE = re.compile(r"(-[LI])(/\S*)")
+_REQUIRE_RE = re.compile(r"([^\s,<>=!]+)(?:\s*(<=|>=|!=|=|<|>)\s*([^\s,]+))?")
+
+
+@dataclass
+class PcFile(object):
+  path: str
+  # the lines as read, a parsed line is (key, separator with its spaces, value), others are kept as str
+  lines: list = field(default_factory=list)
+
+  @property
+  def name(self) -> str:
+    return os.path.splitext(os.path.basename(self.path))[0]
+
+  def get(self, key: str, sep: str = ":") -> str:
+    for line in self.lines:
+      if isinstance(line, tuple) and line[0] == key and line[1].strip() == sep:
+        return line[2]
+    return ""
+
+  def variables(self) -> dict:
+    return {line[0]: line[2] for line in self.lines if isinstance(line, tuple) and line[1].strip() == "="}
+
+  def requires(self) -> list[tuple[str, str, str]]:
+    """(package, operator, version) of Requires and Requires.private
+    """
+    res = []
+    for key in REQUIRES_FIELDS:
+      for match in _REQUIRE_RE.finditer(self.get(key)):
+        res.append((match.group(1), match.group(2) or "", match.group(3) or ""))
+    return res
+
+  def dumps(self) -> str:
+    return "".join(f"{line[0]}{line[1]}{line[2]}\n" if isinstance(line, tuple) else line for line in self.lines)
+
+
+def parse_pc(path: str, text: str) -> PcFile:
+  pc = PcFile(path)
+  for raw in text.splitlines(keepends=True):
+    match = _LINE_RE.match(raw.rstrip("\r\n"))
+    if match and not raw.lstrip().startswith("#"):
+      pc.lines.append(match.groups())
+    else:
+      pc.lines.append(raw if raw.endswith("\n") else raw + "\n")
+  return pc
+
+
+def relocate(pc: PcFile, prefix: str) -> PcFile:
+  """rewrite the paths of pc to prefix, the variables which refer to another one (${prefix}) are kept
+  """
+  lib_dir = os.path.join(prefix, "lib")
+  include_dir = os.path.join(prefix, "include")
+  targets = {"prefix": prefix, "exec_prefix": os.path.join(prefix, "bin"), "libdir": lib_dir, "includedir": include_dir}
+  old_prefix = pc.variables().get("prefix", "")
+
+  old_root = os.path.dirname(old_prefix.rstrip("/"))
+  new_root = os.path.dirname(prefix)
+
+  def move_flag(match) -> str:
+    flag, path = match.groups()
+    if old_prefix.startswith("/") and (path == old_prefix or path.startswith(old_prefix.rstrip("/") + "/")):
+      return flag + prefix + path[len(old_prefix.rstrip("/")):]
+    if old_root.startswith("/") and path.startswith(old_root + "/"):
+      # a library installed next to this one, e.g. universal/opus for universal/ffmpeg
+      sibling = path[len(old_root) + 1:].split("/")[0]
+      if os.path.isdir(os.path.join(new_root, sibling)):
+        return flag + new_root + path[len(old_root):]
+    if not old_prefix.startswith("/") and path.endswith("/lib" if flag == "-L" else "/include"):
+      # no usable prefix, what correct-pc.sh did
+      return flag + (lib_dir if flag == "-L" else include_dir)
+    # the sysroot or something outside of the installed libraries
+    return match.group(0)
+
+  lines = []
+  for line in pc.lines:
+    if isinstance(line, tuple):
+      key, sep, value = line
+      if sep.strip() == "=" and key in targets and not value.startswith("$"):
+        value = targets[key]
+      elif sep.strip() == ":" and key in FLAG_FIELDS:
+        value = _FLAG_RE.sub(move_flag, value)
+      line = (key, sep, value)
+    lines.append(line)
+  return PcFile(pc.path, lines)
+
+
+@dataclass
+class RelocateReport(object):
+  changed: list = field(default_factory=list)
+  unchanged: list = field(default_factory=list)
+  # (pc name, problem) of the Requires check
+  problems: list = field(default_factory=list)
+
+
+def find_pc_files(root: str) -> list[str]:
+  res = []
+  for dirpath, _, filenames in os.walk(root):
+    res.extend(os.path.join(dirpath, f) for f in filenames if f.endswith(".pc"))
+  return sorted(res)
+
+
+def relocate_file(path: str) -> tuple[PcFile, bool]:
+  """relocate one <prefix>/lib/pkgconfig/x.pc in place, returns the file and whether it was written
+  """
+  with open(path, encoding="utf-8", errors="surrogateescape") as f:
+    text = f.read()
+  pkgconfig_dir = os.path.dirname(os.path.abspath(path))
+  prefix = os.path.dirname(os.path.dirname(pkgconfig_dir))
+  pc = relocate(parse_pc(path, text), prefix)
+  new_text = pc.dumps()
+  if new_text == text:
+    return pc, False
+  tmp = f"{path}.tmp"
+  with open(tmp, "w", encoding="utf-8", errors="surrogateescape") as f:
+    f.write(new_text)
+  os.replace(tmp, path)
+  return pc, True
+
+
+def _version_key(version: str) -> list:
+  return [(0, int(p), "") if p.isdigit() else (1, 0, p) for p in re.split(r"[.\-_+~]", version) if p]
+
+
+def version_satisfies(version: str, op: str, wanted: str) -> bool:
+  a, b = _version_key(version), _version_key(wanted)
+  return {"=": a == b, "!=": a != b, "<": a < b, "<=": a <= b, ">": a > b, ">=": a >= b}.get(op, True)
+
+
+def check_requires(pcs: list[PcFile], external: set = None) -> list[tuple[str, str]]:
+  """the Requires which no installed file satisfies
+
+  Args:
+      external (set): packages which come from the system, e.g. zlib, they are not checked
+  """
+  installed = {}
+  for pc in pcs:
+    installed.setdefault(pc.name, []).append(pc.get("Version"))
+  external = external or set()
+  problems = []
+  for pc in pcs:
+    for name, op, wanted in pc.requires():
+      if name in external:
+        continue
+      versions = installed.get(name)
+      if not versions:
+        problems.append((pc.name, f"requires {name}, which is not installed"))
+      elif op and not any(version_satisfies(v, op, wanted) for v in versions):
+        problems.append((pc.name, f"requires {name} {op} {wanted}, installed is {', '.join(sorted(set(versions)))}"))
+  return sorted(set(problems))
+
+
+def relocate_tree(root: str, max_workers: int = 8, external: set = None) -> RelocateReport:
+  """relocate every .pc below root concurrently and check their Requires
+  """
+  report = RelocateReport()
+  paths = find_pc_files(root)
+  if not paths:
+    return report
+  with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(paths)))) as pool:
+    results = list(pool.map(relocate_file, paths))
+  for pc, changed in results:
+    (report.changed if changed else report.unchanged).append(pc.path)
+  # the libraries below root depend on each other, e.g. product/ios/universal/{ffmpeg7,opus}
+  report.problems = check_requires([pc for pc, _ in results], external)
+  for name, problem in report.problems:
+    logger.warning(f"{name}.pc {problem}")
+  return report
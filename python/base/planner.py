@@ -0,0 +1,307 @@
+"""plan a build without running it
+
+for every library and arch the planner tells what `--action build` would do:
+
+  skip     the installed prefix was built from the same source tree, patches,
+           configure flags and toolchain, the fingerprints of the build key
+  restore  the build cache has the key, the prefix is restored instead of compiled
+  build    something changed, the changed fingerprints are the reasons
+  init     there is no sample repo yet, `--action init` comes first
+
+every build leaves a stamp with its fingerprints in <arch workspace>/.mr-build
+and its duration in <workspace>/timings.json. the estimates are the median of
+the last durations of the same library, platform and arch, the libraries are
+ordered by them and the critical path of the dependency graph is the estimate
+of the whole build. libraries of the shell driver have no fingerprints, they
+are always built.
+"""
+from dataclasses import dataclass, field
+import json
+import logging
+import os
+import statistics
+import threading
+import time
+
+from base import BuildConfigure, ConfigureError, InitError, _lock_file, get_platform_envs
+
+logger = logging.getLogger('build')
+
+STAMP_DIR = ".mr-build"
+TIMINGS_FILE = "timings.json"
+# durations kept per library, platform, arch and kind
+MAX_SAMPLES = 10
+
+
+def stamp_path(cfg: BuildConfigure, library: str) -> str:
+  return os.path.join(cfg.get_arch_workspace(), STAMP_DIR, f"{library}.json")
+
+
+def read_stamp(cfg: BuildConfigure, library: str) -> dict:
+  try:
+    with open(stamp_path(cfg, library)) as f:
+      return json.load(f)
+  except (OSError, ValueError):
+    return {}
+
+
+def write_stamp(cfg: BuildConfigure, library: str, key: str, fingerprints: dict):
+  path = stamp_path(cfg, library)
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with open(f"{path}.tmp", "w") as f:
+    json.dump({"key": key, "fingerprints": fingerprints, "time": time.time()}, f, indent=1)
+  os.replace(f"{path}.tmp", path)
+
+
+def remove_stamp(cfg: BuildConfigure, library: str):
+  """the prefix is about to be rewritten, a failed build must not look up to date
+  """
+  try:
+    os.remove(stamp_path(cfg, library))
+  except FileNotFoundError:
+    pass
+
+
+def source_commit_path(cfg: BuildConfigure, library: str) -> str:
+  return os.path.join(cfg.get_arch_workspace(), STAMP_DIR, f"{library}.source")
+
+
+def read_source_commit(cfg: BuildConfigure, library: str) -> str:
+  """the commit of the sample the arch source tree was made from, empty if unknown
+  """
+  try:
+    with open(source_commit_path(cfg, library)) as f:
+      return f.read().strip()
+  except OSError:
+    return ""
+
+
+def write_source_commit(cfg: BuildConfigure, library: str, commit: str):
+  path = source_commit_path(cfg, library)
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with open(f"{path}.tmp", "w") as f:
+    f.write(commit)
+  os.replace(f"{path}.tmp", path)
+
+
+def installed_files_path(cfg: BuildConfigure, library: str) -> str:
+  return os.path.join(cfg.get_arch_workspace(), STAMP_DIR, f"{library}.files.json")
+
+
+def read_installed_files(cfg: BuildConfigure, library: str) -> list[str]:
+  """the files library installed into the shared arch prefix, relative to it
+  """
+  try:
+    with open(installed_files_path(cfg, library)) as f:
+      return json.load(f)
+  except (OSError, ValueError):
+    return []
+
+
+def write_installed_files(cfg: BuildConfigure, library: str, files: list):
+  path = installed_files_path(cfg, library)
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with open(f"{path}.tmp", "w") as f:
+    json.dump(sorted(set(files)), f, indent=1)
+  os.replace(f"{path}.tmp", path)
+
+
+def snapshot_prefix(prefix: str) -> dict:
+  """relative path: (size, mtime, inode) of every file in the prefix
+  """
+  res = {}
+  for dirpath, _, filenames in os.walk(prefix):
+    for name in filenames:
+      path = os.path.join(dirpath, name)
+      try:
+        st = os.lstat(path)
+      except FileNotFoundError:
+        continue
+      res[os.path.relpath(path, prefix)] = (st.st_size, st.st_mtime_ns, st.st_ino)
+  return res
+
+
+def record_installed_files(cfg: BuildConfigure, library: str, before: dict) -> list[str]:
+  """the files the install of library wrote since the snapshot `before`, plus the files of its
+  former installs which are still there, e.g. ones make install left unchanged
+  """
+  after = snapshot_prefix(cfg.get_arch_install_prefix())
+  files = {rel for rel, st in after.items() if before.get(rel) != st}
+  files.update(rel for rel in read_installed_files(cfg, library) if rel in after)
+  write_installed_files(cfg, library, files)
+  return sorted(files)
+
+
+def changed_parts(stamp: dict, fingerprints: dict) -> list[str]:
+  """why the installed prefix is out of date, empty if it is not
+  """
+  if not stamp:
+    return ["never built"]
+  old = stamp.get("fingerprints", {})
+  return [f"{part} changed" for part in fingerprints if old.get(part) != fingerprints[part]]
+
+
+def is_up_to_date(cfg: BuildConfigure, library: str, key: str) -> bool:
+  return bool(key) and read_stamp(cfg, library).get("key") == key and os.path.isdir(cfg.get_arch_install_prefix())
+
+
+class Timings(object):
+  def __init__(self, path: str):
+    """durations of the past builds
+
+    Args:
+        path (str): the json file, shared by the processes building in the workspace
+    """
+    self.path = path
+    self.__lock = threading.Lock()
+
+  def _load(self) -> dict:
+    try:
+      with open(self.path) as f:
+        return json.load(f)
+    except (OSError, ValueError):
+      return {}
+
+  @staticmethod
+  def _key(library: str, platform: str, arch: str, kind: str) -> str:
+    return f"{library}/{platform}/{arch}/{kind}"
+
+  def record(self, library: str, platform: str, arch: str, seconds: float, kind: str = "build"):
+    os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+    with self.__lock, _lock_file(f"{self.path}.lock"):
+      data = self._load()
+      samples = data.setdefault(self._key(library, platform, arch, kind), [])
+      samples.append(round(seconds, 3))
+      del samples[:-MAX_SAMPLES]
+      with open(f"{self.path}.tmp", "w") as f:
+        json.dump(data, f, indent=1)
+      os.replace(f"{self.path}.tmp", self.path)
+
+  def estimate(self, library: str, platform: str, arch: str, kind: str = "build") -> float:
+    """median of the past durations, of the other archs of the platform if this arch has none, None if nothing is known
+    """
+    data = self._load()
+    samples = data.get(self._key(library, platform, arch, kind))
+    if not samples:
+      prefix = self._key(library, platform, "", "").rstrip("/")
+      samples = [s for k, v in data.items() if k.startswith(prefix + "/") and k.endswith(f"/{kind}") for s in v]
+    return statistics.median(samples) if samples else None
+
+
+@dataclass
+class PlanItem(object):
+  library: str
+  arch: str
+  action: str
+  reasons: list = field(default_factory=list)
+  # seconds, None if there is no history
+  estimate: float = None
+  key: str = ""
+
+
+@dataclass
+class Plan(object):
+  platform: str
+  arch: str
+  items: list = field(default_factory=list)
+  critical_path: list = field(default_factory=list)
+  estimate: float = 0
+
+  @property
+  def up_to_date(self) -> bool:
+    return all(item.action == "skip" for item in self.items)
+
+  def library_estimate(self, library: str) -> float:
+    """the archs of a library are built at the same time, the slowest one counts
+    """
+    return max((i.estimate or 0 for i in self.items if i.library == library and i.action != "skip"), default=0)
+
+  def to_dict(self) -> dict:
+    libraries = list(dict.fromkeys(i.library for i in self.items))
+    return {
+      "platform": self.platform,
+      "arch": self.arch,
+      "up_to_date": self.up_to_date,
+      "estimate": round(self.estimate, 1),
+      "critical_path": self.critical_path,
+      # the longest first, how CI should start them
+      "order": sorted(libraries, key=lambda lib: -self.library_estimate(lib)),
+      "items": [vars(i) for i in self.items],
+    }
+
+
+def plan_arch(cfg: BuildConfigure, name: str, module_cls, cache=None, timings: Timings = None) -> PlanItem:
+  """what the build of the python module of library `name` on one arch would do
+  """
+  item = PlanItem(name, cfg.arch, "unknown")
+  try:
+    toolchain, host = get_platform_envs(cfg)
+    module = module_cls(cfg, toolchain, host)
+    if not os.path.isdir(module.get_sample_dir()):
+      item.action = "init"
+      item.reasons = [f"no sample repo in {module.get_sample_dir()}"]
+      return item
+    fingerprints = module.get_build_fingerprints()
+    item.key = module.get_build_key()
+  except (ConfigureError, InitError, OSError) as e:
+    item.reasons = [str(e)]
+    return item
+  if is_up_to_date(cfg, name, item.key):
+    item.action = "skip"
+    return item
+  item.reasons = changed_parts(read_stamp(cfg, name), fingerprints)
+  if not os.path.isdir(cfg.get_arch_install_prefix()):
+    item.reasons.append("not installed")
+  item.action = "restore" if cache and cache.contains(item.key) else "build"
+  if timings:
+    item.estimate = timings.estimate(name, cfg.platform, cfg.arch, item.action)
+  return item
+
+
+def make_plan(cfg: BuildConfigure, libraries: list, modules: dict, cache=None, timings: Timings = None) -> Plan:
+  """the plan of building libraries on the archs of cfg
+
+  Args:
+      modules (dict): library: ModuleSpec of the python modules, the others are built by the shell
+  """
+  from base.graph import build_library_graph
+  from base.scheduler import expand_archs
+  plan = Plan(cfg.platform, cfg.arch)
+  for lib in libraries:
+    if lib in modules:
+      module_cls = modules[lib].load()
+      plan.items.extend(plan_arch(arch_cfg, lib, module_cls, cache, timings) for arch_cfg in expand_archs(cfg))
+    else:
+      estimate = timings.estimate(lib, cfg.platform, cfg.arch) if timings else None
+      plan.items.append(PlanItem(lib, cfg.arch, "build", ["built by the shell driver"], estimate))
+  depends = {lib: modules[lib].get_depends() for lib in libraries if lib in modules}
+  graph = build_library_graph(libraries, {lib: None for lib in libraries}, depends)
+  for lib in libraries:
+    graph.nodes[lib].cost = plan.library_estimate(lib)
+  plan.critical_path, plan.estimate = graph.critical_path()
+  return plan
+
+
+def _duration(seconds: float) -> str:
+  if seconds is None:
+    return "?"
+  return f"{int(seconds // 60)}m{int(seconds % 60):02d}s" if seconds >= 60 else f"{seconds:.0f}s"
+
+
+def format_plan(plan: Plan) -> str:
+  lines = [f"{'library':<16} {'arch':<18} {'action':<8} {'estimate':>9}  reasons"]
+  for item in plan.items:
+    lines.append(f"{item.library:<16} {item.arch:<18} {item.action:<8} {_duration(item.estimate) if item.action != 'skip' else '-':>9}"
+                 f"  {', '.join(item.reasons)}")
+  if plan.up_to_date:
+    lines.append("everything is up to date")
+  else:
+    lines.append(f"estimated {_duration(plan.estimate)}, critical path: {' -> '.join(plan.critical_path)}")
+  return "\n".join(lines)
+
+
+def write_plan(plan: Plan, path: str):
+  os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+  with open(f"{path}.tmp", "w") as f:
+    json.dump(plan.to_dict(), f, indent=1)
+  os.replace(f"{path}.tmp", path)
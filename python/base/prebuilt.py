@@ -0,0 +1,432 @@
+"""parallel, resumable install of the prebuilt libraries
+
+the python side of do-install: the archives named by the PRE_COMPILE_TAG_*
+entries of configs/libs/*.sh are downloaded concurrently over a pool of
+keep-alive connections. a partial download is resumed with an http range
+request, the sha256 is computed while the bytes arrive and checked against
+`<url>.sha256` when the server has one. every archive is extracted as soon as
+it is complete, while the others are still downloading, and only the members
+the arch needs are written, then the .pc files are relocated, see pkgconfig.
+an archive which is extracted and unchanged is skipped without touching the
+network.
+
+zip keeps its directory at the end of the file, so extraction overlaps with
+the downloads of the other archives instead of starting on a partial file.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+import hashlib
+import http.client
+import json
+import logging
+import os
+import queue
+import re
+import shutil
+import threading
+import time
+import urllib.parse
+import zipfile
+
+from base import BuildError, InstallError
+
+logger = logging.getLogger('build')
+
+DEFAULT_BASE_URL = "https://github.com/debugly/MRFFToolChainBuildShell/releases/download/"
+CHUNK_SIZE = 256 * 1024
+MAX_REDIRECTS = 5
+# the per-arch directories a universal archive may contain
+KNOWN_ARCHS = ["arm64", "armv7a", "x86", "x86_64", "arm64-v8a", "armeabi-v7a", "arm64-simulator", "x86_64-simulator"]
+MARKER_DIR = ".mr-prebuilt"
+
+
+@dataclass
+class PrebuiltArchive(object):
+  url: str
+  # where the archive is kept, <workspace>/pre/<tag>/<name>.zip
+  path: str
+  dest_dir: str
+  # expected sha256, empty means `<url>.sha256` or nothing
+  sha256: str = ""
+  # archs to extract, empty extracts every member
+  archs: list = field(default_factory=list)
+
+
+@dataclass
+class InstallResult(object):
+  archive: PrebuiltArchive
+  skipped: bool = False
+  downloaded_bytes: int = 0
+  resumed_from: int = 0
+  extracted: int = 0
+  # installed from the artifact store
+  restored: bool = False
+  elapsed: float = 0
+  error: str = ""
+
+  @property
+  def ok(self):
+    return not self.error
+
+
+def parse_pre_compile_tag(tag: str) -> tuple[str, str]:
+  """(lib name, version) of a tag like opus-1.3.1-231124151836, as do-install/main.sh does
+  """
+  parts = tag.split("-")
+  if len(parts) < 3:
+    raise InstallError(f"Bad prebuilt tag {tag}")
+  return parts[0], "-".join(parts[1:-1])
+
+
+def read_pre_compile_tag(config_path: str, platform: str) -> str:
+  """the PRE_COMPILE_TAG_<PLATFORM> of a configs/libs/*.sh, empty if there is none
+  """
+  try:
+    with open(config_path) as f:
+      text = f.read()
+  except OSError:
+    raise InstallError(f"{config_path} does not exist")
+  match = re.search(rf"^\s*export\s+PRE_COMPILE_TAG_{platform.upper()}=['\"]?([^'\"\s]+)", text, re.M)
+  return match.group(1) if match else ""
+
+
+def member_archs(platform: str, arch: str) -> list[str]:
+  """directory names of arch in an archive, empty for all archs
+  """
+  if arch in ("", "all"):
+    return []
+  if platform == "android":
+    from base.toolchain import ANDROID_ARCHS
+    if arch in ANDROID_ARCHS:
+      return [arch, ANDROID_ARCHS[arch][2]]
+  return [arch]
+
+
+def prebuilt_archives(config_path: str, platform: str, workspace: str, arch: str = "all",
+                      base_url: str = "") -> list[PrebuiltArchive]:
+  """the archives of one library, ios and tvos have a simulator archive too, see install-pre-lib.sh
+
+  a simulator arch only needs the simulator archive, a device arch the other one.
+  """
+  tag = read_pre_compile_tag(config_path, platform)
+  if not tag:
+    raise InstallError(f"PRE_COMPILE_TAG_{platform.upper()} can't be nil in {config_path}")
+  lib_name, ver = parse_pre_compile_tag(tag)
+  base_url = base_url or os.environ.get("MR_DOWNLOAD_BASEURL") or DEFAULT_BASE_URL
+  joins = ["", "-simulator"] if platform in ("ios", "tvos") else [""]
+  if len(joins) > 1 and arch not in ("", "all"):
+    joins = ["-simulator"] if arch.endswith("-simulator") else [""]
+  res = []
+  for join in joins:
+    oname = f"{tag}/{lib_name}-{platform}-universal{join}-{ver}.zip"
+    res.append(PrebuiltArchive(url=f"{base_url}{oname}",
+                               path=os.path.join(workspace, "pre", oname),
+                               dest_dir=os.path.join(workspace, "product", platform, f"universal{join}"),
+                               archs=member_archs(platform, arch)))
+  return res
+
+
+def wanted_member(name: str, archs: list) -> bool:
+  """members below a directory of another arch are not extracted
+  """
+  if not archs:
+    return True
+  parts = name.split("/")
+  others = [a for a in KNOWN_ARCHS if a not in archs]
+  return not any(p in others for p in parts[:-1])
+
+
+class ConnectionPool(object):
+  """keep-alive connections per host, shared by the download threads
+  """
+  def __init__(self, timeout: float = 60):
+    self.timeout = timeout
+    self.__idle = {}
+    self.__lock = threading.Lock()
+
+  def _new(self, scheme: str, netloc: str):
+    cls = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+    return cls(netloc, timeout=self.timeout)
+
+  def get(self, scheme: str, netloc: str):
+    with self.__lock:
+      idle = self.__idle.setdefault((scheme, netloc), queue.SimpleQueue())
+    try:
+      return idle.get_nowait()
+    except queue.Empty:
+      return self._new(scheme, netloc)
+
+  def put(self, scheme: str, netloc: str, conn):
+    with self.__lock:
+      self.__idle.setdefault((scheme, netloc), queue.SimpleQueue()).put(conn)
+
+  def request(self, url: str, headers: dict = None):
+    """GET url following redirects, returns (pool key, connection, response)
+
+    the caller reads the response and gives the connection back by `release`
+    """
+    for _ in range(MAX_REDIRECTS + 1):
+      parts = urllib.parse.urlsplit(url)
+      path = parts.path + (f"?{parts.query}" if parts.query else "")
+      conn = self.get(parts.scheme, parts.netloc)
+      try:
+        conn.request("GET", path, headers=headers or {})
+        resp = conn.getresponse()
+      except (http.client.HTTPException, OSError):
+        # a kept connection may have been closed by the server, retry on a new one
+        conn.close()
+        conn = self._new(parts.scheme, parts.netloc)
+        conn.request("GET", path, headers=headers or {})
+        resp = conn.getresponse()
+      if resp.status in (301, 302, 303, 307, 308):
+        location = resp.getheader("Location")
+        resp.read()
+        self.release((parts.scheme, parts.netloc), conn, resp)
+        url = urllib.parse.urljoin(url, location)
+        continue
+      return (parts.scheme, parts.netloc), conn, resp
+    raise InstallError(f"Too many redirects for {url}")
+
+  def release(self, key, conn, resp):
+    if resp.will_close:
+      conn.close()
+    else:
+      self.put(*key, conn)
+
+  def close(self):
+    with self.__lock:
+      for idle in self.__idle.values():
+        while not idle.empty():
+          idle.get_nowait().close()
+      self.__idle.clear()
+
+
+def _sha256_file(path: str) -> str:
+  h = hashlib.sha256()
+  with open(path, "rb") as f:
+    for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+      h.update(chunk)
+  return h.hexdigest()
+
+
+class PrebuiltInstaller(object):
+  def __init__(self, max_workers: int = 8, retries: int = 3, retry_delay: float = 2, pool: ConnectionPool = None,
+               store=None):
+    """
+    Args:
+        max_workers (int): archives downloaded and extracted at the same time
+        retries (int): attempts per archive, each attempt resumes the partial file
+        retry_delay (float): seconds before the first retry, doubled for the next ones
+        store (ArtifactStore): keeps the extracted members instead of the archives, an archive
+            in the store is installed from it without downloading
+    """
+    self.max_workers = max(1, max_workers)
+    self.retries = max(1, retries)
+    self.retry_delay = retry_delay
+    self.pool = pool or ConnectionPool()
+    self.store = store
+
+  def expected_sha256(self, archive: PrebuiltArchive) -> str:
+    if archive.sha256:
+      return archive.sha256
+    key, conn, resp = self.pool.request(f"{archive.url}.sha256")
+    body = resp.read()
+    self.pool.release(key, conn, resp)
+    if resp.status != 200:
+      return ""
+    return body.decode(errors="replace").split()[0].lower() if body.strip() else ""
+
+  def download(self, archive: PrebuiltArchive, result: InstallResult) -> str:
+    """download archive.path, resuming a partial file, returns its sha256
+    """
+    part = f"{archive.path}.part"
+    os.makedirs(os.path.dirname(archive.path), exist_ok=True)
+    h = hashlib.sha256()
+    offset = 0
+    if os.path.exists(part):
+      # hash what is there already, the rest is hashed while it arrives
+      with open(part, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+          h.update(chunk)
+          offset += len(chunk)
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    key, conn, resp = self.pool.request(archive.url, headers)
+    try:
+      if resp.status == 416 and offset:
+        # the partial file is complete already or does not belong to this archive, start again
+        resp.read()
+        self.pool.release(key, conn, resp)
+        os.remove(part)
+        return self.download(archive, result)
+      if resp.status == 200 and offset:
+        # the server ignored the range
+        h, offset = hashlib.sha256(), 0
+      elif resp.status not in (200, 206):
+        resp.read()
+        raise InstallError(f"GET {archive.url} returned {resp.status}")
+      result.resumed_from = offset
+      with open(part, "ab" if offset else "wb") as f:
+        for chunk in iter(lambda: resp.read(CHUNK_SIZE), b""):
+          h.update(chunk)
+          f.write(chunk)
+          result.downloaded_bytes += len(chunk)
+      if resp.length:
+        # read() ends quietly when the server closes early
+        raise http.client.IncompleteRead(b"", resp.length)
+    except BaseException:
+      # the rest of the body is unread, the connection can't be reused
+      conn.close()
+      raise
+    self.pool.release(key, conn, resp)
+    os.replace(part, archive.path)
+    return h.hexdigest()
+
+  def marker_path(self, archive: PrebuiltArchive) -> str:
+    return os.path.join(archive.dest_dir, MARKER_DIR, f"{os.path.basename(archive.path)}.json")
+
+  def is_installed(self, archive: PrebuiltArchive) -> bool:
+    """the archive is unchanged and all its members are extracted with their sizes
+    """
+    try:
+      with open(self.marker_path(archive)) as f:
+        marker = json.load(f)
+    except (OSError, ValueError):
+      return False
+    if marker.get("url") != archive.url or sorted(marker.get("archs", [])) != sorted(archive.archs):
+      return False
+    if archive.sha256 and marker.get("sha256") != archive.sha256:
+      return False
+    for name, size in marker.get("members", {}).items():
+      try:
+        # the .pc files are relocated after the extraction
+        if os.path.getsize(os.path.join(archive.dest_dir, name)) != size and not name.endswith(".pc"):
+          return False
+      except OSError:
+        return False
+    return True
+
+  def extract(self, archive: PrebuiltArchive, sha256: str) -> int:
+    """extract the members the archs need, zipfile checks the crc of each member
+    """
+    dest = os.path.abspath(archive.dest_dir)
+    members = {}
+    try:
+      with zipfile.ZipFile(archive.path) as zf:
+        for info in zf.infolist():
+          if info.is_dir() or not wanted_member(info.filename, archive.archs):
+            continue
+          target = os.path.abspath(os.path.join(dest, info.filename))
+          if not target.startswith(dest + os.sep):
+            raise InstallError(f"{archive.path} has a member outside of the destination: {info.filename}")
+          os.makedirs(os.path.dirname(target), exist_ok=True)
+          tmp = f"{target}.mr-tmp"
+          with zf.open(info) as src, open(tmp, "wb") as dst:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+          mode = (info.external_attr >> 16) & 0o777
+          if mode:
+            os.chmod(tmp, mode)
+          os.replace(tmp, target)
+          members[info.filename] = info.file_size
+    except (zipfile.BadZipFile, zipfile.LargeZipFile) as e:
+      raise InstallError(f"{archive.path} is broken: {e}")
+    self.write_marker(archive, sha256, members)
+    return len(members)
+
+  def write_marker(self, archive: PrebuiltArchive, sha256: str, members: dict):
+    marker = self.marker_path(archive)
+    os.makedirs(os.path.dirname(marker), exist_ok=True)
+    with open(f"{marker}.tmp", "w") as f:
+      json.dump({"url": archive.url, "sha256": sha256, "archs": archive.archs, "members": members}, f)
+    os.replace(f"{marker}.tmp", marker)
+
+  @staticmethod
+  def store_key(archive: PrebuiltArchive) -> tuple[str, str]:
+    """name and build id of the archive in the artifact store, <name> and <tag>[-<archs>]
+    """
+    name = os.path.splitext(os.path.basename(archive.path))[0]
+    tag = os.path.basename(os.path.dirname(archive.path))
+    return name, "-".join([tag, *sorted(archive.archs)])
+
+  def restore(self, archive: PrebuiltArchive) -> int:
+    """install the archive from the store, 0 if the store does not have it
+    """
+    name, build_id = self.store_key(archive)
+    if not self.store.has(name, build_id):
+      return 0
+    meta = self.store.manifest(name, build_id)
+    if meta["meta"].get("url") != archive.url or (archive.sha256 and meta["meta"].get("sha256") != archive.sha256):
+      return 0
+    count = self.store.materialize(name, build_id, archive.dest_dir)
+    self.write_marker(archive, meta["meta"].get("sha256", ""), {e["path"]: e["size"] for e in meta["files"]})
+    return count
+
+  def keep_in_store(self, archive: PrebuiltArchive, sha256: str):
+    """the extracted members go to the store, the archive is not needed any more
+    """
+    with open(self.marker_path(archive)) as f:
+      members = json.load(f)["members"]
+    name, build_id = self.store_key(archive)
+    self.store.put(name, build_id, archive.dest_dir, list(members), {"url": archive.url, "sha256": sha256},
+                   group="-".join(sorted(archive.archs)))
+    os.remove(archive.path)
+
+  def install_one(self, archive: PrebuiltArchive) -> InstallResult:
+    result = InstallResult(archive)
+    start = time.monotonic()
+    try:
+      if self.is_installed(archive):
+        result.skipped = True
+        return result
+      if self.store and not os.path.exists(archive.path):
+        result.extracted = self.restore(archive)
+        if result.extracted:
+          result.restored = True
+          return result
+      expected = self.expected_sha256(archive)
+      for attempt in range(1, self.retries + 1):
+        try:
+          if os.path.exists(archive.path):
+            sha256 = _sha256_file(archive.path)
+          else:
+            sha256 = self.download(archive, result)
+          break
+        except (http.client.HTTPException, OSError) as e:
+          if attempt == self.retries:
+            raise InstallError(f"Download {archive.url} failed: {e}")
+          delay = self.retry_delay * 2 ** (attempt - 1)
+          logger.warning(f"Download {archive.url} failed: {e}, resume in {delay:.0f}s")
+          time.sleep(delay)
+      if expected and sha256 != expected:
+        os.remove(archive.path)
+        raise InstallError(f"Checksum of {archive.url} is {sha256}, expected {expected}")
+      result.extracted = self.extract(archive, sha256)
+      if self.store:
+        self.keep_in_store(archive, sha256)
+    except (InstallError, BuildError) as e:
+      result.error = str(e)
+    except (http.client.HTTPException, OSError) as e:
+      result.error = str(e)
+    finally:
+      result.elapsed = time.monotonic() - start
+    return result
+
+  def install(self, archives: list[PrebuiltArchive]) -> list[InstallResult]:
+    with ThreadPoolExecutor(max_workers=min(self.max_workers, max(1, len(archives)))) as pool:
+      results = list(pool.map(self.install_one, archives))
+    for res in results:
+      if res.skipped:
+        logger.info(f"{res.archive.url} is installed already, skip")
+      elif res.restored:
+        logger.info(f"{res.archive.url}: {res.extracted} files from the artifact store into {res.archive.dest_dir}")
+      elif res.ok:
+        resumed = f", resumed from {res.resumed_from}" if res.resumed_from else ""
+        logger.info(f"{res.archive.url}: {res.downloaded_bytes} bytes{resumed}, "
+                    f"{res.extracted} files into {res.archive.dest_dir} in {res.elapsed:.1f}s")
+      else:
+        logger.error(f"{res.archive.url}: {res.error}")
+    # the .pc files still point to the machine which built the archives
+    from base.pkgconfig import relocate_tree
+    for dest_dir in sorted({res.archive.dest_dir for res in results if res.ok and not res.skipped}):
+      report = relocate_tree(dest_dir, self.max_workers)
+      logger.info(f"{len(report.changed)} of {len(report.changed) + len(report.unchanged)} pc files relocated in {dest_dir}")
+    return results
@@ -0,0 +1,138 @@
+"""streaming subprocess runner
+
+output is forwarded line by line to a logger and a log file while the process
+runs, only the last lines are kept in memory for error reports. all commands
+run on one shared event loop, so concurrent builds on different threads do
+not need a thread per pipe.
+"""
+import asyncio
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+import logging
+import os
+import signal
+import threading
+
+# longest line the reader accepts, longer lines are split
+LINE_LIMIT = 1024 * 1024
+TAIL_LINES = 200
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+class ProcTimeout(Exception):
+  pass
+
+
+@dataclass
+class ProcResult(object):
+  returncode: int
+  tail: list = field(default_factory=list)
+  lines: int = 0
+
+  @property
+  def ok(self):
+    return self.returncode == 0
+
+  def tail_text(self):
+    return "\n".join(self.tail)
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+  """the event loop shared by all commands, it runs on a daemon thread
+  """
+  global _loop
+  with _loop_lock:
+    if _loop is None:
+      _loop = asyncio.new_event_loop()
+      threading.Thread(target=_loop.run_forever, name="proc-loop", daemon=True).start()
+  return _loop
+
+
+async def _pump(stream: asyncio.StreamReader, emit):
+  while True:
+    try:
+      line = await stream.readline()
+    except ValueError:
+      # the line is longer than LINE_LIMIT, take what is buffered
+      line = await stream.read(LINE_LIMIT)
+    if not line:
+      return
+    emit(line.decode(errors="replace").rstrip("\r\n"))
+
+
+async def run_async(command: list, cwd: str = None, env: dict = None, logger: logging.Logger = None,
+                    log_path: str = None, timeout: float = None, tail_lines: int = TAIL_LINES,
+                    pass_fds: tuple = (), sink=None) -> ProcResult:
+  """run command and stream its output
+
+  Args:
+      logger: stdout lines go to debug, stderr lines to info
+      log_path: every line is also appended to this file
+      timeout: seconds before the process is killed and ProcTimeout is raised
+      pass_fds: file descriptors the child inherits, e.g. the jobserver pipe
+      sink: called with "out" or "err" and every line, e.g. the write of a buildlog.Stream
+  """
+  logger = logger or logging.getLogger('build')
+  tail = deque(maxlen=tail_lines)
+  result = ProcResult(returncode=-1)
+  log_file = None
+  if log_path:
+    os.makedirs(os.path.dirname(os.path.abspath(log_path)), exist_ok=True)
+    log_file = open(log_path, "a", encoding="utf-8")
+
+  def emitter(level, name):
+    def emit(line):
+      result.lines += 1
+      tail.append(line)
+      logger.log(level, line)
+      if log_file:
+        log_file.write(line + "\n")
+      if sink:
+        sink(name, line)
+    return emit
+
+  # own process group, so killing it also stops the compilers make has spawned
+  proc = await asyncio.create_subprocess_exec(*command, cwd=cwd, env=env, limit=LINE_LIMIT, start_new_session=True, pass_fds=pass_fds,
+                                              stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+  pumps = asyncio.gather(_pump(proc.stdout, emitter(logging.DEBUG, "out")), _pump(proc.stderr, emitter(logging.INFO, "err")))
+  try:
+    await asyncio.wait_for(asyncio.shield(pumps), timeout)
+    result.returncode = await proc.wait()
+  except asyncio.TimeoutError:
+    await _kill(proc, pumps)
+    raise ProcTimeout(f"{' '.join(command)} timed out after {timeout}s")
+  except asyncio.CancelledError:
+    await _kill(proc, pumps)
+    raise
+  finally:
+    if log_file:
+      log_file.close()
+  result.tail = list(tail)
+  return result
+
+
+async def _kill(proc, pumps):
+  try:
+    os.killpg(proc.pid, signal.SIGKILL)
+  except ProcessLookupError:
+    pass
+  await proc.wait()
+  try:
+    await asyncio.wait_for(pumps, 5)
+  except (asyncio.TimeoutError, asyncio.CancelledError):
+    pass
+
+
+def start(command: list, **kwargs) -> Future:
+  """schedule command on the shared loop, cancel the future to kill it
+  """
+  return asyncio.run_coroutine_threadsafe(run_async(command, **kwargs), get_loop())
+
+
+def run(command: list, **kwargs) -> ProcResult:
+  """blocking helper for threads, see run_async for the arguments
+  """
+  return start(command, **kwargs).result()
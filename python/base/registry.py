@@ -0,0 +1,79 @@
+"""registry of the library modules
+
+every `module_<x>` package next to main.py is a module. the registry finds
+them and their FFModule subclass by reading the source, nothing is imported
+until an action needs the module, so `--help` and the no-op paths do not pay
+for the imports of every library.
+"""
+import ast
+import importlib
+import os
+import threading
+
+MODULE_PREFIX = "module_"
+
+
+class ModuleSpec(object):
+  def __init__(self, package: str, class_name: str, name: str):
+    """
+    Args:
+        package (str): the import name, e.g. module_ffmpeg
+        class_name (str): the FFModule subclass defined by the package
+        name (str): the library name of MODULE_CONFIG, the package suffix if it is not a literal
+    """
+    self.package = package
+    self.class_name = class_name
+    self.name = name
+    self.__cls = None
+    self.__lock = threading.Lock()
+
+  def load(self):
+    """import the package and return the module class
+    """
+    with self.__lock:
+      if self.__cls is None:
+        self.__cls = getattr(importlib.import_module(self.package), self.class_name)
+      return self.__cls
+
+  def get_module_config(self) -> dict:
+    return importlib.import_module(self.package).MODULE_CONFIG
+
+  def get_depends(self) -> list:
+    return self.get_module_config().get("depends", [])
+
+  def __repr__(self):
+    return f"ModuleSpec({self.name}, {self.package}.{self.class_name})"
+
+
+def _scan(init_path: str) -> tuple[str, str]:
+  """(class name, library name) from the source of a module package
+  """
+  with open(init_path, encoding="utf-8") as f:
+    tree = ast.parse(f.read(), init_path)
+  class_name = name = ""
+  for node in tree.body:
+    if isinstance(node, ast.ClassDef) and not class_name:
+      if any(isinstance(b, ast.Name) and b.id == "FFModule" for b in node.bases):
+        class_name = node.name
+    elif isinstance(node, ast.Assign) and any(isinstance(t, ast.Name) and t.id == "MODULE_CONFIG" for t in node.targets):
+      if isinstance(node.value, ast.Dict):
+        for key, value in zip(node.value.keys, node.value.values):
+          if isinstance(key, ast.Constant) and key.value == "name" and isinstance(value, ast.Constant):
+            name = value.value
+  return class_name, name
+
+
+def discover_modules(root: str) -> dict[str, ModuleSpec]:
+  """library name: spec of every module package in root
+  """
+  specs = {}
+  for entry in sorted(os.listdir(root)):
+    init_path = os.path.join(root, entry, "__init__.py")
+    if not entry.startswith(MODULE_PREFIX) or not os.path.isfile(init_path):
+      continue
+    class_name, name = _scan(init_path)
+    if not class_name:
+      continue
+    spec = ModuleSpec(entry, class_name, name or entry[len(MODULE_PREFIX):])
+    specs[spec.name] = spec
+  return specs
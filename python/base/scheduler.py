@@ -0,0 +1,170 @@
+"""multi-arch build scheduler
+
+expand `-a all` into one BuildConfigure per arch and build them at the same
+time, every arch gets its own toolchain, share of the cpu budget and log file.
+when every arch is built the universal outputs are assembled, see base.universal.
+an arch whose installed prefix has the same build key is skipped, see base.planner.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict, replace
+import logging
+import os
+import time
+import traceback
+
+from base import BuildConfigure, ConfigureError, get_platform_envs
+from base import planner, trace
+
+PLATFORM_ARCHS = {
+  "android": ["arm64", "armv7a", "x86", "x86_64"],
+  "apple": ["arm64", "arm64-simulator", "x86_64", "x86_64-simulator"],
+  "ios": ["arm64", "arm64-simulator", "x86_64-simulator"],
+  "tvos": ["arm64", "arm64-simulator", "x86_64-simulator"],
+  "macos": ["arm64", "x86_64"],
+}
+
+
+def expand_archs(cfg: BuildConfigure) -> list[BuildConfigure]:
+  """expand `all` into per-arch configures, a concrete arch is kept as is
+  """
+  if cfg.arch != "all":
+    return [cfg]
+  archs = PLATFORM_ARCHS.get(cfg.platform)
+  if not archs:
+    raise ConfigureError(f"Unknown platform {cfg.platform}")
+  return [replace(cfg, arch=arch) for arch in archs]
+
+
+def split_jobs(total: int, count: int) -> list[int]:
+  """split `total` make jobs over `count` builds, every build gets at least one
+  """
+  if count <= 0:
+    return []
+  base_jobs, extra = divmod(max(total, count), count)
+  return [base_jobs + (1 if i < extra else 0) for i in range(count)]
+
+
+@dataclass
+class ArchResult(object):
+  arch: str
+  ok: bool
+  elapsed: float
+  log_path: str
+  error: str = ""
+  compiler_cache: object = None
+
+
+def get_arch_logger(cfg: BuildConfigure) -> tuple[logging.Logger, str]:
+  """a child of the `build` logger which also writes to <arch workspace>/build.log
+  """
+  logger = logging.getLogger(f"build.{cfg.arch}")
+  log_path = os.path.join(cfg.get_arch_workspace(), "build.log")
+  os.makedirs(os.path.dirname(log_path), exist_ok=True)
+  if not any(getattr(h, "baseFilename", None) == os.path.abspath(log_path) for h in logger.handlers):
+    handler = logging.FileHandler(log_path)
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    logger.addHandler(handler)
+  return logger, log_path
+
+
+class MultiArchScheduler(object):
+  def __init__(self, cfg: BuildConfigure, module_cls, jobs: int = 0, cache=None, jobserver=None):
+    """_summary_
+
+    Args:
+        cfg (BuildConfigure): the configure, its arch may be `all`
+        module_cls: subclass of FFModule to build
+        jobs (int): global make jobs shared by all archs, 0 means all cores
+        cache (ArtifactCache): restore installed prefixes instead of compiling, optional
+        jobserver (JobServer): the global token pool, the jobs split is only used without it
+    """
+    self.cfg = cfg
+    self.module_cls = module_cls
+    self.cache = cache
+    self.jobserver = jobserver
+    self.jobs = jobs if jobs > 0 else cfg.get_jobs()
+    self.arch_cfgs = expand_archs(cfg)
+    self.timings = planner.Timings(os.path.join(cfg.workspace, planner.TIMINGS_FILE))
+    for arch_cfg, arch_jobs in zip(self.arch_cfgs, split_jobs(self.jobs, len(self.arch_cfgs))):
+      arch_cfg.jobs = arch_jobs
+
+  def build_arch(self, arch_cfg: BuildConfigure, trace_context: dict = None) -> ArchResult:
+    with trace.context(**(trace_context or {}), arch=arch_cfg.arch):
+      return self._build_arch(arch_cfg)
+
+  def _build_arch(self, arch_cfg: BuildConfigure) -> ArchResult:
+    logger, log_path = get_arch_logger(arch_cfg)
+    start = time.monotonic()
+    try:
+      toolchain, host = get_platform_envs(arch_cfg)
+      module = self.module_cls(arch_cfg, toolchain, host)
+      module.logger = logger
+      module.jobserver = self.jobserver
+      logger.info(f"Build {arch_cfg.arch} with {arch_cfg.jobs} jobs")
+      name = module.get_module_config()["name"]
+      fingerprints = module.get_build_fingerprints()
+      key = module.get_build_key()
+      if planner.is_up_to_date(arch_cfg, name, key):
+        logger.info(f"Build {arch_cfg.arch} is up to date, skip")
+        return ArchResult(arch_cfg.arch, True, time.monotonic() - start, log_path)
+      planner.remove_stamp(arch_cfg, name)
+      if self.cache:
+        with trace.span("cache-restore", "cache"):
+          restored = self.cache.restore(key, arch_cfg.get_arch_install_prefix(),
+                                        planner.read_installed_files(arch_cfg, name))
+        if restored is not None:
+          planner.write_installed_files(arch_cfg, name, restored)
+          # the entry may come from another workspace
+          from base.pkgconfig import relocate_tree
+          relocate_tree(arch_cfg.get_arch_install_prefix(), arch_cfg.jobs)
+          planner.write_stamp(arch_cfg, name, key, fingerprints)
+          self.timings.record(name, arch_cfg.platform, arch_cfg.arch, time.monotonic() - start, "restore")
+          logger.info(f"Build {arch_cfg.arch} restored from cache")
+          return ArchResult(arch_cfg.arch, True, time.monotonic() - start, log_path)
+      with trace.span("prebuild", "module"), trace.context(phase="prebuild"):
+        module.prebuild()
+      # the prefix is shared with other libraries, the files of this one are told by what the install wrote
+      before = planner.snapshot_prefix(arch_cfg.get_arch_install_prefix())
+      with trace.span("build", "module"), trace.context(phase="build"):
+        module.build(toolchain.to_env(), asdict(host))
+      files = planner.record_installed_files(arch_cfg, name, before)
+      with trace.span("postbuild", "module"), trace.context(phase="postbuild"):
+        module.postbuild()
+      if self.cache:
+        with trace.span("cache-save", "cache"):
+          self.cache.save(key, arch_cfg.get_arch_install_prefix(), files)
+      planner.write_stamp(arch_cfg, name, key, fingerprints)
+      self.timings.record(name, arch_cfg.platform, arch_cfg.arch, time.monotonic() - start)
+    except Exception as e:
+      logger.error(f"Build {arch_cfg.arch} failed: {e}\n{traceback.format_exc()}")
+      return ArchResult(arch_cfg.arch, False, time.monotonic() - start, log_path, str(e))
+    logger.info(f"Build {arch_cfg.arch} done")
+    return ArchResult(arch_cfg.arch, True, time.monotonic() - start, log_path,
+                      compiler_cache=module.compiler_cache_stats)
+
+  def run(self) -> list[ArchResult]:
+    """build all archs concurrently, a failed arch does not stop the others
+    """
+    with ThreadPoolExecutor(max_workers=len(self.arch_cfgs)) as pool:
+      ctx = trace.current()
+      results = list(pool.map(lambda c: self.build_arch(c, ctx), self.arch_cfgs))
+    if len(self.arch_cfgs) > 1 and all(r.ok for r in results):
+      results.append(self.assemble())
+    return results
+
+  def assemble(self) -> ArchResult:
+    """the universal outputs of the built archs, reported as the `universal` arch
+    """
+    cfg = replace(self.arch_cfgs[0], arch="universal", jobs=self.jobs)
+    logger, log_path = get_arch_logger(cfg)
+    start = time.monotonic()
+    try:
+      toolchain, host = get_platform_envs(self.arch_cfgs[0])
+      module = self.module_cls(cfg, toolchain, host)
+      module.logger = logger
+      with trace.span("assemble", "module"):
+        ok = module.assemble(self.arch_cfgs)
+    except Exception as e:
+      logger.error(f"Assemble failed: {e}\n{traceback.format_exc()}")
+      return ArchResult(cfg.arch, False, time.monotonic() - start, log_path, str(e))
+    return ArchResult(cfg.arch, ok, time.monotonic() - start, log_path, "" if ok else "assemble failed")
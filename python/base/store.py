@@ -0,0 +1,397 @@
+"""compressed, deduplicated store of installed prefixes
+
+every library x platform x arch prefix repeats the same headers and .pc
+templates, and the static libraries of two builds share most of their
+objects. the store keeps each file as a list of chunks named by their
+sha256, so a chunk is written once however many builds have it:
+
+  chunks/ab/<sha256>.z|.zst     a compressed chunk, zstd if the zstandard module
+                                is installed, zlib level 1 otherwise
+  index/ab/<sha256>.json        the chunks of a file, by the sha256 of the file
+  manifests/<name>/<id>.json    the files of one build with their modes
+  files/ab/<sha256>-<mode>      uncompressed files, hardlinked into prefixes
+
+a static library is chunked at its ar members, other files in fixed blocks.
+a build is materialized into a prefix by hardlinks to `files`, or by a
+streaming extract where hardlinks are not possible. the writers of a prefix
+(e.g. the .pc relocation) replace files, they never write through a link.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import stat
+import threading
+import time
+import zlib
+
+from base import BuildError
+
+logger = logging.getLogger('build')
+
+BLOCK_SIZE = 1 << 20
+# ar members larger than this are split into blocks
+MAX_CHUNK = 4 << 20
+AR_MAGIC = b"!<arch>\n"
+AR_HEADER = 60
+
+
+class StoreError(BuildError):
+  pass
+
+
+def _zstd():
+  try:
+    import zstandard
+  except ImportError:
+    return None
+  return zstandard
+
+
+def compress(data: bytes) -> tuple[bytes, str]:
+  """(compressed data, suffix of the codec)
+  """
+  zstd = _zstd()
+  if zstd:
+    return zstd.ZstdCompressor(level=3).compress(data), ".zst"
+  return zlib.compress(data, 1), ".z"
+
+
+def decompress(data: bytes, suffix: str) -> bytes:
+  if suffix == ".zst":
+    zstd = _zstd()
+    if not zstd:
+      raise StoreError("the chunk is zstd compressed, install zstandard to read it")
+    return zstd.ZstdDecompressor().decompress(data)
+  return zlib.decompress(data)
+
+
+def _blocks(f, size: int):
+  while size > 0:
+    data = f.read(min(BLOCK_SIZE, size))
+    if not data:
+      return
+    size -= len(data)
+    yield data
+
+
+def iter_chunks(path: str):
+  """the chunks of a file, the members of an ar archive or fixed blocks
+  """
+  file_size = os.path.getsize(path)
+  with open(path, "rb") as f:
+    if f.read(len(AR_MAGIC)) != AR_MAGIC:
+      f.seek(0)
+      yield from _blocks(f, file_size)
+      return
+    yield AR_MAGIC
+    while True:
+      header = f.read(AR_HEADER)
+      if not header:
+        return
+      try:
+        size = int(header[48:58].decode().strip())
+      except ValueError:
+        size = -1
+      if len(header) < AR_HEADER or header[58:60] != b"`\n" or size < 0:
+        # not an archive after all, the rest goes in blocks
+        yield header
+        yield from _blocks(f, file_size)
+        return
+      size += size % 2
+      if size + AR_HEADER <= MAX_CHUNK:
+        yield header + f.read(size)
+      else:
+        yield header
+        yield from _blocks(f, size)
+
+
+def sha256_file(path: str) -> str:
+  h = hashlib.sha256()
+  with open(path, "rb") as f:
+    for data in iter(lambda: f.read(BLOCK_SIZE), b""):
+      h.update(data)
+  return h.hexdigest()
+
+
+@dataclass
+class PutReport(object):
+  files: int = 0
+  # bytes of the files
+  total_bytes: int = 0
+  # bytes of the chunks which were not in the store, before and after the compression
+  new_bytes: int = 0
+  stored_bytes: int = 0
+  elapsed: float = 0
+
+  def __str__(self):
+    mb = 1024 * 1024
+    return (f"{self.files} files, {self.total_bytes / mb:.1f}MB, {self.new_bytes / mb:.1f}MB new, "
+            f"{self.stored_bytes / mb:.1f}MB written, {self.elapsed:.2f}s")
+
+
+@dataclass
+class GcReport(object):
+  manifests: list = field(default_factory=list)
+  chunks: int = 0
+  files: int = 0
+  freed_bytes: int = 0
+
+
+class ArtifactStore(object):
+  def __init__(self, root: str, max_workers: int = 8):
+    """
+    Args:
+        root (str): the store directory, it may be shared by workspaces on the same filesystem
+    """
+    self.root = os.path.abspath(root)
+    self.max_workers = max(1, max_workers)
+    self.__lock = threading.Lock()
+    # identical files of one prefix are extracted once and linked to the same inode
+    self.__file_locks = {}
+    os.makedirs(self.root, exist_ok=True)
+
+  def _lock(self, exclusive: bool):
+    """put takes a shared lock, gc an exclusive one so it never sweeps what a put is writing
+    """
+    f = open(os.path.join(self.root, ".lock"), "w")
+    fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+    return f
+
+  def _sharded(self, kind: str, name: str) -> str:
+    return os.path.join(self.root, kind, name[:2], name)
+
+  def manifest_path(self, name: str, build_id: str) -> str:
+    return os.path.join(self.root, "manifests", name, f"{build_id}.json")
+
+  def _find_chunk(self, digest: str) -> str:
+    for suffix in [".zst", ".z"]:
+      path = self._sharded("chunks", digest) + suffix
+      if os.path.exists(path):
+        return path
+    return ""
+
+  @staticmethod
+  def _write(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+      f.write(data)
+    os.replace(tmp, path)
+
+  def _put_file(self, path: str, report: PutReport) -> str:
+    digest = sha256_file(path)
+    index = self._sharded("index", digest) + ".json"
+    if os.path.exists(index):
+      return digest
+    chunks = []
+    new_bytes = stored_bytes = 0
+    for data in iter_chunks(path):
+      chunk = hashlib.sha256(data).hexdigest()
+      chunks.append(chunk)
+      if self._find_chunk(chunk):
+        continue
+      packed, suffix = compress(data)
+      self._write(self._sharded("chunks", chunk) + suffix, packed)
+      new_bytes += len(data)
+      stored_bytes += len(packed)
+    # the index is written last, it tells that every chunk is there
+    self._write(index, json.dumps(chunks).encode())
+    with self.__lock:
+      report.new_bytes += new_bytes
+      report.stored_bytes += stored_bytes
+    return digest
+
+  def put(self, name: str, build_id: str, prefix: str, files: list = None, meta: dict = None,
+          group: str = "") -> PutReport:
+    """store the files of prefix as build `build_id` of `name`, all of them without files
+
+    Args:
+        files (list): paths relative to prefix
+        meta (dict): kept in the manifest, e.g. the platform, arch and build key
+        group (str): the builds which replace each other, e.g. of one platform and arch, see gc
+    """
+    start = time.monotonic()
+    prefix = os.path.abspath(prefix)
+    report = PutReport()
+    if files is None:
+      files = []
+      for dirpath, _, filenames in os.walk(prefix):
+        files.extend(os.path.relpath(os.path.join(dirpath, f), prefix) for f in filenames)
+    regular = []
+    symlinks = {}
+    for rel in sorted(files):
+      path = os.path.join(prefix, rel)
+      if os.path.islink(path):
+        symlinks[rel] = os.readlink(path)
+      elif os.path.isfile(path):
+        regular.append(rel)
+    with self._lock(exclusive=False):
+      def put_one(rel: str) -> dict:
+        path = os.path.join(prefix, rel)
+        st = os.stat(path)
+        return {"path": rel, "sha256": self._put_file(path, report), "size": st.st_size,
+                "mode": stat.S_IMODE(st.st_mode)}
+      with ThreadPoolExecutor(max_workers=min(self.max_workers, max(1, len(regular)))) as pool:
+        entries = list(pool.map(put_one, regular))
+      manifest = {"name": name, "build_id": build_id, "group": group, "created": time.time(), "meta": meta or {},
+                  "files": entries, "symlinks": symlinks}
+      self._write(self.manifest_path(name, build_id), json.dumps(manifest, indent=1).encode())
+    report.files = len(entries)
+    report.total_bytes = sum(e["size"] for e in entries)
+    report.elapsed = time.monotonic() - start
+    logger.info(f"[store] {name}/{build_id}: {report}")
+    return report
+
+  def has(self, name: str, build_id: str) -> bool:
+    return os.path.exists(self.manifest_path(name, build_id))
+
+  def manifest(self, name: str, build_id: str) -> dict:
+    try:
+      with open(self.manifest_path(name, build_id)) as f:
+        return json.load(f)
+    except (OSError, ValueError):
+      raise StoreError(f"No build {build_id} of {name} in {self.root}")
+
+  def builds(self, name: str) -> list[dict]:
+    """name, build_id, group, created and meta of the stored builds of name, the oldest first
+    """
+    manifest_dir = os.path.join(self.root, "manifests", name)
+    res = []
+    if not os.path.isdir(manifest_dir):
+      return res
+    for entry in os.listdir(manifest_dir):
+      if entry.endswith(".json"):
+        data = self.manifest(name, entry[:-len(".json")])
+        res.append({k: data.get(k, "") for k in ["name", "build_id", "group", "created", "meta"]})
+    return sorted(res, key=lambda b: b["created"])
+
+  def read_file(self, digest: str, out):
+    """write the content of a stored file to out, chunk by chunk
+    """
+    try:
+      with open(self._sharded("index", digest) + ".json") as f:
+        chunks = json.load(f)
+    except (OSError, ValueError):
+      raise StoreError(f"The store has no file {digest}")
+    for chunk in chunks:
+      path = self._find_chunk(chunk)
+      if not path:
+        raise StoreError(f"Chunk {chunk} of file {digest} is missing")
+      with open(path, "rb") as f:
+        out.write(decompress(f.read(), os.path.splitext(path)[1]))
+
+  def _cached_file(self, digest: str, mode: int) -> str:
+    """the uncompressed file which the prefixes link to, made on first use
+    """
+    path = self._sharded("files", f"{digest}-{mode:o}")
+    with self.__lock:
+      file_lock = self.__file_locks.setdefault(path, threading.Lock())
+    with file_lock:
+      if os.path.exists(path):
+        return path
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      tmp = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+      with open(tmp, "wb") as f:
+        self.read_file(digest, f)
+      os.chmod(tmp, mode)
+      os.replace(tmp, path)
+    return path
+
+  def _extract(self, entry: dict, target: str):
+    tmp = f"{target}.mr-store"
+    with open(tmp, "wb") as f:
+      self.read_file(entry["sha256"], f)
+    os.chmod(tmp, entry["mode"])
+    os.replace(tmp, target)
+
+  def materialize(self, name: str, build_id: str, dest: str, hardlink: bool = True) -> int:
+    """create the files of a stored build in dest, returns the number of files
+
+    Args:
+        hardlink (bool): link to the uncompressed files of the store, the files are extracted
+            when the store is on another filesystem
+    """
+    manifest = self.manifest(name, build_id)
+    dest = os.path.abspath(dest)
+    if hardlink:
+      os.makedirs(dest, exist_ok=True)
+      hardlink = os.stat(dest).st_dev == os.stat(self.root).st_dev
+
+    def make_one(entry: dict):
+      target = os.path.join(dest, entry["path"])
+      if not os.path.abspath(target).startswith(dest + os.sep):
+        raise StoreError(f"{entry['path']} is outside of {dest}")
+      os.makedirs(os.path.dirname(target), exist_ok=True)
+      if not hardlink:
+        self._extract(entry, target)
+        return
+      source = self._cached_file(entry["sha256"], entry["mode"])
+      if os.path.exists(target) and os.path.samefile(source, target):
+        return
+      tmp = f"{target}.mr-store"
+      if os.path.lexists(tmp):
+        os.remove(tmp)
+      os.link(source, tmp)
+      os.replace(tmp, target)
+
+    with self._lock(exclusive=False), \
+         ThreadPoolExecutor(max_workers=min(self.max_workers, max(1, len(manifest["files"])))) as pool:
+      list(pool.map(make_one, manifest["files"]))
+    for rel, link in manifest.get("symlinks", {}).items():
+      target = os.path.join(dest, rel)
+      os.makedirs(os.path.dirname(target), exist_ok=True)
+      if os.path.lexists(target):
+        os.remove(target)
+      os.symlink(link, target)
+    logger.info(f"[store] {name}/{build_id} materialized into {dest} by {'hardlinks' if hardlink else 'extraction'}")
+    return len(manifest["files"])
+
+  def gc(self, keep: int) -> GcReport:
+    """keep the newest `keep` builds of every name and group and drop what no kept build refers to,
+    an uncompressed file which no prefix links to any more is dropped too
+    """
+    report = GcReport()
+    with self._lock(exclusive=True):
+      live_files = set()
+      manifests_dir = os.path.join(self.root, "manifests")
+      for name in sorted(os.listdir(manifests_dir)) if os.path.isdir(manifests_dir) else []:
+        groups = {}
+        for build in self.builds(name):
+          groups.setdefault(build["group"], []).append(build)
+        for builds in groups.values():
+          for build in builds[:max(0, len(builds) - keep)]:
+            os.remove(self.manifest_path(name, build["build_id"]))
+            report.manifests.append(f"{name}/{build['build_id']}")
+          for build in builds[max(0, len(builds) - keep):]:
+            live_files.update(e["sha256"] for e in self.manifest(name, build["build_id"])["files"])
+      live_chunks = set()
+      for digest in live_files:
+        with open(self._sharded("index", digest) + ".json") as f:
+          live_chunks.update(json.load(f))
+      for kind, alive in [("index", lambda n: n[:-len(".json")] in live_files),
+                          ("chunks", lambda n: os.path.splitext(n)[0] in live_chunks),
+                          ("files", lambda n: n.split("-")[0] in live_files)]:
+        for dirpath, _, filenames in os.walk(os.path.join(self.root, kind)):
+          for entry in filenames:
+            path = os.path.join(dirpath, entry)
+            st = os.stat(path)
+            # a file is also dropped when it is not linked from a prefix, it is made again on use
+            if alive(entry) and not (kind == "files" and st.st_nlink == 1):
+              continue
+            os.remove(path)
+            report.freed_bytes += st.st_size
+            report.chunks += kind == "chunks"
+            report.files += kind == "files"
+    logger.info(f"[store] gc dropped {len(report.manifests)} builds, {report.chunks} chunks and {report.files} files, "
+                f"{report.freed_bytes / 1024 / 1024:.1f}MB")
+    return report
+
+
+def open_store(root: str, max_workers: int = 8) -> ArtifactStore:
+  """None without a root, like create_cache
+  """
+  return ArtifactStore(root, max_workers) if root else None
@@ -0,0 +1,327 @@
+"""toolchain discovery with an on-disk probe cache
+
+probing an NDK or Xcode means resolving a dozen tool paths, checking they exist
+and running the compiler for its version. the result only changes when the
+toolchain is replaced, so it is stored as JSON keyed by the toolchain path and
+the mtimes of its version file and bin directory. repeated runs and the
+threads of one run share the probe instead of probing again.
+
+the cache lives in MR_TOOLCHAIN_CACHE_DIR, default ~/.cache/mr-ffbuild/toolchains
+"""
+from dataclasses import dataclass, field
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+
+from base import BuildConfigure, ConfigureError, HostVars, ToolchainVars, detect_host
+
+logger = logging.getLogger('build')
+
+# bump when the layout of the probe changes
+PROBE_VERSION = 1
+
+ANDROID_API_LEVEL = 21
+
+# arch: (triple without api level, FF_ARCH, ANDROID_ABI)
+ANDROID_ARCHS = {
+  "arm64": ("aarch64-linux-android", "aarch64", "arm64-v8a"),
+  "armv7a": ("armv7a-linux-androideabi", "arm", "armeabi-v7a"),
+  "x86": ("i686-linux-android", "i686", "x86"),
+  "x86_64": ("x86_64-linux-android", "x86_64", "x86_64"),
+}
+
+# platform: (device sdk, simulator sdk, device min version flag, simulator min version flag)
+APPLE_SDKS = {
+  "ios": ("iphoneos", "iphonesimulator", "-miphoneos-version-min=11.0", "-mios-simulator-version-min=11.0"),
+  "tvos": ("appletvos", "appletvsimulator", "-mtvos-version-min=12.0", "-mtvos-simulator-version-min=12.0"),
+  "macos": ("macosx", "macosx", "-mmacosx-version-min=10.11", "-mmacosx-version-min=10.11"),
+}
+# `apple` is the platform of the shell driver, its archs are those of ios
+APPLE_SDKS["apple"] = APPLE_SDKS["ios"]
+
+APPLE_TOOLS = ["clang", "clang++", "ar", "nm", "ranlib", "strip", "size", "strings", "lipo", "otool"]
+
+_probes = {}
+_probes_lock = threading.Lock()
+
+
+@dataclass
+class ToolchainProbe(object):
+  key: str
+  root: str
+  revision: str = ""
+  compiler_version: str = ""
+  # triple: api levels with a clang wrapper in the toolchain bin
+  triples: dict = field(default_factory=dict)
+  # triple: api levels of the sysroot libraries
+  api_levels: dict = field(default_factory=dict)
+  # arch or sdk: ToolchainVars fields except the env dependent ones
+  tools: dict = field(default_factory=dict)
+  version: int = PROBE_VERSION
+
+
+def get_cache_dir() -> str:
+  return os.environ.get("MR_TOOLCHAIN_CACHE_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "mr-ffbuild", "toolchains")
+
+
+def _mtime(path: str) -> int:
+  try:
+    return os.stat(path).st_mtime_ns
+  except OSError:
+    return 0
+
+
+def _read(path: str) -> str:
+  try:
+    with open(path) as f:
+      return f.read()
+  except OSError:
+    return ""
+
+
+def probe_key(kind: str, root: str, version_file: str, bin_dir: str) -> str:
+  """changes whenever the toolchain is moved, upgraded or its tools are replaced
+  """
+  h = hashlib.sha256()
+  for part in [kind, str(PROBE_VERSION), os.path.realpath(root), _read(version_file),
+               str(_mtime(version_file)), str(_mtime(bin_dir))]:
+    h.update(part.encode())
+    h.update(b"\0")
+  return h.hexdigest()
+
+
+def _load(key: str) -> ToolchainProbe:
+  data = _read(os.path.join(get_cache_dir(), f"{key}.json"))
+  if not data:
+    return None
+  try:
+    probe = ToolchainProbe(**json.loads(data))
+  except (ValueError, TypeError):
+    return None
+  return probe if probe.key == key and probe.version == PROBE_VERSION else None
+
+
+def _store(probe: ToolchainProbe):
+  cache_dir = get_cache_dir()
+  try:
+    os.makedirs(cache_dir, exist_ok=True)
+    # concurrent runs may probe at the same time, the last complete file wins
+    fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+      json.dump(probe.__dict__, f, indent=2)
+    os.replace(tmp, os.path.join(cache_dir, f"{probe.key}.json"))
+  except OSError as e:
+    logger.warning(f"Can not store the toolchain probe in {cache_dir}: {e}")
+
+
+def cached_probe(key: str, probe_func) -> ToolchainProbe:
+  """the probe of key from memory, disk or by calling probe_func, in this order
+  """
+  with _probes_lock:
+    probe = _probes.get(key)
+    if probe:
+      return probe
+    probe = _load(key)
+    if not probe:
+      probe = probe_func()
+      probe.key = key
+      _store(probe)
+    _probes[key] = probe
+    return probe
+
+
+def _compiler_version(cc: str) -> str:
+  try:
+    res = subprocess.run([cc, "--version"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, timeout=30)
+  except (OSError, subprocess.TimeoutExpired):
+    return ""
+  return res.stdout.splitlines()[0] if res.stdout else ""
+
+
+def _check_tools(tools: dict):
+  for name, path in tools.items():
+    if name in ToolchainVars.CHECKED_FIELDS and not os.path.exists(path):
+      raise ConfigureError(f"Tool {path} does not exist")
+
+
+def _to_vars(probe: ToolchainProbe, tools: dict, path: str, launcher: str, cflags: str = "") -> ToolchainVars:
+  # the tools were checked when probed
+  return ToolchainVars(**tools, path=path, launcher=launcher, cflags=cflags, cc_version=probe.compiler_version,
+                       validate=False)
+
+
+def _android_paths(ndk_home: str, host_tag: str) -> tuple[str, str]:
+  toolchain_root = os.path.join(ndk_home, "toolchains", "llvm", "prebuilt", host_tag)
+  return toolchain_root, os.path.join(toolchain_root, "bin")
+
+
+def probe_android(ndk_home: str, host_tag: str) -> ToolchainProbe:
+  toolchain_root, bin_dir = _android_paths(ndk_home, host_tag)
+  sysroot = os.path.join(toolchain_root, "sysroot")
+  probe = ToolchainProbe(key="", root=ndk_home)
+  match = re.search(r"Pkg\.Revision\s*=\s*(\S+)", _read(os.path.join(ndk_home, "source.properties")))
+  probe.revision = match.group(1) if match else ""
+  for name in sorted(os.listdir(bin_dir)):
+    match = re.match(r"(.+-linux-android(?:eabi)?)(\d+)-clang$", name)
+    if match:
+      probe.triples.setdefault(match.group(1), []).append(int(match.group(2)))
+  for levels in probe.triples.values():
+    levels.sort()
+  for triple, _, _ in ANDROID_ARCHS.values():
+    lib_dir = os.path.join(sysroot, "usr", "lib", triple)
+    if os.path.isdir(lib_dir):
+      probe.api_levels[triple] = sorted(int(d) for d in os.listdir(lib_dir) if d.isdigit())
+  for arch, (triple, _, _) in ANDROID_ARCHS.items():
+    if ANDROID_API_LEVEL not in probe.triples.get(triple, []):
+      continue
+    clang = os.path.join(bin_dir, f"{triple}{ANDROID_API_LEVEL}-clang")
+    tools = {
+      "triple_cc": clang,
+      "triple_cxx": f"{clang}++",
+      "cc": os.path.join(bin_dir, "clang"),
+      "cxx": os.path.join(bin_dir, "clang++"),
+      "as_tool": os.path.join(bin_dir, "llvm-as"),
+      "yasm": os.path.join(bin_dir, "yasm"),
+      "ar": os.path.join(bin_dir, "llvm-ar"),
+      "nm": os.path.join(bin_dir, "llvm-nm"),
+      "ranlib": os.path.join(bin_dir, "llvm-ranlib"),
+      "strip": os.path.join(bin_dir, "llvm-strip"),
+      "readelf": os.path.join(bin_dir, "llvm-readelf"),
+      "size": os.path.join(bin_dir, "llvm-size"),
+      "strings": os.path.join(bin_dir, "llvm-strings"),
+      "lipo": os.path.join(bin_dir, "llvm-lipo"),
+      "sysroot": sysroot,
+      "make": os.path.join(ndk_home, "prebuilt", host_tag, "bin", "make"),
+    }
+    _check_tools(tools)
+    probe.tools[arch] = tools
+  # every triple wrapper runs the same clang
+  probe.compiler_version = _compiler_version(os.path.join(bin_dir, "clang"))
+  logger.info(f"Probed NDK {probe.revision} in {ndk_home}: {', '.join(probe.tools) or 'no arch'}, {probe.compiler_version}")
+  return probe
+
+
+def android_toolchain(cfg: BuildConfigure, launcher: str = "") -> tuple[ToolchainVars, HostVars]:
+  ndk_home = os.environ.get("ANDROID_NDK_HOME", "")
+  if not ndk_home or not os.path.exists(ndk_home):
+    raise ConfigureError(f"ANDROID_NDK_HOME {ndk_home} does not exist!")
+  if cfg.arch not in ANDROID_ARCHS:
+    raise ConfigureError(f"Unknown arch {cfg.arch} for platform {cfg.platform}")
+  host = detect_host()
+  toolchain_root, bin_dir = _android_paths(ndk_home, host.host_tag)
+  if not os.path.isdir(bin_dir):
+    raise ConfigureError(f"No toolchain for {host.host_tag} in {ndk_home}")
+  key = probe_key("android", ndk_home, os.path.join(ndk_home, "source.properties"), bin_dir)
+  probe = cached_probe(key, lambda: probe_android(ndk_home, host.host_tag))
+  triple = ANDROID_ARCHS[cfg.arch][0]
+  tools = probe.tools.get(cfg.arch)
+  if not tools:
+    raise ConfigureError(f"NDK {probe.revision} in {ndk_home} has no {triple}{ANDROID_API_LEVEL}-clang, "
+                         f"api levels: {probe.triples.get(triple, [])}")
+  levels = probe.api_levels.get(triple)
+  if levels and ANDROID_API_LEVEL < levels[0]:
+    raise ConfigureError(f"NDK {probe.revision} does not support android api {ANDROID_API_LEVEL} for {triple}, "
+                         f"the lowest is {levels[0]}")
+  return _to_vars(probe, tools, f"{bin_dir}:{os.environ['PATH']}", launcher), host
+
+
+def _xcrun(sdk: str, *args) -> str:
+  try:
+    res = subprocess.run(["xcrun", "-sdk", sdk, *args], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, timeout=60)
+  except (OSError, subprocess.TimeoutExpired):
+    return ""
+  return res.stdout.strip() if res.returncode == 0 else ""
+
+
+def get_developer_dir() -> str:
+  developer_dir = os.environ.get("DEVELOPER_DIR")
+  if developer_dir:
+    return developer_dir
+  try:
+    return subprocess.run(["xcode-select", "-print-path"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                          text=True, timeout=30).stdout.strip()
+  except (OSError, subprocess.TimeoutExpired):
+    return ""
+
+
+def probe_apple(developer_dir: str, sdks: list) -> ToolchainProbe:
+  probe = ToolchainProbe(key="", root=developer_dir)
+  match = re.search(r"<key>CFBundleShortVersionString</key>\s*<string>([^<]+)</string>",
+                    _read(os.path.join(os.path.dirname(developer_dir), "version.plist")))
+  probe.revision = match.group(1) if match else ""
+  for sdk in sdks:
+    paths = {tool: _xcrun(sdk, "-f", tool) for tool in APPLE_TOOLS}
+    sysroot = _xcrun(sdk, "--show-sdk-path")
+    if not paths["clang"] or not sysroot:
+      logger.warning(f"xcrun has no clang or sdk path for {sdk}, skip it")
+      continue
+    # ffmpeg assembles x86 with nasm and arm with clang
+    asm = shutil.which("nasm") or shutil.which("yasm") or paths["clang"]
+    tools = {
+      "triple_cc": paths["clang"],
+      "triple_cxx": paths["clang++"],
+      "cc": paths["clang"],
+      "cxx": paths["clang++"],
+      "as_tool": paths["clang"],
+      "yasm": asm,
+      "ar": paths["ar"],
+      "nm": paths["nm"],
+      "ranlib": paths["ranlib"],
+      "strip": paths["strip"],
+      # no readelf for mach-o
+      "readelf": paths["otool"],
+      "size": paths["size"],
+      "strings": paths["strings"],
+      "lipo": paths["lipo"],
+      "sysroot": sysroot,
+      "make": shutil.which("make") or "make",
+    }
+    _check_tools(tools)
+    probe.tools[sdk] = tools
+    probe.compiler_version = probe.compiler_version or _compiler_version(paths["clang"])
+  logger.info(f"Probed Xcode {probe.revision} in {developer_dir}: {', '.join(probe.tools)}, {probe.compiler_version}")
+  return probe
+
+
+def apple_target(platform: str, arch: str) -> tuple[str, str]:
+  """the sdk and the target cflags of an apple arch, e.g. arm64-simulator of ios
+  """
+  if platform not in APPLE_SDKS:
+    raise ConfigureError(f"Unknown platform {platform}")
+  device_sdk, sim_sdk, device_min, sim_min = APPLE_SDKS[platform]
+  simulator = arch.endswith("-simulator") or arch.endswith("_simulator")
+  cpu = re.sub(r"[-_]simulator$", "", arch)
+  if cpu not in ["arm64", "x86_64"] or (platform == "macos" and simulator):
+    raise ConfigureError(f"Unknown arch {arch} for platform {platform}")
+  sdk, min_version = (sim_sdk, sim_min) if simulator else (device_sdk, device_min)
+  return sdk, f"-arch {cpu} {min_version} -D__APPLE__"
+
+
+def apple_toolchain(cfg: BuildConfigure, launcher: str = "") -> tuple[ToolchainVars, HostVars]:
+  sdk, cflags = apple_target(cfg.platform, cfg.arch)
+  developer_dir = get_developer_dir()
+  if not developer_dir or not os.path.isdir(developer_dir):
+    raise ConfigureError(f"Xcode developer dir {developer_dir} does not exist, run `sudo xcode-select -switch <xcode path>`")
+  if " " in developer_dir:
+    raise ConfigureError(f"Your Xcode path {developer_dir} contains whitespaces, which is not supported")
+  key = probe_key("apple", developer_dir, os.path.join(os.path.dirname(developer_dir), "version.plist"),
+                  os.path.join(developer_dir, "Toolchains"))
+  probe = cached_probe(key, lambda: probe_apple(developer_dir, sorted({s for p in APPLE_SDKS.values() for s in p[:2]})))
+  tools = probe.tools.get(sdk)
+  if not tools:
+    raise ConfigureError(f"Xcode {probe.revision} in {developer_dir} has no {sdk} sdk")
+  host = HostVars(arch=os.uname().machine, platform="darwin", host_tag="darwin-x86_64")
+  return _to_vars(probe, tools, os.environ["PATH"], launcher, cflags), host
+
+
+def clear_probes():
+  """forget the probes of this process, the disk cache is kept
+  """
+  with _probes_lock:
+    _probes.clear()
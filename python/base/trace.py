@@ -0,0 +1,209 @@
+"""build timing spans with chrome trace and json summary export
+
+spans nest and carry their library/arch from the enclosing `context`, also on
+the worker threads the context is carried over to. every span records wall time, cpu time of its thread, cpu time and peak rss of the
+child processes and bytes written. the child counters are process wide, so
+spans running at the same time on different threads see each other's children.
+
+open the chrome trace in chrome://tracing or https://ui.perfetto.dev
+"""
+from contextlib import contextmanager
+import json
+import os
+import resource
+import itertools
+import threading
+import time
+
+_local = threading.local()
+_ids = itertools.count(1)
+
+
+def _context() -> dict:
+  if not hasattr(_local, "stack"):
+    _local.stack = [{}]
+  return _local.stack[-1]
+
+
+def _write_bytes() -> int:
+  """bytes written by this process and its waited children
+  """
+  written = resource.getrusage(resource.RUSAGE_CHILDREN).ru_oublock * 512
+  try:
+    with open("/proc/self/io") as f:
+      for line in f:
+        if line.startswith("wchar:"):
+          written += int(line.split()[1])
+  except OSError:
+    pass
+  return written
+
+
+def _usage() -> dict:
+  children = resource.getrusage(resource.RUSAGE_CHILDREN)
+  return {
+    "thread_cpu": time.thread_time(),
+    "child_cpu": children.ru_utime + children.ru_stime,
+    "child_maxrss": children.ru_maxrss,
+    "write_bytes": _write_bytes(),
+  }
+
+
+class Tracer(object):
+  def __init__(self):
+    self.origin = time.perf_counter()
+    self.spans = []
+    self.__lock = threading.Lock()
+
+  @contextmanager
+  def span(self, name: str, cat: str = "build", **args):
+    parent = _context()
+    # `_span` is the enclosing span, it links the spans of worker threads too
+    args = {**{k: v for k, v in parent.items() if not k.startswith("_")}, **args}
+    span_id = next(_ids)
+    start, before = time.perf_counter(), _usage()
+    error = None
+    _local.stack.append({**parent, "_span": span_id})
+    try:
+      yield args
+    except BaseException as e:
+      error = repr(e)
+      raise
+    finally:
+      _local.stack.pop()
+      end, after = time.perf_counter(), _usage()
+      record = {
+        "name": name,
+        "cat": cat,
+        "ts": (start - self.origin) * 1e6,
+        "dur": (end - start) * 1e6,
+        "tid": threading.get_ident(),
+        "id": span_id,
+        "parent": parent.get("_span"),
+        "args": {
+          **args,
+          "thread_cpu_s": round(after["thread_cpu"] - before["thread_cpu"], 3),
+          "child_cpu_s": round(after["child_cpu"] - before["child_cpu"], 3),
+          # ru_maxrss is KB on linux and bytes on darwin
+          "child_peak_rss": after["child_maxrss"],
+          "write_bytes": after["write_bytes"] - before["write_bytes"],
+        },
+      }
+      if error:
+        record["args"]["error"] = error
+      with self.__lock:
+        self.spans.append(record)
+
+  def chrome_trace(self) -> dict:
+    pid = os.getpid()
+    with self.__lock:
+      spans = list(self.spans)
+    events = [{**{k: v for k, v in s.items() if k not in ("id", "parent")}, "ph": "X", "pid": pid} for s in spans]
+    threads = sorted({s["tid"] for s in spans})
+    events += [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": f"worker-{i}"}}
+               for i, tid in enumerate(threads)]
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+  def summary(self) -> dict:
+    """seconds per span name, per library and per arch, plus the wall time
+
+    spans nest (library > build > configure/make), so `total_s`, `child_cpu_s` and
+    `write_bytes` only add up the spans of a group which are not inside another span of
+    the same group. `self_s` is the time of a span minus the time covered by its child
+    spans, it adds up over all spans and compares the phases.
+    """
+    with self.__lock:
+      spans = list(self.spans)
+    by_id = {s["id"]: s for s in spans}
+    children = {}
+    for s in spans:
+      children.setdefault(s["parent"], []).append(s)
+
+    def self_time(s) -> float:
+      # children on worker threads run at the same time, count the time they cover once
+      covered, end = 0.0, s["ts"]
+      for c in sorted(children.get(s["id"], []), key=lambda c: c["ts"]):
+        c_start, c_end = max(c["ts"], end), min(c["ts"] + c["dur"], s["ts"] + s["dur"])
+        if c_end > c_start:
+          covered += c_end - c_start
+          end = c_end
+      return max(s["dur"] - covered, 0.0)
+
+    def nested(s, key, k) -> bool:
+      parent = by_id.get(s["parent"])
+      while parent is not None:
+        if key(parent) == k:
+          return True
+        parent = by_id.get(parent["parent"])
+      return False
+
+    def group(key):
+      res = {}
+      for s in spans:
+        k = key(s)
+        if k is None:
+          continue
+        item = res.setdefault(k, {"count": 0, "total_s": 0.0, "self_s": 0.0, "max_s": 0.0,
+                                  "child_cpu_s": 0.0, "write_bytes": 0})
+        secs = s["dur"] / 1e6
+        item["count"] += 1
+        item["self_s"] = round(item["self_s"] + self_time(s) / 1e6, 3)
+        item["max_s"] = round(max(item["max_s"], secs), 3)
+        if nested(s, key, k):
+          continue
+        item["total_s"] = round(item["total_s"] + secs, 3)
+        item["child_cpu_s"] = round(item["child_cpu_s"] + s["args"]["child_cpu_s"], 3)
+        item["write_bytes"] += s["args"]["write_bytes"]
+      return dict(sorted(res.items(), key=lambda kv: -kv[1]["total_s"]))
+
+    wall = max((s["ts"] + s["dur"] for s in spans), default=0) - min((s["ts"] for s in spans), default=0)
+    return {
+      "wall_s": round(wall / 1e6, 3),
+      "spans": len(spans),
+      "by_name": group(lambda s: f"{s['cat']}:{s['name']}"),
+      "by_library": group(lambda s: s["args"].get("library")),
+      "by_arch": group(lambda s: s["args"].get("arch")),
+    }
+
+  def export(self, path: str):
+    """write the chrome trace to path and the summary next to it
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+      json.dump(self.chrome_trace(), f)
+    with open(summary_path(path), "w") as f:
+      json.dump(self.summary(), f, indent=2)
+
+
+def summary_path(trace_path: str) -> str:
+  root, _ = os.path.splitext(trace_path)
+  return f"{root}.summary.json"
+
+
+_tracer = Tracer()
+
+
+def get_tracer() -> Tracer:
+  return _tracer
+
+
+def span(name: str, cat: str = "build", **args):
+  return _tracer.span(name, cat, **args)
+
+
+def current() -> dict:
+  """the context of this thread with the open span, to carry it over to worker threads
+  """
+  return dict(_context())
+
+
+@contextmanager
+def context(**args):
+  """library/arch of all spans opened in this block on this thread
+  """
+  parent = _context()
+  _local.stack.append({**parent, **args})
+  try:
+    yield
+  finally:
+    _local.stack.pop()
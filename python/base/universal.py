@@ -0,0 +1,267 @@
+"""assemble the per-arch install prefixes into multi-arch outputs
+
+the python side of do_lipo_all of do-compile/apple/any.sh, run once every arch
+of a platform is built:
+
+  apple    <prefix>/universal[-simulator]/<name>/lib/<lib>.a merged by lipo,
+           the device and simulator archs separately, headers and .pc copied
+  android  <prefix>/universal/<name>/jniLibs/<abi>/<lib>.so and
+           <prefix>/universal/<name>/<name>.aar with the shared libraries in
+           jni/<abi> and every library plus headers as prefab modules
+
+every output is one task of a thread pool, so the time follows the number of
+cores rather than the number of libraries. an output whose inputs have the
+same content as last time is skipped, the sha256 of the inputs is kept in
+<output dir>/.mr-assemble.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import zipfile
+
+from base import BuildError
+
+logger = logging.getLogger('build')
+
+MARKER_DIR = ".mr-assemble"
+APPLE_PLATFORMS = ["ios", "tvos", "macos", "apple"]
+AAR_MANIFEST = """<?xml version="1.0" encoding="utf-8"?>
+<manifest xmlns:android="http://schemas.android.com/apk/res/android" package="%(package)s">
+  <uses-sdk android:minSdkVersion="%(api)d" />
+</manifest>
+"""
+
+
+@dataclass
+class AssembleTask(object):
+  name: str
+  output: str
+  inputs: list
+  # runs the task, takes the task
+  func: object = None
+  skipped: bool = False
+  error: str = ""
+
+
+@dataclass
+class AssembleReport(object):
+  tasks: list = field(default_factory=list)
+
+  @property
+  def ok(self) -> bool:
+    return all(not t.error for t in self.tasks)
+
+  @property
+  def skipped(self) -> int:
+    return len([t for t in self.tasks if t.skipped])
+
+
+def _sha256(path: str) -> str:
+  h = hashlib.sha256()
+  with open(path, "rb") as f:
+    for chunk in iter(lambda: f.read(1 << 20), b""):
+      h.update(chunk)
+  return h.hexdigest()
+
+
+def inputs_digest(paths: list, extra: str = "") -> str:
+  h = hashlib.sha256(extra.encode())
+  for path in sorted(paths):
+    h.update(f"{path}\0{_sha256(path)}\0".encode())
+  return h.hexdigest()
+
+
+def _marker_path(output: str) -> str:
+  return os.path.join(os.path.dirname(output), MARKER_DIR, os.path.basename(output) + ".json")
+
+
+def _is_fresh(task: AssembleTask, digest: str) -> bool:
+  if not os.path.exists(task.output):
+    return False
+  try:
+    with open(_marker_path(task.output)) as f:
+      return json.load(f).get("inputs") == digest
+  except (OSError, ValueError):
+    return False
+
+
+def _run_task(task: AssembleTask) -> AssembleTask:
+  try:
+    digest = inputs_digest(task.inputs, task.name)
+    if _is_fresh(task, digest):
+      task.skipped = True
+      return task
+    os.makedirs(os.path.dirname(task.output), exist_ok=True)
+    task.func(task)
+    marker = _marker_path(task.output)
+    os.makedirs(os.path.dirname(marker), exist_ok=True)
+    with open(marker, "w") as f:
+      json.dump({"inputs": digest, "files": sorted(task.inputs)}, f)
+  except (OSError, subprocess.SubprocessError, BuildError) as e:
+    task.error = str(e)
+  return task
+
+
+def _lipo(lipo: str):
+  def run(task: AssembleTask):
+    tmp = f"{task.output}.tmp"
+    res = subprocess.run([lipo, "-create", *task.inputs, "-output", tmp],
+                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    if res.returncode != 0:
+      raise BuildError(f"lipo {task.output} failed: {res.stdout.strip()}")
+    os.replace(tmp, task.output)
+  return run
+
+
+def _copy(task: AssembleTask):
+  shutil.copy2(task.inputs[0], f"{task.output}.tmp")
+  os.replace(f"{task.output}.tmp", task.output)
+
+
+def _copy_tree(src: str, dst: str):
+  if os.path.isdir(src):
+    shutil.copytree(src, dst, dirs_exist_ok=True)
+
+
+def _files(root: str) -> list[str]:
+  res = []
+  for dirpath, _, filenames in os.walk(root):
+    res.extend(os.path.join(dirpath, f) for f in filenames)
+  return res
+
+
+def apple_tasks(name: str, libraries: list, arch_prefixes: dict, out_root: str, lipo: str) -> list[AssembleTask]:
+  """one lipo per library and device/simulator group, the archs are the keys of arch_prefixes
+  """
+  tasks = []
+  for suffix, archs in [("", [a for a in arch_prefixes if not a.endswith("-simulator")]),
+                        ("-simulator", [a for a in arch_prefixes if a.endswith("-simulator")])]:
+    for lib in libraries:
+      inputs = [os.path.join(arch_prefixes[a], "lib", f"{lib}.a") for a in archs]
+      inputs = [p for p in inputs if os.path.isfile(p)]
+      if inputs:
+        output = os.path.join(out_root, f"universal{suffix}", name, "lib", f"{lib}.a")
+        tasks.append(AssembleTask(f"lipo {lib}{suffix}", output, inputs, _lipo(lipo)))
+  return tasks
+
+
+def android_tasks(name: str, libraries: list, arch_prefixes: dict, out_root: str, api_level: int) -> list[AssembleTask]:
+  """the jniLibs copies of the shared libraries and one AAR of everything
+  """
+  from base.toolchain import ANDROID_ARCHS
+  uni_dir = os.path.join(out_root, "universal", name)
+  tasks = []
+  aar_inputs = []
+  for arch, prefix in arch_prefixes.items():
+    abi = ANDROID_ARCHS[arch][2] if arch in ANDROID_ARCHS else arch
+    for lib in libraries:
+      for ext in [".so", ".a"]:
+        path = os.path.join(prefix, "lib", f"{lib}{ext}")
+        if not os.path.isfile(path):
+          continue
+        aar_inputs.append(path)
+        if ext == ".so":
+          tasks.append(AssembleTask(f"jniLibs {abi}/{lib}", os.path.join(uni_dir, "jniLibs", abi, f"{lib}.so"),
+                                    [path], _copy))
+  # the headers are the same for all archs, take the first
+  include_dir = os.path.join(next(iter(arch_prefixes.values())), "include") if arch_prefixes else ""
+  aar_inputs.extend(_files(include_dir) if include_dir else [])
+  if aar_inputs:
+    tasks.append(AssembleTask(f"aar {name}", os.path.join(uni_dir, f"{name}.aar"), aar_inputs,
+                              _aar(name, libraries, arch_prefixes, include_dir, api_level)))
+  return tasks
+
+
+def _aar(name: str, libraries: list, arch_prefixes: dict, include_dir: str, api_level: int):
+  """an AAR with the shared libraries in jni/<abi> and prefab modules for the native build
+  """
+  def run(task: AssembleTask):
+    from base.toolchain import ANDROID_ARCHS
+    tmp = f"{task.output}.tmp"
+    with zipfile.ZipFile(tmp, "w", zipfile.ZIP_DEFLATED) as aar:
+      aar.writestr("AndroidManifest.xml", AAR_MANIFEST % {"package": f"com.mrffbuild.{name}", "api": api_level})
+      # an AAR must have a classes.jar, an empty one will do
+      aar.writestr("classes.jar", _empty_jar())
+      aar.writestr("prefab/prefab.json", json.dumps({"schema_version": 2, "name": name, "dependencies": []}))
+      for lib in libraries:
+        module_dir = f"prefab/modules/{lib[3:] if lib.startswith('lib') else lib}"
+        wrote = False
+        for arch, prefix in arch_prefixes.items():
+          _, _, abi = ANDROID_ARCHS.get(arch, ("", "", arch))
+          for ext in [".so", ".a"]:
+            path = os.path.join(prefix, "lib", f"{lib}{ext}")
+            if not os.path.isfile(path):
+              continue
+            if ext == ".so":
+              aar.write(path, f"jni/{abi}/{lib}.so")
+            aar.write(path, f"{module_dir}/libs/android.{abi}/{lib}{ext}")
+            aar.writestr(f"{module_dir}/libs/android.{abi}/abi.json", json.dumps(
+              {"abi": abi, "api": api_level, "ndk": 0, "stl": "none", "static": ext == ".a"}))
+            wrote = True
+            break
+        if wrote:
+          aar.writestr(f"{module_dir}/module.json", json.dumps({"export_libraries": [], "library_name": lib}))
+          for path in _files(include_dir):
+            aar.write(path, f"{module_dir}/include/{os.path.relpath(path, include_dir)}")
+    os.replace(tmp, task.output)
+  return run
+
+
+def _empty_jar() -> bytes:
+  import io
+  buf = io.BytesIO()
+  with zipfile.ZipFile(buf, "w") as jar:
+    jar.writestr("META-INF/MANIFEST.MF", "Manifest-Version: 1.0\n")
+  return buf.getvalue()
+
+
+def copy_headers(name: str, arch_prefixes: dict, out_root: str):
+  """include and pkgconfig of every group next to the universal libraries, the .pc files are relocated
+  """
+  from base.pkgconfig import relocate_tree
+  for arch, prefix in arch_prefixes.items():
+    group = "universal-simulator" if arch.endswith("-simulator") else "universal"
+    dest = os.path.join(out_root, group, name)
+    if not os.path.isdir(dest):
+      continue
+    _copy_tree(os.path.join(prefix, "include"), os.path.join(dest, "include"))
+    _copy_tree(os.path.join(prefix, "lib", "pkgconfig"), os.path.join(dest, "lib", "pkgconfig"))
+  for group in ["universal", "universal-simulator"]:
+    if os.path.isdir(os.path.join(out_root, group, name)):
+      relocate_tree(os.path.join(out_root, group, name))
+
+
+def assemble(platform: str, name: str, libraries: list, arch_prefixes: dict, out_root: str, lipo: str = "",
+             max_workers: int = 8, api_level: int = 21) -> AssembleReport:
+  """build the multi-arch outputs of one library set
+
+  Args:
+      arch_prefixes (dict): arch: its install prefix
+      out_root (str): the platform install prefix, the outputs go to its universal dirs
+      lipo (str): lipo or llvm-lipo, apple only
+  """
+  if platform in APPLE_PLATFORMS:
+    if not lipo:
+      raise BuildError("lipo is needed to assemble the apple libraries")
+    tasks = apple_tasks(name, libraries, arch_prefixes, out_root, lipo)
+  elif platform == "android":
+    tasks = android_tasks(name, libraries, arch_prefixes, out_root, api_level)
+  else:
+    raise BuildError(f"Can't assemble libraries of {platform}")
+  report = AssembleReport()
+  if not tasks:
+    return report
+  with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(tasks)))) as pool:
+    report.tasks = list(pool.map(_run_task, tasks))
+  if platform in APPLE_PLATFORMS and report.ok:
+    copy_headers(name, arch_prefixes, out_root)
+  for task in report.tasks:
+    if task.error:
+      logger.error(f"{task.name}: {task.error}")
+  logger.info(f"assembled {len(report.tasks) - report.skipped} outputs of {name}, {report.skipped} unchanged")
+  return report
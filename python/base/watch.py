@@ -0,0 +1,383 @@
+"""rebuild while the patches or the arch source trees are edited
+
+the patch directory of a module and the source tree of every arch are
+watched, by inotify on linux and by polling the mtimes elsewhere. the events
+are debounced, then:
+
+  a patch changed   the sample repo syncs its series incrementally, only the
+                    changed patch and the ones after it are applied again, see
+                    Repo.sync_patches. the files which differ between the old
+                    and the new sample are copied into every arch tree
+  a source changed  only the arch whose tree it is in is rebuilt, the tree
+                    no longer matches the sample so its build stamp is dropped
+                    until a sync of the series makes the edited files match
+                    the sample again, e.g. once the edit is turned into a patch
+
+the affected archs then run the incremental make of the module concurrently,
+configure is skipped by its cache as long as the flags and the files configure
+reads are the same, edits of the other sources only run make.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+import ctypes
+import ctypes.util
+import errno
+import filecmp
+import logging
+import os
+import select
+import shutil
+import struct
+import subprocess
+import sys
+import time
+
+from base import InitError, get_platform_envs
+
+logger = logging.getLogger('build')
+
+# the files of a source tree which are worth a rebuild
+SOURCE_SUFFIXES = (".c", ".h", ".S", ".asm", ".inc", ".m", ".cpp", ".cc", ".mak", ".v", ".pl", ".sh")
+SOURCE_NAMES = ("Makefile", "configure")
+SKIP_DIRS = (".git", "logs")
+
+# inotify(7)
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+_EVENT = struct.Struct("iIII")
+
+
+def is_source(path: str) -> bool:
+  name = os.path.basename(path)
+  return name in SOURCE_NAMES or name.endswith(SOURCE_SUFFIXES)
+
+
+class InotifyWatcher(object):
+  def __init__(self):
+    """recursive watches of directories, new directories are watched as they appear
+    """
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    self._add_watch = libc.inotify_add_watch
+    self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    # watch descriptor: directory
+    self.dirs = {}
+
+  def add(self, root: str):
+    for dirpath, dirnames, _ in os.walk(root):
+      dirnames[:] = [d for d in dirnames if d not in SKIP_DIRS]
+      wd = self._add_watch(self.fd, os.fsencode(dirpath), WATCH_MASK)
+      if wd < 0:
+        err = ctypes.get_errno()
+        if err == errno.ENOSPC:
+          raise OSError(err, "out of inotify watches, raise fs.inotify.max_user_watches")
+        continue
+      self.dirs[wd] = dirpath
+
+  def read(self, timeout: float) -> set:
+    """changed paths within timeout, None means the events overflowed and everything may have changed
+    """
+    if not select.select([self.fd], [], [], timeout)[0]:
+      return set()
+    try:
+      data = os.read(self.fd, 1 << 16)
+    except BlockingIOError:
+      return set()
+    res = set()
+    offset = 0
+    while offset < len(data):
+      wd, mask, _, length = _EVENT.unpack_from(data, offset)
+      name = data[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b"\0")
+      offset += _EVENT.size + length
+      if mask & IN_Q_OVERFLOW:
+        return None
+      if wd not in self.dirs:
+        continue
+      path = os.path.join(self.dirs[wd], os.fsdecode(name))
+      if mask & IN_ISDIR:
+        if mask & (IN_CREATE | IN_MOVED_TO) and os.path.basename(path) not in SKIP_DIRS:
+          self.add(path)
+        continue
+      res.add(path)
+    return res
+
+  def close(self):
+    os.close(self.fd)
+
+
+class PollingWatcher(object):
+  def __init__(self, interval: float = 1.0):
+    """compare the mtimes of the watched trees, where there is no inotify
+    """
+    self.interval = interval
+    self.roots = []
+    self.snapshot = {}
+
+  def _scan(self) -> dict:
+    res = {}
+    for root in self.roots:
+      for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if d not in SKIP_DIRS]
+        for name in filenames:
+          path = os.path.join(dirpath, name)
+          try:
+            st = os.stat(path)
+          except FileNotFoundError:
+            continue
+          res[path] = (st.st_mtime_ns, st.st_size)
+    return res
+
+  def add(self, root: str):
+    self.roots.append(root)
+    self.snapshot = self._scan()
+
+  def read(self, timeout: float) -> set:
+    time.sleep(min(timeout, self.interval))
+    current = self._scan()
+    changed = {p for p in set(current) | set(self.snapshot) if current.get(p) != self.snapshot.get(p)}
+    self.snapshot = current
+    return changed
+
+  def close(self):
+    pass
+
+
+def create_watcher():
+  if sys.platform.startswith("linux") and os.environ.get("MR_WATCH_POLL") != "1":
+    try:
+      return InotifyWatcher()
+    except (OSError, AttributeError) as e:
+      logger.warning(f"inotify is not available, poll instead: {e}")
+  return PollingWatcher()
+
+
+def changed_files(repo_dir: str, old: str, new: str) -> list[str]:
+  """paths which differ between two commits of repo_dir, relative to it
+  """
+  if old == new:
+    return []
+  res = subprocess.run(["git", "diff", "--name-only", "--no-renames", old, new], cwd=repo_dir,
+                       stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+  if res.returncode != 0:
+    raise InitError(f"Can't diff {old}..{new} in {repo_dir}: {res.stderr.strip()}")
+  return res.stdout.split()
+
+
+def _same_file(a: str, b: str) -> bool:
+  if not os.path.exists(a) or not os.path.exists(b):
+    return os.path.exists(a) == os.path.exists(b)
+  return filecmp.cmp(a, b, shallow=False)
+
+
+def _head(repo_dir: str) -> str:
+  return subprocess.run(["git", "rev-parse", "HEAD"], cwd=repo_dir, stdout=subprocess.PIPE,
+                        stderr=subprocess.DEVNULL, text=True).stdout.strip()
+
+
+@dataclass
+class ArchTarget(object):
+  cfg: object
+  module: object
+  source_dir: str
+  # edited by hand since the last sync, the tree is not the sample any more
+  diverged: bool = False
+  # the files edited by hand which differ from the sample
+  edited: set = field(default_factory=set)
+  # path: mtime_ns of the files copied by the watcher, their events are not edits
+  written: dict = field(default_factory=dict)
+
+
+class PatchWatcher(object):
+  def __init__(self, cfg, module_cls, repo_url: str, debounce: float = 0.5, jobserver=None):
+    """
+    Args:
+        cfg (BuildConfigure): the configure, its arch may be `all`
+        module_cls: subclass of FFModule, its patch dir and the arch source trees are watched
+        repo_url (str): the upstream of the sample, used when the series is synced
+        debounce (float): seconds without events before a rebuild starts
+    """
+    from base.scheduler import expand_archs, split_jobs
+    self.cfg = cfg
+    self.repo_url = repo_url
+    self.debounce = debounce
+    self.jobserver = jobserver
+    self.targets = []
+    arch_cfgs = expand_archs(cfg)
+    for arch_cfg, jobs in zip(arch_cfgs, split_jobs(cfg.get_jobs(), len(arch_cfgs))):
+      arch_cfg.jobs = jobs
+      # the edits of an arch tree are not part of the build key, keep them out of the artifact store
+      arch_cfg.artifact_store = ""
+      toolchain, host = get_platform_envs(arch_cfg)
+      module = module_cls(arch_cfg, toolchain, host)
+      module.jobserver = jobserver
+      source_dir = module.get_arch_source_dir()
+      if not os.path.isdir(source_dir):
+        logger.warning(f"{source_dir} does not exist, build {arch_cfg.arch} once before watching it")
+        continue
+      self.targets.append(ArchTarget(arch_cfg, module, source_dir))
+    if not self.targets:
+      raise InitError("No arch source tree to watch, build first")
+    self.module = self.targets[0].module
+    self.name = self.module.get_module_config()["name"]
+    self.patch_dir = self.module.get_module_patch_dir()
+    self.sample_dir = self.module.get_sample_dir()
+    self.private_files = set(self.module.get_module_config().get("private_files") or [])
+
+  def classify(self, paths: set) -> tuple[bool, list]:
+    """(whether the series changed, the arch targets whose sources were edited)
+    """
+    patches = False
+    archs = []
+    for path in paths:
+      if os.path.dirname(path) == os.path.abspath(self.patch_dir) and path.endswith(".patch"):
+        patches = True
+        continue
+      for target in self.targets:
+        root = os.path.abspath(target.source_dir)
+        if not path.startswith(root + os.sep) or not is_source(path):
+          continue
+        rel = os.path.relpath(path, root)
+        if rel in self.private_files:
+          break
+        try:
+          mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+          mtime = None
+        if target.written.pop(rel, "missing") == mtime:
+          # copied by sync_arch
+          break
+        target.edited.add(rel)
+        if target not in archs:
+          archs.append(target)
+        break
+    return patches, archs
+
+  def sync_series(self) -> list[str]:
+    """sync the sample with the series, returns the files which changed
+    """
+    old = _head(self.sample_dir)
+    start = time.monotonic()
+    self.module.init_sample_repo(self.repo_url, self.sample_dir)
+    files = changed_files(self.sample_dir, old, _head(self.sample_dir))
+    logger.info(f"[watch] series synced in {time.monotonic() - start:.1f}s, {len(files)} files changed")
+    return files
+
+  def sync_arch(self, target: ArchTarget, files: list):
+    """copy the changed files of the sample into the arch tree, a new inode so hardlinks to the sample break
+    """
+    for rel in files:
+      src = os.path.join(self.sample_dir, rel)
+      dst = os.path.join(target.source_dir, rel)
+      if os.path.isfile(src):
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        shutil.copyfile(src, f"{dst}.mr-watch")
+        shutil.copymode(src, f"{dst}.mr-watch")
+        os.replace(f"{dst}.mr-watch", dst)
+        target.written[rel] = os.stat(dst).st_mtime_ns
+      elif os.path.lexists(dst):
+        os.remove(dst)
+        target.written[rel] = None
+    # the synced files overwrote the edits of the same files, the others may match the sample now
+    target.edited = {rel for rel in target.edited - set(files)
+                     if not _same_file(os.path.join(self.sample_dir, rel), os.path.join(target.source_dir, rel))}
+    target.diverged = bool(target.edited)
+    # the tree follows the synced sample, the next build must not make it again
+    from base import planner
+    planner.write_source_commit(target.cfg, self.name, _head(self.sample_dir))
+
+  def rebuild(self, targets: list) -> bool:
+    """the incremental make of the targets, at the same time
+    """
+    from base import planner
+    from base.scheduler import get_arch_logger
+
+    def build_one(target: ArchTarget) -> bool:
+      arch_logger, log_path = get_arch_logger(target.cfg)
+      target.module.logger = arch_logger
+      start = time.monotonic()
+      try:
+        planner.remove_stamp(target.cfg, self.name)
+        before = planner.snapshot_prefix(target.cfg.get_arch_install_prefix())
+        target.module.build(target.module.toolchain.to_env(), asdict(target.module.host))
+        planner.record_installed_files(target.cfg, self.name, before)
+        target.module.postbuild()
+        if not target.diverged:
+          planner.write_stamp(target.cfg, self.name, target.module.get_build_key(),
+                              target.module.get_build_fingerprints())
+      except Exception as e:
+        logger.error(f"[watch] {target.cfg.arch} failed: {e}, log: {log_path}")
+        return False
+      logger.info(f"[watch] {target.cfg.arch} rebuilt in {time.monotonic() - start:.1f}s")
+      return True
+
+    with ThreadPoolExecutor(max_workers=len(targets)) as pool:
+      return all(pool.map(build_one, targets))
+
+  def handle(self, paths: set) -> bool:
+    """one debounced batch of changes, None paths means everything may have changed.
+    returns None if nothing of the batch needs a rebuild, e.g. the files the build wrote
+    """
+    if paths is None:
+      patches, archs = True, list(self.targets)
+    else:
+      patches, archs = self.classify(paths)
+    if not patches and not archs:
+      return None
+    for target in archs:
+      target.diverged = True
+    if patches:
+      try:
+        files = self.sync_series()
+      except InitError as e:
+        logger.error(f"[watch] {e}")
+        return False
+      for target in self.targets:
+        self.sync_arch(target, files)
+      if files:
+        archs = list(self.targets)
+    if not archs:
+      return None
+    logger.info(f"[watch] rebuild {', '.join(t.cfg.arch for t in archs)}")
+    return self.rebuild(archs)
+
+  def run(self, max_batches: int = 0):
+    """watch until interrupted, or until max_batches batches of changes are handled
+    """
+    watcher = create_watcher()
+    try:
+      watcher.add(os.path.abspath(self.patch_dir))
+      for target in self.targets:
+        watcher.add(os.path.abspath(target.source_dir))
+      logger.info(f"[watch] watching {self.patch_dir} and {len(self.targets)} arch trees by {type(watcher).__name__}")
+      batches = 0
+      while not max_batches or batches < max_batches:
+        paths = watcher.read(3600)
+        if paths is not None and not paths:
+          continue
+        first = time.monotonic()
+        # collect until the changes settle
+        while paths is not None:
+          more = watcher.read(self.debounce)
+          if more is None:
+            paths = None
+          elif not more:
+            break
+          else:
+            paths |= more
+        ok = self.handle(paths)
+        if ok is None:
+          continue
+        batches += 1
+        logger.info(f"[watch] {'done' if ok else 'failed'} {time.monotonic() - first:.1f}s after the first change")
+    except KeyboardInterrupt:
+      pass
+    finally:
+      watcher.close()
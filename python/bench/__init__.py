@@ -0,0 +1,2 @@
+"""benchmarks of the driver, run by `python -m bench`, see bench/__main__.py
+"""
@@ -0,0 +1,292 @@
+"""benchmarks of the python build driver on a fake toolchain
+
+  python -m bench --repeat 5 --output bench.json
+
+every benchmark runs on the fake NDK and fake FFmpeg repo of bench.fixtures,
+so the numbers are the overhead of the driver itself: no network, no compiler.
+the JSON result carries the commit of the tree to compare runs across commits.
+"""
+import argparse
+from contextlib import redirect_stdout
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import base
+import module_ffmpeg
+from base import proc
+from base.jobserver import create_jobserver
+from base.materialize import default_strategies, materialize
+from base.prebuilt import PrebuiltInstaller, prebuilt_archives
+from base.scheduler import MultiArchScheduler
+from bench import fixtures
+
+TAG = "n-bench"
+PREBUILT_TAG = "ffmpeg7-7.1.1-000000000000"
+
+
+class Fixture(object):
+  def __init__(self, root: str, args):
+    self.root = root
+    self.args = args
+    self.ndk = fixtures.make_fake_ndk(os.path.join(root, "ndk"))
+    self.origin = fixtures.make_fake_repo(os.path.join(root, "origin"), module_ffmpeg.CONFIGURE_OUTPUTS, TAG, args.files)
+    self.patch_root = os.path.join(root, "patches")
+    self.patch_dir = fixtures.make_patch_series(self.origin, TAG,
+                                                os.path.join(self.patch_root, module_ffmpeg.MODULE_CONFIG["patch_dir"]),
+                                                args.patches)
+    self.__count = 0
+
+  def new_dir(self, name: str) -> str:
+    self.__count += 1
+    return os.path.join(self.root, "runs", f"{name}-{self.__count}")
+
+  def workspace(self, arch: str = "arm64") -> base.BuildConfigure:
+    """a fresh workspace whose patches link to the fake series
+    """
+    run_dir = self.new_dir("ws")
+    cfg = base.BuildConfigure("android", arch, os.path.join(run_dir, "build"), os.path.join(run_dir, "install"),
+                              "build", self.args.jobs)
+    os.makedirs(cfg.get_samples_dir())
+    os.symlink(self.patch_root, cfg.get_patch_dir())
+    return cfg
+
+  def init_module(self, cfg: base.BuildConfigure) -> module_ffmpeg.FFMpegModule:
+    toolchain, host = base.get_platform_envs(base.BuildConfigure("android", "arm64", cfg.workspace, cfg.install_prefix, "init"))
+    module = module_ffmpeg.FFMpegModule(cfg, toolchain, host)
+    module.init_sample_repo(self.origin, os.path.join(cfg.get_samples_dir(), module.module_config["repo_save_dir"]))
+    return module
+
+
+def _elapsed(func) -> float:
+  start = time.perf_counter()
+  func()
+  return time.perf_counter() - start
+
+
+def bench_init(fx: Fixture) -> dict:
+  """clone and patch the sample from scratch, then again on the initialized sample
+  """
+  cfg = fx.workspace()
+  toolchain, host = base.get_platform_envs(cfg)
+  module = module_ffmpeg.FFMpegModule(cfg, toolchain, host)
+  sample = os.path.join(cfg.get_samples_dir(), module.module_config["repo_save_dir"])
+  cold = _elapsed(lambda: module.init_sample_repo(fx.origin, sample))
+  warm = _elapsed(lambda: module.init_sample_repo(fx.origin, sample))
+  return {"cold_s": cold, "warm_s": warm}
+
+
+def bench_patches(fx: Fixture) -> dict:
+  """the patch series on a fresh clone, a no-op sync and a sync after one patch changed
+  """
+  repo = base.Repo(fx.origin, fx.new_dir("patches"))
+  repo.init(TAG)
+  repo.ensure_commit(TAG)
+  apply = _elapsed(lambda: repo.apply_patches(fx.patch_dir, base=TAG))
+  noop = _elapsed(lambda: repo.apply_patches(fx.patch_dir, base=TAG))
+  last = sorted(os.listdir(fx.patch_dir))[-1]
+  edited_dir = fx.new_dir("patches-edited")
+  shutil.copytree(fx.patch_dir, edited_dir)
+  with open(os.path.join(edited_dir, last), "a") as f:
+    f.write("\n")
+  changed = _elapsed(lambda: repo.apply_patches(edited_dir, base=TAG))
+  return {"apply_s": apply, "noop_s": noop, "last_changed_s": changed, "patches": fx.args.patches}
+
+
+def bench_copy(fx: Fixture) -> dict:
+  """materialize the sample into an arch source tree by every available strategy
+  """
+  cfg = fx.workspace()
+  module = fx.init_module(cfg)
+  res = {}
+  for strategy in default_strategies(module.module_config["private_files"]):
+    target = fx.new_dir(f"copy-{strategy.name}")
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if not strategy.available(module.get_sample_dir(), target):
+      continue
+    report = materialize(module.get_sample_dir(), target, [strategy])
+    res[f"{strategy.name}_s"] = report.elapsed
+  return res
+
+
+def bench_log(fx: Fixture) -> dict:
+  """stream a noisy command through the runner into the logger and a log file
+  """
+  lines = fx.args.lines
+  log_dir = fx.new_dir("log")
+  command = ["sh", "-c", f"seq 1 {lines} | sed 's|^|CC libavcodec/file|; s|$|.o|'"]
+  rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  start = time.perf_counter()
+  res = proc.run(command, logger=logging.getLogger("build.bench"), log_path=os.path.join(log_dir, "make.log"))
+  elapsed = time.perf_counter() - start
+  if not res.ok or res.lines != lines:
+    raise RuntimeError(f"log benchmark got {res.lines} lines, return code {res.returncode}")
+  return {
+    "elapsed_s": elapsed,
+    "lines_per_s": lines / elapsed,
+    "rss_growth_kb": float(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before),
+  }
+
+
+def bench_multi_arch(fx: Fixture) -> dict:
+  """build every android arch of the initialized sample, configure and make included
+  """
+  cfg = fx.workspace("all")
+  fx.init_module(cfg)
+  jobserver = create_jobserver(cfg.get_jobs())
+  try:
+    scheduler = MultiArchScheduler(cfg, module_ffmpeg.FFMpegModule, cfg.jobs, None, jobserver)
+    start = time.perf_counter()
+    results = scheduler.run()
+    elapsed = time.perf_counter() - start
+  finally:
+    if jobserver:
+      jobserver.close()
+  failed = [f"{r.arch}: {r.error}" for r in results if not r.ok]
+  if failed:
+    raise RuntimeError(f"multi arch benchmark failed: {failed}")
+  # the archs run side by side, so the fake tools account for one configure and one make
+  tools = fx.args.configure_seconds + fx.args.make_seconds
+  archs = [r for r in results if r.arch != "universal"]
+  return {"elapsed_s": elapsed, "overhead_s": elapsed - tools, "archs": len(archs),
+          "slowest_arch_s": max(r.elapsed for r in archs),
+          "assemble_s": sum(r.elapsed for r in results if r.arch == "universal")}
+
+
+def bench_install(fx: Fixture) -> dict:
+  """install the prebuilt ios release from the local server: cold, after a dropped connection, and installed already
+  """
+  config = fixtures.make_prebuilt_release(os.path.join(fx.root, "prebuilt"), PREBUILT_TAG, "ios",
+                                          ["arm64", "arm64-simulator", "x86_64-simulator"], fx.args.prebuilt_files)
+  res = {}
+  with fixtures.PrebuiltServer(os.path.join(fx.root, "prebuilt", "release")) as server:
+    installer = PrebuiltInstaller(fx.args.jobs or 8, retry_delay=0)
+    for name, drop in [("cold", 0), ("resume", 1 << 20)]:
+      archives = prebuilt_archives(config, "ios", fx.new_dir("install"), "all", server.url)
+      server.drop_after = drop
+      start = time.perf_counter()
+      results = installer.install(archives)
+      res[f"{name}_s"] = time.perf_counter() - start
+      failed = [r.error for r in results if not r.ok]
+      if failed:
+        raise RuntimeError(f"install benchmark failed: {failed}")
+    start = time.perf_counter()
+    results = installer.install(archives)
+    res["installed_s"] = time.perf_counter() - start
+    if not all(r.skipped for r in results):
+      raise RuntimeError("install benchmark: the installed release was not skipped")
+    installer.pool.close()
+  res["archive_bytes"] = sum(os.path.getsize(a.path) for a in archives)
+  return res
+
+
+BENCHMARKS = {
+  "init": bench_init,
+  "patches": bench_patches,
+  "copy": bench_copy,
+  "log": bench_log,
+  "multi_arch": bench_multi_arch,
+  "install": bench_install,
+}
+
+
+def summarize(runs: list[dict]) -> dict:
+  res = {}
+  for key in runs[0]:
+    values = [run[key] for run in runs if key in run]
+    if all(isinstance(v, float) for v in values):
+      res[key] = {"min": min(values), "median": statistics.median(values), "max": max(values), "runs": values}
+    else:
+      res[key] = values[0]
+  return res
+
+
+def tree_commit() -> dict:
+  here = os.path.dirname(os.path.abspath(__file__))
+  def git(*args):
+    out = subprocess.run(["git", *args], cwd=here, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    return out.stdout.strip()
+  return {"commit": git("rev-parse", "HEAD"), "dirty": bool(git("status", "--porcelain", "--", ".."))}
+
+
+def parse_args():
+  parser = argparse.ArgumentParser(prog="python -m bench")
+  parser.add_argument('--only', type=str, default="", help=f'benchmarks to run, comma separated, from {",".join(BENCHMARKS)}')
+  parser.add_argument('--repeat', type=int, default=3, help='runs per benchmark')
+  parser.add_argument('--files', type=int, default=2000, help='source files of the fake repo')
+  parser.add_argument('--patches', type=int, default=20, help='patches of the fake series')
+  parser.add_argument('--prebuilt-files', type=int, default=50, help='files per arch of the fake prebuilt archives')
+  parser.add_argument('--lines', type=int, default=100000, help='output lines of the log benchmark')
+  parser.add_argument('--output-lines', type=int, default=2000, help='output lines of the fake configure and make')
+  parser.add_argument('--configure-seconds', type=float, default=0, help='latency of the fake configure')
+  parser.add_argument('--make-seconds', type=float, default=0, help='latency of the fake make')
+  parser.add_argument('-j', '--jobs', type=int, default=0, help='make jobs of the multi arch benchmark, 0 means all cores')
+  parser.add_argument('--work-dir', type=str, default="", help='where the fixtures are created, default is a temp dir')
+  parser.add_argument('--keep', action='store_true', help='keep the fixtures')
+  parser.add_argument('--output', type=str, default="", help='write the JSON result to this file instead of stdout')
+  return parser.parse_args()
+
+
+def main():
+  args = parse_args()
+  names = args.only.replace(",", " ").split() or list(BENCHMARKS)
+  unknown = [n for n in names if n not in BENCHMARKS]
+  if unknown:
+    sys.exit(f"unknown benchmarks {unknown}")
+  root = os.path.abspath(args.work_dir) if args.work_dir else tempfile.mkdtemp(prefix="mr-bench-")
+  os.makedirs(root, exist_ok=True)
+  # the driver logs every line of output, as main.py does, but only to a file
+  logger = logging.getLogger('build')
+  logger.setLevel(logging.DEBUG)
+  logger.propagate = False
+  logger.addHandler(logging.FileHandler(os.path.join(root, "bench.log")))
+  fixtures.git_identity_env()
+  os.environ.update({
+    "ANDROID_NDK_HOME": os.path.join(root, "ndk"),
+    "MR_TOOLCHAIN_CACHE_DIR": os.path.join(root, "toolchains"),
+    module_ffmpeg.MODULE_CONFIG["commit_env"]: TAG,
+    "FAKE_CONFIGURE_SECONDS": str(args.configure_seconds),
+    "FAKE_MAKE_SECONDS": str(args.make_seconds),
+    "FAKE_OUTPUT_LINES": str(args.output_lines),
+  })
+  result = {
+    **tree_commit(),
+    "python": platform.python_version(),
+    "platform": platform.platform(),
+    "cpus": os.cpu_count(),
+    "params": {k: v for k, v in vars(args).items() if k not in ("output", "work_dir", "keep", "only")},
+    "benchmarks": {},
+  }
+  try:
+    # Repo reports with print, stdout is kept for the JSON
+    with redirect_stdout(sys.stderr):
+      start = time.perf_counter()
+      fx = Fixture(root, args)
+      result["fixture_s"] = time.perf_counter() - start
+      for name in names:
+        runs = [BENCHMARKS[name](fx) for _ in range(args.repeat)]
+        result["benchmarks"][name] = summarize(runs)
+        print(f"{name}: {json.dumps(result['benchmarks'][name])}", file=sys.stderr)
+  finally:
+    if not args.keep:
+      shutil.rmtree(root, ignore_errors=True)
+  text = json.dumps(result, indent=2)
+  if args.output:
+    with open(args.output, "w") as f:
+      f.write(text + "\n")
+  else:
+    print(text)
+
+
+if __name__ == "__main__":
+  main()
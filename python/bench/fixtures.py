@@ -0,0 +1,244 @@
+"""fake NDK, fake FFmpeg repo and patch series for the benchmarks
+
+the fake configure and make are shell scripts, their latency and output volume
+come from the environment so one fixture serves every run:
+
+  FAKE_CONFIGURE_SECONDS, FAKE_MAKE_SECONDS  sleep before finishing
+  FAKE_OUTPUT_LINES                          lines printed by configure and make
+
+the prebuilt releases are served by PrebuiltServer, a local stand-in of the
+release host which knows range requests.
+"""
+import hashlib
+import http.server
+import os
+import stat
+import subprocess
+import threading
+import zipfile
+
+from base import detect_host
+
+ANDROID_ARCH_TRIPLES = [
+  "aarch64-linux-android21",
+  "armv7a-linux-androideabi21",
+  "i686-linux-android21",
+  "x86_64-linux-android21",
+]
+
+LLVM_TOOLS = ["clang", "clang++", "llvm-as", "yasm", "llvm-ar", "llvm-nm", "llvm-ranlib", "llvm-strip",
+              "llvm-readelf", "llvm-size", "llvm-strings", "llvm-lipo"]
+
+FAKE_CONFIGURE = """#!/bin/sh
+prefix=""
+for arg in "$@"; do
+  case "$arg" in
+    --prefix=*) prefix="${arg#--prefix=}" ;;
+  esac
+done
+seq 1 "${FAKE_OUTPUT_LINES:-1000}" | sed 's/^/checking for feature /'
+sleep "${FAKE_CONFIGURE_SECONDS:-0}"
+for f in %(outputs)s; do
+  mkdir -p "$(dirname "$f")"
+  echo "/* generated */" > "$f"
+done
+echo "prefix=$prefix" > ffbuild/config.mak
+"""
+
+FAKE_MAKE = """#!/bin/sh
+if [ "$1" = "install" ]; then
+  prefix=$(sed -n 's/^prefix=//p' ffbuild/config.mak)
+  mkdir -p "$prefix/lib" "$prefix/include"
+  echo "fake" > "$prefix/lib/libavcodec.a"
+  exit 0
+fi
+seq 1 "${FAKE_OUTPUT_LINES:-1000}" | sed 's|^|CC libavcodec/file|; s|$|.o|'
+sleep "${FAKE_MAKE_SECONDS:-0}"
+"""
+
+
+def _write_script(path: str, content: str):
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with open(path, "w") as f:
+    f.write(content)
+  os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+
+def _git(cwd: str, *args):
+  subprocess.run(["git", *args], cwd=cwd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def git_identity_env():
+  """git am and commit need an identity, CI machines often have none
+  """
+  for key, value in [("GIT_AUTHOR_NAME", "bench"), ("GIT_AUTHOR_EMAIL", "bench@localhost"),
+                     ("GIT_COMMITTER_NAME", "bench"), ("GIT_COMMITTER_EMAIL", "bench@localhost")]:
+    os.environ.setdefault(key, value)
+
+
+def make_fake_ndk(root: str) -> str:
+  """an NDK tree which satisfies ToolchainVars, returns the NDK home
+
+  the fake make is put into the toolchain bin, which is the first entry of PATH
+  of the build env, so the plain `make` of build_repo_android finds it.
+  """
+  host_tag = detect_host().host_tag
+  toolchain = os.path.join(root, "toolchains", "llvm", "prebuilt", host_tag)
+  bin_dir = os.path.join(toolchain, "bin")
+  for triple in ANDROID_ARCH_TRIPLES:
+    for suffix in ["clang", "clang++"]:
+      _write_script(os.path.join(bin_dir, f"{triple}-{suffix}"), "#!/bin/sh\nexit 0\n")
+  for tool in LLVM_TOOLS:
+    _write_script(os.path.join(bin_dir, tool), "#!/bin/sh\nexit 0\n")
+  _write_script(os.path.join(bin_dir, "make"), FAKE_MAKE)
+  _write_script(os.path.join(root, "prebuilt", host_tag, "bin", "make"), FAKE_MAKE)
+  os.makedirs(os.path.join(toolchain, "sysroot"), exist_ok=True)
+  with open(os.path.join(root, "source.properties"), "w") as f:
+    f.write("Pkg.Desc = Android NDK\nPkg.Revision = 27.2.12479018\n")
+  return root
+
+
+def make_fake_repo(path: str, outputs: list, tag: str, files: int = 2000, file_size: int = 4096) -> str:
+  """a git repo with a fake configure and `files` sources of `file_size` bytes, tagged `tag`
+  """
+  os.makedirs(path, exist_ok=True)
+  _git(path, "init", "-q")
+  _write_script(os.path.join(path, "configure"), FAKE_CONFIGURE % {"outputs": " ".join(outputs)})
+  payload = b"x" * file_size
+  for i in range(files):
+    src_dir = os.path.join(path, f"libavcodec{i % 16}")
+    os.makedirs(src_dir, exist_ok=True)
+    with open(os.path.join(src_dir, f"file{i}.c"), "wb") as f:
+      f.write(payload)
+  _git(path, "add", "-A")
+  _git(path, "commit", "-q", "-m", "fake ffmpeg")
+  _git(path, "tag", tag)
+  return path
+
+
+def make_patch_series(repo: str, tag: str, patch_dir: str, count: int = 20) -> str:
+  """`count` patches on top of tag written by format-patch, the repo is left at tag
+  """
+  _git(repo, "checkout", "-q", "-b", "bench-patches", tag)
+  for i in range(count):
+    with open(os.path.join(repo, f"patched{i}.c"), "w") as f:
+      f.write(f"int patched{i};\n")
+    _git(repo, "add", "-A")
+    _git(repo, "commit", "-q", "-m", f"patch {i}")
+  os.makedirs(patch_dir, exist_ok=True)
+  _git(repo, "format-patch", "-q", "-o", os.path.abspath(patch_dir), tag)
+  _git(repo, "checkout", "-q", tag)
+  _git(repo, "branch", "-q", "-D", "bench-patches")
+  return patch_dir
+
+
+def make_prebuilt_release(root: str, tag: str, platform: str, archs: list, files: int = 50,
+                          file_size: int = 64 * 1024) -> str:
+  """a release of `tag` laid out like the github one, with a .sha256 next to each archive
+
+  returns configs/libs/<lib>.sh which names the release, the archives are below root/release.
+  """
+  lib_name, ver = tag.split("-")[0], "-".join(tag.split("-")[1:-1])
+  joins = ["", "-simulator"] if platform in ("ios", "tvos") else [""]
+  release_dir = os.path.join(root, "release", tag)
+  os.makedirs(release_dir, exist_ok=True)
+  payload = os.urandom(file_size)
+  for join in joins:
+    path = os.path.join(release_dir, f"{lib_name}-{platform}-universal{join}-{ver}.zip")
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+      for arch in archs:
+        for i in range(files):
+          zf.writestr(f"{lib_name}/{arch}/lib/lib{i}.a", payload + str(i).encode())
+      zf.writestr(f"{lib_name}/include/{lib_name}.h", f"int {lib_name};\n")
+    with open(path, "rb") as f:
+      digest = hashlib.sha256(f.read()).hexdigest()
+    with open(f"{path}.sha256", "w") as f:
+      f.write(f"{digest}  {os.path.basename(path)}\n")
+  config = os.path.join(root, "configs", "libs", f"{lib_name}.sh")
+  os.makedirs(os.path.dirname(config), exist_ok=True)
+  with open(config, "w") as f:
+    f.write(f"export PRE_COMPILE_TAG_{platform.upper()}={tag}\n")
+  return config
+
+
+class _RangeHandler(http.server.SimpleHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+
+  def log_message(self, *args):
+    pass
+
+  def send_head(self):
+    path = self.translate_path(self.path)
+    if not os.path.isfile(path):
+      self.send_error(404)
+      return None
+    size = os.path.getsize(path)
+    start = 0
+    ranges = self.headers.get("Range", "")
+    if ranges.startswith("bytes="):
+      start = int(ranges[len("bytes="):].split("-")[0] or 0)
+      if start >= size:
+        self.send_response(416)
+        self.send_header("Content-Range", f"bytes */{size}")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        return None
+      self.send_response(206)
+      self.send_header("Content-Range", f"bytes {start}-{size - 1}/{size}")
+    else:
+      self.send_response(200)
+    self.send_header("Content-Type", "application/octet-stream")
+    self.send_header("Content-Length", str(size - start))
+    self.end_headers()
+    f = open(path, "rb")
+    f.seek(start)
+    self.server.requests.append((self.path, start))
+    return f
+
+  def copyfile(self, source, outputfile):
+    limit = self.server.take_drop(os.fstat(source.fileno()).st_size - source.tell())
+    sent = 0
+    for chunk in iter(lambda: source.read(64 * 1024), b""):
+      if limit and sent + len(chunk) > limit:
+        # a dropped connection, the client has to resume
+        outputfile.write(chunk[:limit - sent])
+        self.close_connection = True
+        return
+      outputfile.write(chunk)
+      sent += len(chunk)
+
+
+class PrebuiltServer(http.server.ThreadingHTTPServer):
+  """serves `root` on a free local port, `drop_after` bytes cuts the next download once
+  """
+  daemon_threads = True
+
+  def __init__(self, root: str):
+    self.root = root
+    self.drop_after = 0
+    self.requests = []
+    self.__lock = threading.Lock()
+    handler = lambda *a, **kw: _RangeHandler(*a, directory=root, **kw)
+    super().__init__(("127.0.0.1", 0), handler)
+    self.__thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+  def take_drop(self, size: int) -> int:
+    """the bytes to send before dropping a response of size, 0 to send it all
+    """
+    with self.__lock:
+      if not self.drop_after or size <= self.drop_after:
+        return 0
+      limit, self.drop_after = self.drop_after, 0
+      return limit
+
+  @property
+  def url(self) -> str:
+    return f"http://127.0.0.1:{self.server_address[1]}/"
+
+  def __enter__(self):
+    self.__thread.start()
+    return self
+
+  def __exit__(self, *exc):
+    self.shutdown()
+    self.server_close()
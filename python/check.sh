@@ -0,0 +1,2 @@
+# checks of the driver on local fixtures, no NDK or network needed
+cd "$(dirname "$0")" && python -m checks "$@"
@@ -0,0 +1,48 @@
+"""runnable checks of the driver against local fixtures
+
+  python -m checks [--only cache,...] [--keep]
+
+every check builds what it needs with bench.fixtures: the fake NDK and FFmpeg
+repo, bare repos and the local release server, nothing comes from the network.
+a check raises AssertionError when the driver misbehaves.
+"""
+import os
+
+import base
+import module_ffmpeg
+from bench import fixtures
+
+TAG = "n-check"
+
+
+def fake_env(root: str):
+  """the fake NDK and the env the module reads, once per run
+  """
+  fixtures.git_identity_env()
+  fixtures.make_fake_ndk(os.path.join(root, "ndk"))
+  os.environ.update({
+    "ANDROID_NDK_HOME": os.path.join(root, "ndk"),
+    "MR_TOOLCHAIN_CACHE_DIR": os.path.join(root, "toolchains"),
+    module_ffmpeg.MODULE_CONFIG["commit_env"]: TAG,
+    "FAKE_CONFIGURE_SECONDS": "0",
+    "FAKE_MAKE_SECONDS": "0",
+    "FAKE_OUTPUT_LINES": "5",
+  })
+
+
+def fake_workspace(root: str, name: str, arch: str = "arm64") -> base.BuildConfigure:
+  """a workspace with the sample of a fake FFmpeg repo initialized
+  """
+  origin = os.path.join(root, "origin")
+  patch_root = os.path.join(root, "patches")
+  if not os.path.exists(origin):
+    fixtures.make_fake_repo(origin, module_ffmpeg.CONFIGURE_OUTPUTS, TAG, files=20)
+    fixtures.make_patch_series(origin, TAG, os.path.join(patch_root, module_ffmpeg.MODULE_CONFIG["patch_dir"]), 3)
+  run_dir = os.path.join(root, name)
+  cfg = base.BuildConfigure("android", arch, os.path.join(run_dir, "build"), os.path.join(run_dir, "install"), "build", 2)
+  os.makedirs(cfg.get_samples_dir())
+  os.symlink(patch_root, cfg.get_patch_dir())
+  toolchain, host = base.get_platform_envs(cfg)
+  module = module_ffmpeg.FFMpegModule(cfg, toolchain, host)
+  module.init_sample_repo(origin, os.path.join(cfg.get_samples_dir(), module.module_config["repo_save_dir"]))
+  return cfg
@@ -0,0 +1,66 @@
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import traceback
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import checks
+from checks import cache, flags, keys, mirror, prebuilt, source, timing
+
+CHECKS = {
+  "cache": cache.check,
+  "flags": flags.check,
+  "keys": keys.check,
+  "mirror": mirror.check,
+  "prebuilt": prebuilt.check,
+  "source": source.check,
+  "timing": timing.check,
+}
+
+
+def parse_args():
+  parser = argparse.ArgumentParser(prog="python -m checks")
+  parser.add_argument('--only', type=str, default="", help=f'checks to run, comma separated, from {",".join(CHECKS)}')
+  parser.add_argument('--work-dir', type=str, default="", help='where the fixtures are created, default is a temp dir')
+  parser.add_argument('--keep', action='store_true', help='keep the fixtures')
+  return parser.parse_args()
+
+
+def main() -> int:
+  args = parse_args()
+  names = args.only.replace(",", " ").split() or list(CHECKS)
+  unknown = [n for n in names if n not in CHECKS]
+  if unknown:
+    sys.exit(f"unknown checks {unknown}")
+  root = os.path.abspath(args.work_dir) if args.work_dir else tempfile.mkdtemp(prefix="mr-checks-")
+  os.makedirs(root, exist_ok=True)
+  logger = logging.getLogger('build')
+  logger.setLevel(logging.DEBUG)
+  logger.propagate = False
+  logger.addHandler(logging.FileHandler(os.path.join(root, "checks.log")))
+  checks.fake_env(root)
+  failed = []
+  try:
+    for name in names:
+      try:
+        check_dir = os.path.join(root, name)
+        shutil.rmtree(check_dir, ignore_errors=True)
+        CHECKS[name](check_dir)
+        print(f"ok      {name}")
+      except Exception:
+        failed.append(name)
+        print(f"FAILED  {name}\n{traceback.format_exc()}")
+  finally:
+    if args.keep or failed:
+      print(f"fixtures and checks.log kept in {root}")
+    else:
+      shutil.rmtree(root, ignore_errors=True)
+  return 1 if failed else 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,56 @@
+"""the build cache: a miss builds and saves, a hit restores only the files of the module
+"""
+import glob
+import json
+import os
+import tarfile
+
+import module_ffmpeg
+from base import planner
+from base.cache import create_cache
+from base.scheduler import MultiArchScheduler
+from checks import fake_workspace
+
+
+def _build(cfg, cache) -> bool:
+  results = MultiArchScheduler(cfg, module_ffmpeg.FFMpegModule, 2, cache).run()
+  return all(r.ok for r in results)
+
+
+def check(root: str):
+  cfg = fake_workspace(root, "ws")
+  cache = create_cache(os.path.join(root, "cache"))
+  prefix = cfg.get_arch_install_prefix()
+  # a library of the shell driver installed into the same prefix
+  os.makedirs(os.path.join(prefix, "lib"))
+  with open(os.path.join(prefix, "lib", "libssl.a"), "w") as f:
+    f.write("openssl")
+
+  assert _build(cfg, cache), "the first build failed"
+  assert (cache.stats.hits, cache.stats.misses, cache.stats.saves) == (0, 1, 1), cache.stats
+  entries = glob.glob(os.path.join(root, "cache", "*", "*.tar.gz"))
+  assert len(entries) == 1, entries
+  with tarfile.open(entries[0]) as tar:
+    members = [os.path.normpath(m.name) for m in tar.getmembers()]
+  assert "lib/libavcodec.a" in members, members
+  assert "lib/libssl.a" not in members, f"the entry has a file of another library: {members}"
+  with open(os.path.join(cfg.get_arch_workspace(), "footprint", "ffmpeg.json")) as f:
+    libraries = json.load(f)["libraries"]
+  assert list(libraries) == ["libavcodec.a"], f"the footprint counts other libraries: {list(libraries)}"
+
+  # a hit restores the files of ffmpeg and keeps the ones of the other library
+  os.remove(os.path.join(prefix, "lib", "libavcodec.a"))
+  planner.remove_stamp(cfg, module_ffmpeg.MODULE_CONFIG["name"])
+  assert _build(cfg, cache), "the cached build failed"
+  assert cache.stats.hits == 1, cache.stats
+  assert os.path.exists(os.path.join(prefix, "lib", "libavcodec.a")), "the hit did not restore libavcodec.a"
+  with open(os.path.join(prefix, "lib", "libssl.a")) as f:
+    assert f.read() == "openssl", "the hit changed a file of another library"
+
+  # other configure flags are another key
+  os.environ[module_ffmpeg.MODULE_CONFIG["formats_env"]] = "mp4"
+  try:
+    assert _build(cfg, cache), "the build with other flags failed"
+  finally:
+    del os.environ[module_ffmpeg.MODULE_CONFIG["formats_env"]]
+  assert (cache.stats.misses, cache.stats.saves) == (2, 2), cache.stats
@@ -0,0 +1,20 @@
+"""normalizing the configure flags keeps what they mean
+"""
+from module_ffmpeg.flags import normalize
+
+
+def check(root: str):
+  # a group and its member switches keep the order they are given in
+  assert normalize(["--disable-ffmpeg", "--enable-programs"]) == ["--disable-ffmpeg", "--enable-programs"]
+  assert normalize(["--enable-ffmpeg", "--disable-programs"]) == ["--enable-ffmpeg", "--disable-programs"]
+  assert normalize(["--enable-programs", "--disable-ffmpeg"]) == ["--enable-programs", "--disable-ffmpeg"]
+  # the same switch given again takes the place of the last one
+  assert normalize(["--disable-programs", "--enable-ffmpeg", "--disable-programs"]) == \
+    ["--enable-ffmpeg", "--disable-programs"]
+  assert normalize(["--disable-doc", "--enable-pic", "--disable-doc"]) == ["--enable-pic", "--disable-doc"]
+  # a disabled group of components overrides the ones given before it
+  assert normalize(["--enable-decoder=aac", "--disable-everything", "--enable-demuxer=mov"]) == \
+    ["--disable-everything", "--enable-demuxer=mov"]
+  # the same meaning gives the same vector
+  assert normalize(["--enable-pic", "--disable-debug", "--enable-decoder=h264,aac"]) == \
+    normalize(["--disable-debug", "--enable-decoder=aac", "--enable-pic", "--enable-decoder=h264"])
@@ -0,0 +1,27 @@
+"""the build key tells every arch apart, also on apple where all archs share one clang
+"""
+from dataclasses import replace
+import itertools
+
+import base
+from base.cache import compute_build_key
+from base.scheduler import PLATFORM_ARCHS
+from base.toolchain import apple_target
+
+
+def check(root: str):
+  cfg = base.BuildConfigure("android", "arm64", root, root, "build")
+  toolchain, _ = base.get_platform_envs(cfg)
+  flags = ["--enable-neon"]
+  keys = {}
+  for arch in PLATFORM_ARCHS["android"]:
+    arch_toolchain, _ = base.get_platform_envs(replace(cfg, arch=arch))
+    keys[f"android/{arch}"] = compute_build_key("tree", "", flags, arch_toolchain)
+  # like xcrun gives them: one clang and one sysroot per sdk, the arch is in the cflags only
+  for platform in ["ios", "tvos", "macos"]:
+    for arch in PLATFORM_ARCHS[platform]:
+      sdk, cflags = apple_target(platform, arch)
+      apple = replace(toolchain, sysroot=f"{toolchain.sysroot}-{sdk}", cflags=cflags, validate=False)
+      keys[f"{platform}/{arch}"] = compute_build_key("tree", "", flags, apple)
+  same = [(a, b) for a, b in itertools.combinations(keys, 2) if keys[a] == keys[b]]
+  assert not same, f"archs with the same build key: {same}"
@@ -0,0 +1,89 @@
+"""the bare mirror shared by clones and the partial clone modes of base.Repo
+"""
+import os
+import subprocess
+
+from base import Repo
+from bench import fixtures
+from checks import TAG
+
+
+def _git(cwd: str, *args) -> str:
+  return subprocess.run(["git", *args], cwd=cwd, check=True, stdout=subprocess.PIPE,
+                        stderr=subprocess.DEVNULL, text=True).stdout.strip()
+
+
+def _has(repo_dir: str, commit: str) -> bool:
+  return subprocess.run(["git", "cat-file", "-e", f"{commit}^{{commit}}"], cwd=repo_dir,
+                        stderr=subprocess.DEVNULL).returncode == 0
+
+
+def _alternates(repo_dir: str) -> str:
+  path = os.path.join(repo_dir, ".git", "objects", "info", "alternates")
+  if not os.path.exists(path):
+    return ""
+  with open(path) as f:
+    return f.read().strip()
+
+
+def check(root: str):
+  origin = fixtures.make_fake_repo(os.path.join(root, "origin"), ["config.h"], TAG, files=20)
+  # upstream moves on after the tag, a shallow clone must not get it
+  with open(os.path.join(origin, "next.c"), "w") as f:
+    f.write("int next;\n")
+  _git(origin, "add", "-A")
+  _git(origin, "commit", "-q", "-m", "after the tag")
+  tagged = _git(origin, "rev-parse", f"{TAG}^{{commit}}")
+  mirrors = os.path.join(root, "mirrors")
+
+  # the first clone creates the mirror and borrows its objects
+  first = Repo(origin, os.path.join(root, "ws1", "ffmpeg"), mirror_root=mirrors)
+  first.init(TAG)
+  first.reset(TAG)
+  mirror = first.get_mirror_path()
+  assert os.path.isdir(mirror), "the mirror is not created"
+  assert _alternates(first.get_repo_dir()).startswith(mirror), "the clone does not borrow from the mirror"
+  assert _git(first.get_repo_dir(), "rev-parse", "HEAD") == tagged, "reset did not check out the tag"
+
+  # a commit the mirror has already is not fetched again
+  with open(os.path.join(origin, "later.c"), "w") as f:
+    f.write("int later;\n")
+  _git(origin, "add", "-A")
+  _git(origin, "commit", "-q", "-m", "later")
+  later = _git(origin, "rev-parse", "HEAD")
+  second = Repo(origin, os.path.join(root, "ws2", "ffmpeg"), mirror_root=mirrors)
+  second.init(TAG)
+  second.reset(TAG)
+  assert not _has(mirror, later), "the mirror was fetched although it had the commit"
+  # a commit the clone misses is fetched into the mirror, then into the clone
+  with open(os.path.join(origin, "latest.c"), "w") as f:
+    f.write("int latest;\n")
+  _git(origin, "add", "-A")
+  _git(origin, "commit", "-q", "-m", "latest")
+  latest = _git(origin, "rev-parse", "HEAD")
+  second.reset(latest)
+  assert _has(mirror, latest), "the mirror was not updated for a missing commit"
+  assert _git(second.get_repo_dir(), "rev-parse", "HEAD") == latest
+
+  # reset to the base drops local commits and edits
+  with open(os.path.join(second.get_repo_dir(), "next.c"), "w") as f:
+    f.write("edited\n")
+  second.reset(TAG)
+  assert _git(second.get_repo_dir(), "rev-parse", "HEAD") == tagged
+  assert not _git(second.get_repo_dir(), "status", "--porcelain"), "reset left local edits"
+
+  # blobless clones record the filter, blobs come on demand
+  blobless = Repo(origin, os.path.join(root, "blobless", "ffmpeg"), clone_mode="blobless")
+  blobless.init(TAG)
+  blobless.reset(TAG)
+  assert _git(blobless.get_repo_dir(), "config", "remote.origin.partialclonefilter") == "blob:none"
+  assert _git(blobless.get_repo_dir(), "rev-parse", "HEAD") == tagged
+
+  # shallow clones only have the commit, from the mirror
+  shallow = Repo(origin, os.path.join(root, "shallow", "ffmpeg"), mirror_root=mirrors, clone_mode="shallow")
+  shallow.init(TAG)
+  shallow.reset(TAG)
+  assert os.path.exists(os.path.join(shallow.get_repo_dir(), ".git", "shallow")), "the clone is not shallow"
+  assert _git(shallow.get_repo_dir(), "rev-list", "--count", "HEAD") == "1"
+  assert _git(shallow.get_repo_dir(), "rev-parse", "HEAD") == tagged
+  assert _alternates(shallow.get_repo_dir()).startswith(mirror), "the shallow clone does not borrow from the mirror"
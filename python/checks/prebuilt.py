@@ -0,0 +1,72 @@
+"""the prebuilt installer against the local release server: resume, checksum mismatch and zip traversal
+"""
+import hashlib
+import os
+import zipfile
+
+from base.prebuilt import PrebuiltInstaller, prebuilt_archives
+from bench import fixtures
+
+PREBUILT_TAG = "opus-1.3.1-231124151836"
+
+
+def _install(config: str, workspace: str, url: str):
+  installer = PrebuiltInstaller(2, retry_delay=0)
+  try:
+    archives = prebuilt_archives(config, "android", workspace, "all", url)
+    return archives, installer.install(archives)
+  finally:
+    installer.pool.close()
+
+
+def _replace_release(release_dir: str, name: str, members: dict):
+  """rewrite an archive of the release with members, the .sha256 matches it
+  """
+  path = os.path.join(release_dir, name)
+  with zipfile.ZipFile(path, "w") as zf:
+    for member, data in members.items():
+      zf.writestr(member, data)
+  with open(path, "rb") as f:
+    digest = hashlib.sha256(f.read()).hexdigest()
+  with open(f"{path}.sha256", "w") as f:
+    f.write(f"{digest}  {name}\n")
+
+
+def check(root: str):
+  config = fixtures.make_prebuilt_release(root, PREBUILT_TAG, "android", ["arm64", "armv7a"], files=20)
+  release_root = os.path.join(root, "release")
+  release_dir = os.path.join(release_root, PREBUILT_TAG)
+  name = os.listdir(release_dir)[0].replace(".sha256", "")
+  with fixtures.PrebuiltServer(release_root) as server:
+    # a connection dropped in the middle is resumed by a range request
+    server.drop_after = 256 * 1024
+    archives, results = _install(config, os.path.join(root, "resume"), server.url)
+    assert results[0].ok, results[0].error
+    assert results[0].resumed_from == 256 * 1024, results[0]
+    assert results[0].extracted == 41, results[0]
+    with open(os.path.join(release_dir, name), "rb") as f, open(archives[0].path, "rb") as g:
+      assert f.read() == g.read(), "the resumed archive differs from the release"
+
+    # a partial file of an earlier run is resumed too
+    workspace = os.path.join(root, "partial")
+    archive = prebuilt_archives(config, "android", workspace, "all", server.url)[0]
+    os.makedirs(os.path.dirname(archive.path))
+    with open(os.path.join(release_dir, name), "rb") as f, open(f"{archive.path}.part", "wb") as g:
+      g.write(f.read(100000))
+    _, results = _install(config, workspace, server.url)
+    assert results[0].ok and results[0].resumed_from == 100000, results[0]
+
+    # an archive which does not match its .sha256 is removed and nothing is extracted
+    with open(os.path.join(release_dir, f"{name}.sha256"), "w") as f:
+      f.write(f"{'0' * 64}  {name}\n")
+    archives, results = _install(config, os.path.join(root, "mismatch"), server.url)
+    assert not results[0].ok and "Checksum" in results[0].error, results[0]
+    assert not os.path.exists(archives[0].path), "the archive with a wrong checksum is kept"
+    assert not os.path.exists(archives[0].dest_dir), "members of an archive with a wrong checksum are extracted"
+
+    # a member outside of the destination fails the install and is never written
+    _replace_release(release_dir, name, {"opus/arm64/lib/libopus.a": b"opus", "opus/../../evil": b"evil"})
+    archives, results = _install(config, os.path.join(root, "traversal"), server.url)
+    assert not results[0].ok and "outside of the destination" in results[0].error, results[0]
+    dest = os.path.abspath(archives[0].dest_dir)
+    assert not os.path.exists(os.path.join(dest, "..", "evil")), "a member is written outside of the destination"
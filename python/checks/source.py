@@ -0,0 +1,64 @@
+"""a patch added after the first build reaches the arch tree which is built, worktree or copy
+"""
+import os
+import subprocess
+
+import base
+import module_ffmpeg
+from base import planner
+from base.scheduler import MultiArchScheduler
+from checks import TAG, fake_workspace
+
+
+def _git(cwd: str, *args) -> str:
+  return subprocess.run(["git", *args], cwd=cwd, check=True, stdout=subprocess.PIPE,
+                        stderr=subprocess.DEVNULL, text=True).stdout.strip()
+
+
+def _add_patch(origin: str, patch_dir: str, name: str):
+  """one more patch on top of the series, it adds `name`
+  """
+  patches = sorted(p for p in os.listdir(patch_dir) if p.endswith(".patch"))
+  _git(origin, "checkout", "-q", "-b", "check-source", TAG)
+  for patch in patches:
+    _git(origin, "am", "-q", os.path.join(patch_dir, patch))
+  with open(os.path.join(origin, name), "w") as f:
+    f.write("int added;\n")
+  _git(origin, "add", "-A")
+  _git(origin, "commit", "-q", "-m", "added after the first build")
+  _git(origin, "format-patch", "-q", "-1", f"--start-number={len(patches) + 1}", "-o", patch_dir)
+  _git(origin, "checkout", "-q", TAG)
+  _git(origin, "branch", "-q", "-D", "check-source")
+
+
+def _build(cfg) -> bool:
+  return all(r.ok for r in MultiArchScheduler(cfg, module_ffmpeg.FFMpegModule, 2).run())
+
+
+def _check(root: str, name: str, strategy: str):
+  cfg = fake_workspace(root, name)
+  toolchain, host = base.get_platform_envs(cfg)
+  module = module_ffmpeg.FFMpegModule(cfg, toolchain, host)
+  os.environ["MR_MATERIALIZE"] = strategy
+  try:
+    assert _build(cfg), f"the first {strategy} build failed"
+    first_key = planner.read_stamp(cfg, "ffmpeg")["key"]
+    added = f"added-{name}.c"
+    _add_patch(os.path.join(root, "origin"), module.get_module_patch_dir(), added)
+    module.init_sample_repo(os.path.join(root, "origin"), module.get_sample_dir())
+    assert _build(cfg), f"the {strategy} build after the new patch failed"
+  finally:
+    del os.environ["MR_MATERIALIZE"]
+    # the series is shared by the workspaces of the check
+    for patch in os.listdir(module.get_module_patch_dir()):
+      if "added-after" in patch:
+        os.remove(os.path.join(module.get_module_patch_dir(), patch))
+  assert planner.read_stamp(cfg, "ffmpeg")["key"] != first_key, "the new patch did not change the key"
+  assert os.path.exists(os.path.join(module.get_arch_source_dir(), added)), \
+    f"the {strategy} arch tree was built without the new patch"
+  assert planner.read_source_commit(cfg, "ffmpeg") == module.get_sample_commit()
+
+
+def check(root: str):
+  _check(root, "worktree", "worktree")
+  _check(root, "copy", "copy")
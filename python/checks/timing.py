@@ -0,0 +1,31 @@
+"""the trace summary adds up nested spans and spans of worker threads once
+"""
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+from base import trace
+
+
+def _arch(tracer: trace.Tracer, ctx: dict, arch: str):
+  with trace.context(**ctx, arch=arch), tracer.span("build", "module"):
+    with tracer.span("configure", "ffmpeg"):
+      time.sleep(0.1)
+    with tracer.span("make", "ffmpeg"):
+      time.sleep(0.2)
+
+
+def check(root: str):
+  tracer = trace.Tracer()
+  with trace.context(library="ffmpeg"), tracer.span("library", "graph"):
+    ctx = trace.current()
+    with ThreadPoolExecutor(max_workers=2) as pool:
+      list(pool.map(lambda arch: _arch(tracer, ctx, arch), ["arm64", "x86_64"]))
+  summary = tracer.summary()
+  library = summary["by_library"]["ffmpeg"]
+  assert library["total_s"] <= summary["wall_s"], f"nested spans are counted twice: {library}"
+  for arch, item in summary["by_arch"].items():
+    assert 0.3 <= item["total_s"] < 0.4, f"{arch} adds up its build and the phases in it: {item}"
+  by_name = summary["by_name"]
+  assert by_name["module:build"]["self_s"] < 0.05, by_name["module:build"]
+  assert by_name["graph:library"]["self_s"] < 0.05, by_name["graph:library"]
+  assert 0.4 <= by_name["ffmpeg:make"]["self_s"] < 0.5, by_name["ffmpeg:make"]
@@ -0,0 +1,49 @@
+"""thin client of the build daemon, `python client.py <main.py arguments>`
+
+it only imports the standard library, the daemon (`python main.py --daemon`)
+has everything else loaded already. without a daemon, or when the daemon runs
+outdated sources, the arguments are handed over to main.py in this process.
+"""
+import json
+import os
+import socket
+import sys
+
+# keep in sync with base.daemon, importing base would load GitPython
+DEFAULT_SOCKET = os.path.join(os.path.expanduser("~"), ".cache", "mr-ffbuild", "daemon.sock")
+
+
+def request(argv: list, socket_path: str) -> int:
+  """exit code of the request, None if the daemon can not run it
+  """
+  try:
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.connect(socket_path)
+  except OSError:
+    return None
+  with s, s.makefile("rb") as f:
+    s.sendall((json.dumps({"argv": argv, "cwd": os.getcwd(), "env": dict(os.environ)}) + "\n").encode())
+    for line in f:
+      msg = json.loads(line)
+      if "out" in msg:
+        sys.stdout.write(msg["out"])
+        sys.stdout.flush()
+      elif msg.get("stale"):
+        return None
+      elif "exit" in msg:
+        return msg["exit"]
+  # the daemon died while running the request, do not run it a second time
+  return 1
+
+
+def run_locally(argv: list):
+  main = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+  os.execv(sys.executable, [sys.executable, main, *argv])
+
+
+if __name__ == "__main__":
+  argv = sys.argv[1:]
+  code = request(argv, os.environ.get("MR_DAEMON_SOCKET") or DEFAULT_SOCKET)
+  if code is None:
+    run_locally(argv)
+  sys.exit(code)
@@ -1,15 +1,59 @@
+import sys
+import time
+
+STARTUP = time.perf_counter()
+# top level imports and their seconds, filled by --profile-startup
+IMPORT_TIMES = {}
+
+def profile_imports():
+  """time every import which is not loaded yet, nested imports count for the outermost one
+  """
+  import builtins
+  real_import = builtins.__import__
+  depth = [0]
+  def timed_import(name, *args, **kwargs):
+    if name in sys.modules:
+      return real_import(name, *args, **kwargs)
+    start = time.perf_counter()
+    depth[0] += 1
+    try:
+      return real_import(name, *args, **kwargs)
+    finally:
+      depth[0] -= 1
+      level = kwargs.get("level", args[3] if len(args) > 3 else 0)
+      if depth[0] == 0 and name:
+        name = "." * level + name
+        IMPORT_TIMES[name] = IMPORT_TIMES.get(name, 0) + time.perf_counter() - start
+  builtins.__import__ = timed_import
+
+if "--profile-startup" in sys.argv:
+  profile_imports()
+
 import argparse
 import logging
 import base
 import os
-import module_ffmpeg
+from base import trace
+from base.registry import discover_modules
+
+# libraries which are built by python modules, the others fall back to the shell driver.
+# the modules are found without importing them, see base.registry
+PY_MODULES = discover_modules(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_LIBRARY = "ffmpeg"
 
-def setup_loggers(logger_path:str):
+def setup_loggers(workspace:str):
+  """console lines and the json lines of this run in <workspace>/logs/runs, see base.buildlog
+  """
+  from base.buildlog import run_log_handler
   logger = logging.getLogger('build')
   logger.setLevel(logging.DEBUG)
+  # a worker of the daemon inherits the handlers of the daemon
+  for handler in list(logger.handlers):
+    logger.removeHandler(handler)
+    handler.close()
 
-  # 创建一个文件处理程序，将日志写入到文件
-  file_handler = logging.FileHandler(logger_path)
+  # 创建一个文件处理程序，每次运行单独一个 json lines 文件，并发运行不会交错
+  file_handler = run_log_handler(workspace)
   file_handler.setLevel(logging.DEBUG)
 
   # 创建一个控制台处理程序，将日志输出到stdout
@@ -18,7 +62,6 @@ def setup_loggers(logger_path:str):
 
   # 定义日志格式
   formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-  file_handler.setFormatter(formatter)
   console_handler.setFormatter(formatter)
 
   # 将处理程序添加到logger实例中
@@ -27,44 +70,287 @@ def setup_loggers(logger_path:str):
   return logger
 
 
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('-p', '--platform', type=str, default='android', choices=['apple', 'android', 'ios', 'tvos', 'macos', 'all'], help='platform must be: [apple|android|ios|tvos|macos|all]')
     # only avalibale for apple
-    parser.add_argument('-a', '--arch', type=str, default='arm64', choices=['arm64', 'arm64-simulator','x86_64', 'x86_64-simulator', 'all'], help='arch must be: [arm64|arm64-simulator|x86_64|x86_64-simulator|all], only avaliable for apple')
+    parser.add_argument('-a', '--arch', type=str, default='arm64', choices=['arm64', 'armv7a', 'x86', 'arm64-simulator','x86_64', 'x86_64-simulator', 'all'], help='arch must be: [arm64|armv7a|x86|arm64-simulator|x86_64|x86_64-simulator|all], armv7a and x86 are only avaliable for android, simulators are only avaliable for apple')
+    parser.add_argument('-j', '--jobs', type=int, default=0, help='total make jobs shared by all libraries and archs, default is derived from cpus, cgroup limits and free memory')
     parser.add_argument('-w', '--workspace', type=str, default='build', help='specify workspace')
     parser.add_argument('--prefix', type=str, help='install the library')
-    parser.add_argument('--action',  type=str, default='init', choices=['init', 'build', 'install'], help='action must be: [init|build|install]')
-    parser.add_argument('--library', type=str, default="", help='specify the library name')
+    parser.add_argument('--action',  type=str, default='init', choices=['init', 'build', 'install', 'check-patches', 'watch', 'restore', 'triage'], help='action must be: [init|build|install|check-patches|watch|restore|triage]')
+    parser.add_argument('--cache-dir', type=str, default=os.environ.get('MR_BUILD_CACHE_DIR', ''), help='local directory of the build artifact cache')
+    parser.add_argument('--cache-url', type=str, default=os.environ.get('MR_BUILD_CACHE_URL', ''), help='http server of the build artifact cache')
+    parser.add_argument('--git-mirror-dir', type=str, default=os.environ.get('MR_GIT_MIRROR_DIR', ''), help='machine wide bare mirrors which new clones borrow objects from')
+    parser.add_argument('--clone-mode', type=str, default='full', choices=base.CLONE_MODES, help='clone mode must be: [full|blobless|shallow]')
+    parser.add_argument('--compiler-cache', type=str, default=os.environ.get('MR_COMPILER_CACHE', 'none'), choices=['none', 'auto', 'ccache', 'sccache'], help='wrap cc/cxx with a compiler cache: [none|auto|ccache|sccache]')
+    parser.add_argument('--trace', type=str, default='', help='write a chrome trace of the run to this file and a json summary next to it')
+    parser.add_argument('--daemon', action='store_true', help='serve requests of client.py on a unix socket instead of building')
+    parser.add_argument('--daemon-socket', type=str, default='', help='socket of the daemon, default is MR_DAEMON_SOCKET or ~/.cache/mr-ffbuild/daemon.sock')
+    parser.add_argument('--daemon-jobs', type=int, default=4, help='requests the daemon runs at the same time, the others are queued')
+    parser.add_argument('--profile-startup', action='store_true', help='report the time until the action starts and the imports it took')
+    parser.add_argument('--library', type=str, default="", help='specify the library names, separated by comma or space, default is ffmpeg')
+    parser.add_argument('--dry-run', action='store_true', help='build only prints what it would do and how long it would take, the plan is also written to <workspace>/plan.json')
+    parser.add_argument('--patch-commits', type=str, default="", help='check-patches also checks every series of the libraries at these commits or tags, separated by comma')
+    parser.add_argument('--store-dir', type=str, default=os.environ.get('MR_ARTIFACT_STORE', ''), help='artifact store which keeps every built prefix and extracted prebuilt, deduplicated and compressed')
+    parser.add_argument('--store-keep', type=int, default=int(os.environ.get('MR_ARTIFACT_STORE_KEEP', '0') or 0), help='builds kept per library in the artifact store after a build, 0 keeps all')
+    parser.add_argument('--build-id', type=str, default="", help='restore puts this build of the artifact store into the install prefix, default is the newest one of the arch')
     # parser.add_argument('--install', action='store_true', help='install the library')
     # # prepare the repo, clone the sample code, and don't build it.
     # parser.add_argument('--init', action='store_true', help='initialize the library')
     # parser.add_argument('--build', action='store_true', help='build the library')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     return args
   
 def preapre_workspaces(bcfg:base.BuildConfigure):
+  from base.scheduler import expand_archs
   if not bcfg.action == "init":
     logger.info("Not initialize the library, skip checking workspace!")
     return
-  bcfg.prepare()
+  for arch_cfg in expand_archs(bcfg):
+    arch_cfg.prepare()
+
+def build_all_archs(bcfg:base.BuildConfigure, module_cls, jobserver=None):
+  from base.cache import create_cache
+  from base.scheduler import MultiArchScheduler
+  scheduler = MultiArchScheduler(bcfg, module_cls, args.jobs, create_cache(args.cache_dir, args.cache_url), jobserver)
+  results = scheduler.run()
+  for res in results:
+    status = "done" if res.ok else f"failed: {res.error}"
+    logger.info(f"[{res.arch}] {status} in {res.elapsed:.1f}s, log: {res.log_path}")
+    if res.compiler_cache:
+      logger.info(f"[{res.arch}] {res.compiler_cache}")
+  return all(res.ok for res in results)
+
+def build_libraries(bcfg:base.BuildConfigure, libraries:list):
+  from base.graph import GraphExecutor, build_library_graph, shell_build_action
+  from base.jobserver import create_jobserver
+  from base.planner import TIMINGS_FILE, Timings
+  # one token pool for every library and arch of this run
+  jobserver = create_jobserver(bcfg.get_jobs())
+  def py_action(spec):
+    def action():
+      module_cls = spec.load()
+      if not build_all_archs(bcfg, module_cls, jobserver):
+        raise base.BuildError(f"Build {module_cls.__name__} failed")
+    return action
+  actions = {}
+  for lib in libraries:
+    if lib in PY_MODULES:
+      actions[lib] = py_action(PY_MODULES[lib])
+    else:
+      actions[lib] = shell_build_action(lib, bcfg.platform, bcfg.arch)
+  depends = {lib: PY_MODULES[lib].get_depends() for lib in libraries if lib in PY_MODULES}
+  # the longest chain by the past durations starts first
+  timings = Timings(os.path.join(bcfg.workspace, TIMINGS_FILE))
+  costs = {lib: timings.estimate(lib, bcfg.platform, bcfg.arch) for lib in libraries}
+  graph = build_library_graph(libraries, actions, depends, costs)
+  executor = GraphExecutor(graph, len(libraries))
+  try:
+    results = executor.run()
+  finally:
+    if jobserver:
+      jobserver.close()
+  for lib, res in results.items():
+    # the python modules record every arch themselves
+    if res.ok and lib not in PY_MODULES:
+      timings.record(lib, bcfg.platform, bcfg.arch, res.elapsed)
+  path, length = executor.critical_path()
+  logger.info(f"critical path: {' -> '.join(path)} ({length:.1f}s)")
+  if args.store_keep > 0 and bcfg.artifact_store:
+    from base.store import open_store
+    open_store(bcfg.artifact_store).gc(args.store_keep)
+  return all(res.ok for res in results.values())
   
+def plan_libraries(bcfg:base.BuildConfigure, libraries:list):
+  """print what building the libraries would do and write it to <workspace>/plan.json, nothing is built
+  """
+  from base.cache import create_cache
+  from base.planner import TIMINGS_FILE, Timings, format_plan, make_plan, write_plan
+  timings = Timings(os.path.join(bcfg.workspace, TIMINGS_FILE))
+  plan = make_plan(bcfg, libraries, PY_MODULES, create_cache(args.cache_dir, args.cache_url), timings)
+  logger.info("build plan:\n" + format_plan(plan))
+  plan_path = os.path.join(bcfg.workspace, "plan.json")
+  write_plan(plan, plan_path)
+  logger.info(f"plan written to {plan_path}")
+  return True
+
+def install_libraries(bcfg:base.BuildConfigure, libraries:list):
+  """download and extract the prebuilt libraries, all archives share one pool of downloads
+  """
+  from base.graph import SHELL_ROOT_DIR
+  from base.prebuilt import PrebuiltInstaller, prebuilt_archives
+  archives = []
+  for lib in libraries:
+    config = lib
+    if lib in PY_MODULES:
+      config = PY_MODULES[lib].get_module_config().get("prebuilt_config", lib)
+    config_path = os.path.join(SHELL_ROOT_DIR, "configs", "libs", f"{config}.sh")
+    archives.extend(prebuilt_archives(config_path, bcfg.platform, bcfg.workspace, bcfg.arch))
+  from base.store import open_store
+  results = PrebuiltInstaller(bcfg.get_jobs(), store=open_store(bcfg.artifact_store)).install(archives)
+  return all(res.ok for res in results)
+
+def restore_library(bcfg:base.BuildConfigure, library:str, build_id:str):
+  """replace the files of library in the install prefix of every arch with a build kept in the
+  artifact store, e.g. to roll back. the files of the other libraries in the prefix are kept
+  """
+  from base import planner
+  from base.scheduler import expand_archs
+  from base.store import open_store
+  store = open_store(bcfg.artifact_store)
+  if not store:
+    raise base.ConfigureError("restore needs --store-dir or MR_ARTIFACT_STORE")
+  name = PY_MODULES[library].get_module_config()["name"] if library in PY_MODULES else library
+  arch_cfgs = expand_archs(bcfg)
+  if build_id:
+    # a build id is <platform>-<arch>-<key>, it restores its own arch only
+    arch_cfgs = [c for c in arch_cfgs if build_id.startswith(f"{c.platform}-{c.arch}-")]
+    if not arch_cfgs or not store.has(name, build_id):
+      raise base.BuildError(f"No build {build_id} of {name} for {bcfg.platform} {bcfg.arch} in {store.root}")
+  for arch_cfg in arch_cfgs:
+    builds = [b["build_id"] for b in store.builds(name) if b["build_id"].startswith(f"{arch_cfg.platform}-{arch_cfg.arch}-")]
+    arch_build = build_id or (builds[-1] if builds else "")
+    if not arch_build:
+      raise base.BuildError(f"No build of {name} for {arch_cfg.platform} {arch_cfg.arch} in {store.root}")
+    prefix = arch_cfg.get_arch_install_prefix()
+    manifest = store.manifest(name, arch_build)
+    files = [e["path"] for e in manifest["files"]] + list(manifest.get("symlinks", {}))
+    # the prefix no longer matches the sources, the next build rebuilds it
+    planner.remove_stamp(arch_cfg, name)
+    # the files of the installed build which the restored one does not have
+    for rel in set(planner.read_installed_files(arch_cfg, name)) - set(files):
+      try:
+        os.remove(os.path.join(prefix, rel))
+      except FileNotFoundError:
+        pass
+    store.materialize(name, arch_build, prefix)
+    planner.write_installed_files(arch_cfg, name, files)
+    logger.info(f"[{arch_cfg.arch}] {name} {arch_build} restored into {prefix}")
+  return True
+
+def check_library_patches(bcfg:base.BuildConfigure, libraries:list, commits:list):
+  """apply the patch series of the libraries to worktrees of their versions, all series at the same time
+  """
+  from base.graph import SHELL_ROOT_DIR
+  from base.patchcheck import check_patches, format_matrix, series_targets, update_mirrors, write_report
+  targets = series_targets(SHELL_ROOT_DIR, bcfg.workspace, libraries, commits, bcfg.git_mirror_dir)
+  if bcfg.git_mirror_dir:
+    update_mirrors(targets, bcfg.git_mirror_dir)
+  results = check_patches(targets, os.path.join(bcfg.workspace, "check-patches"), bcfg.get_jobs())
+  logger.info("patch series:\n" + format_matrix(results))
+  report_path = os.path.join(bcfg.workspace, "check-patches.json")
+  write_report(results, report_path)
+  logger.info(f"report written to {report_path}")
+  return all(res.ok for res in results)
+
+def watch_library(bcfg:base.BuildConfigure, library:str):
+  """rebuild the archs of library whenever its patches or arch source trees change, until interrupted
+  """
+  from base.jobserver import create_jobserver
+  from base.watch import PatchWatcher
+  if library not in PY_MODULES:
+    raise base.ConfigureError(f"{library} has no python module, only those can be watched")
+  module_cls = PY_MODULES[library].load()
+  module_config = PY_MODULES[library].get_module_config()
+  repo = os.environ.get(module_config["repo_env"], module_config["repo"])
+  jobserver = create_jobserver(bcfg.get_jobs())
+  try:
+    PatchWatcher(bcfg, module_cls, repo, jobserver=jobserver).run()
+  finally:
+    if jobserver:
+      jobserver.close()
+  return True
+
+def triage_failures(bcfg:base.BuildConfigure, library:str):
+  """print the root cause of the failed phases of the last builds from the log indexes, see base.buildlog
+  """
+  from base.buildlog import find_indexes, format_triage
+  from base.scheduler import expand_archs
+  name = PY_MODULES[library].get_module_config()["name"] if library in PY_MODULES else library
+  found = False
+  for arch_cfg in expand_archs(bcfg):
+    indexes = find_indexes(arch_cfg.get_arch_workspace(), name)
+    # every run of a phase rewrites its index, the newest failure is where the build stopped
+    failed = [i for i in indexes if not i["ok"]]
+    if failed:
+      found = True
+      logger.info(f"[{arch_cfg.arch}]\n" + format_triage(failed[0]))
+  if not found:
+    logger.info(f"no failed phase of {name} in the logs of {bcfg.workspace}")
+  return True
+
+def preload():
+  """import what the actions load lazily, the forked workers of the daemon start with it
+  """
+  import importlib
+  for name in ["git", "base.proc", "base.cache", "base.graph", "base.jobserver", "base.scheduler", "base.toolchain", "base.prebuilt", "base.patchcheck", "base.planner", "base.store", "base.buildlog"]:
+    importlib.import_module(name)
+  for spec in PY_MODULES.values():
+    spec.load()
+
+def report_imports():
+  total = sum(IMPORT_TIMES.values())
+  lines = [f"  {name:<32} {secs * 1000:8.1f}ms" for name, secs in sorted(IMPORT_TIMES.items(), key=lambda kv: -kv[1])]
+  logger.info(f"imports took {total * 1000:.1f}ms, lazy ones are loaded by the action:\n" + "\n".join(lines[:20]))
+
+def main(argv=None) -> int:
+  global args, logger
+  args = parse_args(argv)
+  logger = setup_loggers(args.workspace)
+  if args.daemon:
+    from base import daemon
+    preload()
+    daemon.serve(main, args.daemon_socket, args.daemon_jobs)
+    return 0
+  if args.profile_startup:
+    logger.info(f"startup took {(time.perf_counter() - STARTUP) * 1000:.1f}ms until the action")
+  build_cfg = base.BuildConfigure(args.platform, args.arch, args.workspace, args.prefix, args.action, args.jobs,
+                                  args.git_mirror_dir, args.clone_mode, args.compiler_cache, args.store_dir)
+  try:
+    with trace.span(build_cfg.action, "main", platform=build_cfg.platform):
+      if build_cfg.action == "build":
+        libraries = args.library.replace(",", " ").split() or [DEFAULT_LIBRARY]
+        if args.dry_run:
+          ok = plan_libraries(build_cfg, libraries)
+        else:
+          ok = build_libraries(build_cfg, libraries)
+      elif build_cfg.action == "install":
+        libraries = args.library.replace(",", " ").split() or [DEFAULT_LIBRARY]
+        ok = install_libraries(build_cfg, libraries)
+      elif build_cfg.action == "watch":
+        ok = watch_library(build_cfg, (args.library.replace(",", " ").split() or [DEFAULT_LIBRARY])[0])
+      elif build_cfg.action == "triage":
+        ok = triage_failures(build_cfg, (args.library.replace(",", " ").split() or [DEFAULT_LIBRARY])[0])
+      elif build_cfg.action == "restore":
+        ok = restore_library(build_cfg, (args.library.replace(",", " ").split() or [DEFAULT_LIBRARY])[0], args.build_id)
+      elif build_cfg.action == "check-patches":
+        # every library which has patches by default
+        libraries = args.library.replace(",", " ").split()
+        ok = check_library_patches(build_cfg, libraries, [c for c in args.patch_commits.split(",") if c])
+      else:
+        from base.scheduler import expand_archs
+        toolchain_vars, host_vars = base.get_platform_envs(expand_archs(build_cfg)[0])
+        preapre_workspaces(build_cfg)
+
+        ffmpeg_module = PY_MODULES[DEFAULT_LIBRARY].load()(build_cfg, toolchain_vars, host_vars)
+          #   "repo": "https://github.com/FFmpeg/FFmpeg.git",
+          # "repo_env": "REPO_FFMPEG",
+          # "repo_save_dir": "FFmpeg"
+        ffconfig=ffmpeg_module.get_module_config()
+        repo = os.environ.get(ffconfig["repo_env"], ffconfig['repo'])
+        repo_save_dir= os.path.join(build_cfg.get_samples_dir(), ffconfig['repo_save_dir'])
+        with trace.context(library=ffconfig["name"]):
+          ffmpeg_module.init_sample_repo(repo, repo_save_dir)
+        ok = True
+  finally:
+    if args.profile_startup:
+      report_imports()
+    if args.trace:
+      trace.get_tracer().export(args.trace)
+      logger.info(f"trace written to {args.trace}, summary to {trace.summary_path(args.trace)}")
+  return 0 if ok else 1
+
 if __name__ == "__main__":
-  args = parse_args()
-  logger = setup_loggers("build.log")
-  build_cfg = base.BuildConfigure(args.platform, args.arch, args.workspace, args.prefix, args.action)
-  toolchain_vars, host_vars = base.get_platform_envs(build_cfg)
-  preapre_workspaces(build_cfg)
-
-  ffmpeg_module = module_ffmpeg.FFMpegModule(build_cfg, toolchain_vars, host_vars)
-    #   "repo": "https://github.com/FFmpeg/FFmpeg.git",
-    # "repo_env": "REPO_FFMPEG",
-    # "repo_save_dir": "FFmpeg"
-  ffconfig=ffmpeg_module.get_module_config()
-  repo = os.environ.get(ffconfig["repo_env"], ffconfig['repo'])
-  repo_save_dir= os.path.join(build_cfg.get_samples_dir(), ffconfig['repo_save_dir'])
-  ffmpeg_module.init_sample_repo(repo, repo_save_dir)
-  
-  # print(base.get_platform_envs(args))
-  pass
\ No newline at end of file
+  sys.exit(main())
@@ -1,8 +1,55 @@
+import logging
 import os
-import subprocess
 # import config
 from .config import *
+from .flags import compile_profile
 from base import *
+from base import trace
+from base.compiler_cache import CompilerCacheSession, launcher_env
+from base.configure_cache import ConfigureCache, configure_fingerprint
+from base.graph import FFMPEG_DEPENDS, SHELL_ROOT_DIR
+
+# files generated by ./configure, relative to the source
+CONFIGURE_OUTPUTS = [
+    "config.h",
+    "config_components.h",
+    "ffbuild/config.mak",
+    "ffbuild/config.sh",
+    "ffbuild/config_components.mak",
+    "doc/config.texi",
+    "libavutil/avconfig.h",
+    "libavutil/ffversion.h",
+    "libavcodec/codec_list.c",
+    "libavcodec/parser_list.c",
+    "libavcodec/bsf_list.c",
+    "libavformat/demuxer_list.c",
+    "libavformat/muxer_list.c",
+    "libavformat/protocol_list.c",
+    "libavdevice/indev_list.c",
+    "libavdevice/outdev_list.c",
+    "libavfilter/filter_list.c",
+]
+
+# files of the source read by ./configure, relative to the source. the patch series changes
+# configure through them, other sources only need make
+CONFIGURE_INPUTS = [
+    "configure",
+    "VERSION",
+    "RELEASE",
+    "ffbuild/arch.mak",
+    "ffbuild/common.mak",
+    "ffbuild/library.mak",
+    "ffbuild/libversion.sh",
+    "ffbuild/pkgconfig_generate.sh",
+    "ffbuild/version.sh",
+    "libavcodec/allcodecs.c",
+    "libavcodec/parsers.c",
+    "libavcodec/bitstream_filters.c",
+    "libavformat/allformats.c",
+    "libavformat/protocols.c",
+    "libavdevice/alldevices.c",
+    "libavfilter/allfilters.c",
+]
 
 MODULE_CONFIG = {
     "name": "ffmpeg",
@@ -16,82 +63,137 @@ MODULE_CONFIG = {
     ],
     "repo": "https://github.com/FFmpeg/FFmpeg.git",
     "repo_env": "REPO_FFMPEG",
+    "commit": "n7.1.1",
+    "commit_env": "GIT_FFMPEG_COMMIT",
     "repo_save_dir": "ffmpeg7",
     "has_submodule": False,
-    "patch_dir":"ffmpeg-n7.1.1"
+    "patch_dir":"ffmpeg-n7.1.1",
+    # configs/libs/<prebuilt_config>.sh names the prebuilt release
+    "prebuilt_config": "ffmpeg7",
+    # configure profile of config.py, or shell:<name> of configs/ffconfig
+    "profile": DEFAULT_PROFILE,
+    "profile_env": "MR_FFMPEG_PROFILE",
+    # e.g. "mp4,hls,h264,aac,https", only the decoders, demuxers, parsers and protocols they need are built
+    "formats_env": "MR_FFMPEG_FORMATS",
+    "depends": FFMPEG_DEPENDS,
+    # written by the build, never shared with the sample
+    "private_files": CONFIGURE_OUTPUTS,
 }
 
 
 
-def wait_proc(proc:subprocess.Popen):
-  sto, ste = proc.communicate()
-  if proc.returncode != 0 :
-    print(f"Error output:\n{ste}")
-    return False
-  return True
+
+def run_step(step: str, command: list, source_path: str, env: dict, logger, timeout: float = None, jobserver=None):
+  """run one build step, output is streamed to logger and <arch workspace>/logs/ffmpeg/<step>.jsonl,
+  see base.buildlog. with a jobserver the step holds one token and make takes the others from the shared pool.
+  """
+  with trace.span(step, "step"):
+    if jobserver:
+      with jobserver.slot():
+        _run_step(step, command, source_path, jobserver.client_env(env), logger, timeout, jobserver.pass_fds())
+    else:
+      _run_step(step, command, source_path, env, logger, timeout)
+
+def _run_step(step: str, command: list, source_path: str, env: dict, logger, timeout: float = None, pass_fds: tuple = ()):
+  # asyncio is only loaded when a step really runs
+  from base import buildlog, proc
+  arch_workspace = os.path.dirname(os.path.abspath(source_path))
+  stream = buildlog.Stream(arch_workspace, MODULE_CONFIG["name"], os.path.basename(arch_workspace), step)
+  try:
+    res = proc.run(command, cwd=source_path, env=env, logger=logger, timeout=timeout, pass_fds=pass_fds, sink=stream.write)
+  finally:
+    stream.close()
+  # a timeout leaves no index, its output has no error to find
+  index = buildlog.index_stream(stream, res.returncode, source_path)
+  if not res.ok:
+    logger.error(f"{step} failed with {res.returncode}, last output:\n{res.tail_text()}\n"
+                 f"{buildlog.format_triage(index)}")
+    raise SystemError(f"{step} {source_path} has failed!")
 
 # before build
 def detect_openssl():
   pass
 
 # building
-def build_repo_android(source_path: str, install_prefix: str, toolchain_vars: dict, force_re_compile: bool = False):
+def build_repo_android(source_path: str, install_prefix: str, toolchain_vars: dict, force_re_compile: bool = False,
+                       jobs: int = 8, logger=None, step_timeout: float = None, jobserver=None, cfg_flags: list = None):
     if not os.path.exists(source_path):
         raise IOError(f"Can not find source {source_path}, clone first!")
-    old_wk_dir = os.getcwd()
-    os.chdir(source_path)
+    logger = logger or logging.getLogger('build')
+    # 多个 arch 会在不同线程同时编译，不能 chdir，子进程通过 cwd 指定目录
     try:
         # 复制当前环境变量并添加 toolchain_vars 中的变量
         env = os.environ.copy()
         env.update(toolchain_vars)
-        if not os.path.exists("config.h") or force_re_compile:
-          # 构建命令参数
-          cfg_flags = configs
-          triple_cc = env.get('TRIPLE_CC', '')
-          ar = env.get('AR', '')
-          nm = env.get('NM', '')
-          strip = env.get('STRIP', '')
-          ranlib = env.get('RANLIB', '')
-          c_flags = env.get('C_FLAGS', '')
-          ldflags = env.get('LDFLAGS', '')
-          mr_pkg_config_executable = env.get('PKG_CONFIG_EXECUTABLE', '')
-
-          command = [
-              './configure',
-              *cfg_flags, # * 是解包操作符，会把序列容器中的元素解出来
-              f'--cc={triple_cc}',
-              f'--as={triple_cc}',
-              f'--ld={triple_cc}',
-              f'--ar={ar}',
-              f'--nm={nm}',
-              f'--strip={strip}',
-              f'--ranlib={ranlib}',
-              f'--extra-cflags={c_flags}',
-              f'--extra-cxxflags={c_flags}',
-              f'--extra-ldflags={ldflags}',
-              f'--pkg-config={mr_pkg_config_executable}'
-              f'--prefix={install_prefix}'
-          ]
-
-          # 启动子进程
-          process = subprocess.Popen(
-              command,
-              env=env,
-              stdout=subprocess.PIPE,
-              stderr=subprocess.PIPE,
-              text=True
-          )
-          if not wait_proc(process):
-            raise SystemError(f"Configure {source_path} has failed!")
-        proc=subprocess.Popen(["make V=1", "-j8"], env=env,stdout=subprocess.PIPE,stderr=subprocess.PIPE, text=True)
-        if not wait_proc(proc):
-          raise SystemError(f"Make failed!")
+        # 构建命令参数
+        cfg_flags = cfg_flags if cfg_flags is not None else compile_profile(PROFILES, DEFAULT_PROFILE, "android")
+        triple_cc = env.get('TRIPLE_CC', '')
+        ar = env.get('AR', '')
+        nm = env.get('NM', '')
+        strip = env.get('STRIP', '')
+        ranlib = env.get('RANLIB', '')
+        c_flags = env.get('C_FLAGS', '')
+        ldflags = env.get('LDFLAGS', '')
+        mr_pkg_config_executable = env.get('PKG_CONFIG_EXECUTABLE', '')
+        launcher = env.get('CC_LAUNCHER', '')
+        cc = f"{launcher} {triple_cc}" if launcher else triple_cc
+        triple_cxx = env.get('TRIPLE_CXX', '')
+        cxx = f"{launcher} {triple_cxx}" if launcher else triple_cxx
+
+        command = [
+            './configure',
+            *cfg_flags, # * 是解包操作符，会把序列容器中的元素解出来
+            f'--cc={cc}',
+            f'--cxx={cxx}',
+            f'--as={triple_cc}',
+            f'--ld={triple_cc}',
+            f'--ar={ar}',
+            f'--nm={nm}',
+            f'--strip={strip}',
+            f'--ranlib={ranlib}',
+            f'--extra-cflags={c_flags}',
+            f'--extra-cxxflags={c_flags}',
+            f'--extra-ldflags={ldflags}',
+            f'--pkg-config={mr_pkg_config_executable}',
+            f'--prefix={install_prefix}'
+        ]
+
+        if launcher:
+          stats_log = os.path.join(os.path.dirname(os.path.abspath(source_path)), "logs", "compiler-cache-stats.log")
+          os.makedirs(os.path.dirname(stats_log), exist_ok=True)
+          env.update(launcher_env(launcher, source_path, stats_log))
+
+        # config.h 存在不代表配置没变，用命令行、环境变量和 configure 读取的源码文件的指纹判断
+        cfg_cache = ConfigureCache(source_path, CONFIGURE_OUTPUTS)
+        fingerprint = configure_fingerprint(command, env, source_path, CONFIGURE_INPUTS)
+        if cfg_cache.is_configured(fingerprint) and not force_re_compile:
+          logger.info(f"{source_path} is configured already, skip configure")
+        elif not force_re_compile and cfg_cache.restore(fingerprint):
+          logger.info(f"{source_path} configure restored from snapshot")
+        else:
+          cfg_cache.invalidate()
+          run_step("configure", command, source_path, env, logger, step_timeout, jobserver)
+          cfg_cache.save(fingerprint)
+        # only compilations of make are counted, not the probes of configure
+        cache_session = CompilerCacheSession(launcher, stats_log, env) if launcher else None
+        if jobserver:
+          # -jN on the command line would start a private jobserver, MAKEFLAGS carries the shared one
+          logger.info(f"make {source_path} with the shared jobserver of {jobserver.tokens} tokens")
+          make_jobs = []
+        else:
+          logger.info(f"make {source_path} with {jobs} jobs")
+          make_jobs = [f"-j{jobs}"]
+        run_step("make", ["make", "V=1", *make_jobs], source_path, env, logger, step_timeout, jobserver)
+        run_step("install", ["make", "install", *make_jobs], source_path, env, logger, step_timeout, jobserver)
+        if cache_session:
+          stats = cache_session.stats()
+          logger.info(f"compiler cache of {source_path}: {stats}")
+          return stats
+        return None
         
     except Exception as e:
-      print(f"An error occurred: {e}")
+      logger.error(f"An error occurred: {e}")
       raise
-    finally:
-      os.chdir(old_wk_dir)
       
 # after build
 
@@ -102,20 +204,35 @@ class FFMpegModule(FFModule):
   
   def get_module_config(self):
     return MODULE_CONFIG
+
+  def get_build_flags(self):
+    """the normalized configure flags of the profile for this platform and arch
+    """
+    profile = os.environ.get(MODULE_CONFIG["profile_env"]) or MODULE_CONFIG["profile"]
+    formats = os.environ.get(MODULE_CONFIG["formats_env"], "").replace(",", " ").split()
+    shell_dir = os.path.join(SHELL_ROOT_DIR, "configs", "ffconfig")
+    return compile_profile(PROFILES, profile, self.cfg.platform, self.cfg.arch, formats, shell_dir)
   
 
-  def do_init():
+  def do_init(self):
     """do the initialization
     1. clone the source code, or download the library
     2. prepare all the patches
     """
     pass
 
-  def do_install_prebuilt():
+  def do_install_prebuilt(self):
     """install the prebuilt libraries
     if no prebuilt, an error will be raised.
     """
-    pass
+    from base.prebuilt import PrebuiltInstaller, prebuilt_archives
+    from base.store import open_store
+    config_path = os.path.join(SHELL_ROOT_DIR, "configs", "libs", f"{MODULE_CONFIG['prebuilt_config']}.sh")
+    archives = prebuilt_archives(config_path, self.cfg.platform, self.cfg.workspace, self.cfg.arch)
+    results = PrebuiltInstaller(self.cfg.get_jobs(), store=open_store(self.cfg.artifact_store)).install(archives)
+    failed = [res.error for res in results if not res.ok]
+    if failed:
+      raise InstallError(f"Install prebuilt {MODULE_CONFIG['name']} failed: {failed}")
   
   def prebuild(self):
     """jobs before building
@@ -124,7 +241,8 @@ class FFMpegModule(FFModule):
     3. detect and setup third libraries
     4. prepare the directories
     """
-    pass
+    self.sync_arch_source()
+    os.makedirs(self.cfg.get_arch_install_prefix(), exist_ok=True)
   
   def build(self, toolchain_vars: dict, host_vars: dict):
     """do the build work
@@ -133,10 +251,33 @@ class FFMpegModule(FFModule):
         toolchain_vars (dict): the detected toolchain variables
         host_vars: the detected host variables
     """
-    pass
+    self.compiler_cache_stats = build_repo_android(self.get_arch_source_dir(), self.cfg.get_arch_install_prefix(), toolchain_vars,
+                       jobs=self.cfg.get_jobs(), logger=self.logger, jobserver=self.jobserver,
+                       cfg_flags=self.get_build_flags())
   
   def postbuild(self):
     """dirty works after build
     """
-    pass
+    from base.pkgconfig import relocate_tree
+    relocate_tree(self.cfg.get_arch_install_prefix(), self.cfg.get_jobs())
+    # before store_prefix, a build which grew too much is not stored, nor cached by the scheduler
+    self.report_footprint()
+    self.store_prefix()
+
+  def report_footprint(self):
+    """size and symbols of the built libraries, diffed against MR_FOOTPRINT_BASELINE or the previous build
+    MR_FOOTPRINT_MAX_GROWTH fails the build when the libraries grew by more bytes
+    """
+    from base import footprint, planner
+    tools = {"size": self.toolchain.size, "nm": self.toolchain.nm, "readelf": self.toolchain.readelf}
+    with trace.span("footprint", "module"):
+      report = footprint.analyze(self.cfg.get_arch_install_prefix(), tools, self.get_arch_source_dir(),
+                                 self.get_module_patch_dir(), self.cfg.get_jobs(),
+                                 # the prefix is shared, the libraries of the shell driver are not ours
+                                 planner.read_installed_files(self.cfg, MODULE_CONFIG["name"]))
+      report_path = os.path.join(self.cfg.get_arch_workspace(), "footprint", f"{MODULE_CONFIG['name']}.json")
+      diff = footprint.write_report(report, report_path, os.environ.get("MR_FOOTPRINT_BASELINE", ""))
+    self.logger.info(f"footprint of {len(report['libraries'])} libraries: {report['total']} bytes, see {report_path}")
+    footprint.check_growth(diff, int(os.environ.get("MR_FOOTPRINT_MAX_GROWTH", "0") or 0), report_path,
+                           self.cfg.get_arch_install_prefix())
   
\ No newline at end of file
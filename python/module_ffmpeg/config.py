@@ -1,260 +1,309 @@
-configs= [
-#--------------------
-# Standard options:
+"""configure profiles of ffmpeg, compiled by flags.compile_profile
 
-# " --prefix=PREFIX",
+"common" holds the options every build shares, "lite" the components of the
+player, which is what this file listed before. the shell variants in
+configs/ffconfig are available as `shell:<name>`, e.g. shell:module-full.
+"""
+from .flags import Profile
 
-# Licensing options:
-" --disable-gpl",
-# " --enable-version3",
-" --disable-nonfree",
+COMMON_FLAGS = [
+  # Standard options:
+  # "--prefix=PREFIX",
 
-# Configuration options:
-# " --disable-static",
-# " --enable-shared",
-# " --enable-small",
-" --enable-runtime-cpudetect",
-" --disable-gray",
-" --disable-swscale-alpha",
+  # Licensing options:
+  "--disable-gpl",
+  # "--enable-version3",
+  "--disable-nonfree",
 
-# Program options:
-" --disable-programs",
-" --disable-ffmpeg",
-" --disable-ffplay",
-" --disable-ffprobe",
-#" --disable-ffserver",
+  # Configuration options:
+  # "--disable-static",
+  # "--enable-shared",
+  # "--enable-small",
+  "--enable-runtime-cpudetect",
+  "--disable-gray",
+  "--disable-swscale-alpha",
 
-# Documentation options:
-" --disable-doc",
-" --disable-htmlpages",
-" --disable-manpages",
-" --disable-podpages",
-" --disable-txtpages",
+  # Program options:
+  "--disable-programs",
+  "--disable-ffmpeg",
+  "--disable-ffplay",
+  "--disable-ffprobe",
+  # "--disable-ffserver",
 
-# Component options:
-" --disable-avdevice",
-" --enable-avcodec",
-" --enable-avformat",
-" --enable-avutil",
-" --enable-swresample",
-" --enable-swscale",
-" --disable-postproc",
-" --enable-avfilter",
-" --disable-avresample",
-# " --disable-pthreads",
-# " --disable-w32threads",
-# " --disable-os2threads",
-" --enable-network",
-# " --disable-dct",
-# " --disable-dwt",
-# " --disable-lsp",
-# " --disable-lzo",
-# " --disable-mdct",
-# " --disable-rdft",
-# " --disable-fft",
+  # Documentation options:
+  "--disable-doc",
+  "--disable-htmlpages",
+  "--disable-manpages",
+  "--disable-podpages",
+  "--disable-txtpages",
 
-# Hardware accelerators:
-" --disable-d3d11va",
-" --disable-dxva2",
-" --disable-vaapi",
-#" --disable-vda",
-" --disable-vdpau",
-" --disable-videotoolbox",
+  # Component options:
+  "--disable-avdevice",
+  "--enable-avcodec",
+  "--enable-avformat",
+  "--enable-avutil",
+  "--enable-swresample",
+  "--enable-swscale",
+  "--disable-postproc",
+  "--enable-avfilter",
+  "--disable-avresample",
+  # "--disable-pthreads",
+  # "--disable-w32threads",
+  # "--disable-os2threads",
+  "--enable-network",
+  # "--disable-dct",
+  # "--disable-dwt",
+  # "--disable-lsp",
+  # "--disable-lzo",
+  # "--disable-mdct",
+  # "--disable-rdft",
+  # "--disable-fft",
 
-# Individual component options:
-# " --disable-everything",
-" --disable-encoders",
-" --enable-encoder=png",
+  # Hardware accelerators:
+  "--disable-d3d11va",
+  "--disable-dxva2",
+  "--disable-vaapi",
+  # "--disable-vda",
+  "--disable-vdpau",
+  "--disable-videotoolbox",
 
-# ./configure --list-decoders
-" --disable-decoders",
-" --enable-decoder=aac",
-" --enable-decoder=aac_latm",
-" --enable-decoder=flv",
-" --enable-decoder=h264",
-" --enable-decoder=mp3*",
-" --enable-decoder=vp6f",
-" --enable-decoder=flac",
-" --enable-decoder=hevc",
-" --enable-decoder=vp8",
-" --enable-decoder=vp9",
-" --enable-demuxer=ijk*",
+  # External library support:
+  "--disable-iconv",
+  "--disable-audiotoolbox",
+  # "--disable-videotoolbox", see Hardware accelerators
 
-" --disable-hwaccels",
+  # Advanced options (experts only):
+  # "--cross-prefix=${FF_CROSS_PREFIX}-",
+  # "--enable-cross-compile",
+  # "--sysroot=PATH",
+  # "--sysinclude=PATH",
+  # "--target-os=TAGET_OS",
+  # "--target-exec=CMD",
+  # "--target-path=DIR",
+  # "--toolchain=NAME",
+  # "--nm=NM",
+  # "--ar=AR",
+  # "--as=AS",
+  # "--yasmexe=EXE",
+  # "--cc=CC",
+  # "--cxx=CXX",
+  # "--dep-cc=DEPCC",
+  # "--ld=LD",
+  # "--host-cc=HOSTCC",
+  # "--host-cflags=HCFLAGS",
+  # "--host-cppflags=HCPPFLAGS",
+  # "--host-ld=HOSTLD",
+  # "--host-ldflags=HLDFLAGS",
+  # "--host-libs=HLIBS",
+  # "--host-os=OS",
+  # "--extra-cflags=ECFLAGS",
+  # "--extra-cxxflags=ECFLAGS",
+  # "--extra-ldflags=ELDFLAGS",
+  # "--extra-libs=ELIBS",
+  # "--extra-version=STRING",
+  # "--optflags=OPTFLAGS",
+  # "--build-suffix=SUFFIX",
+  # "--malloc-prefix=PREFIX",
+  # "--progs-suffix=SUFFIX",
+  # "--arch=ARCH",
+  # "--cpu=CPU",
+  # "--enable-pic",
+  # "--enable-sram",
+  # "--enable-thumb",
+  # "--disable-symver",
+  # "--enable-hardcoded-tables",
+  # "--disable-safe-bitstream-reader",
+  # "--enable-memalign-hack",
+  # "--enable-lto",
 
-# ./configure --list-muxers
-" --disable-muxers",
-" --enable-muxer=mp4",
+  # Optimization options (experts only):
+  # "--enable-asm",
+  # "--disable-altivec",
+  # "--disable-amd3dnow",
+  # "--disable-amd3dnowext",
+  # "--disable-mmx",
+  # "--disable-mmxext",
+  # "--disable-sse",
+  # "--disable-sse2",
+  # "--disable-sse3",
+  # "--disable-ssse3",
+  # "--disable-sse4",
+  # "--disable-sse42",
+  # "--disable-avx",
+  # "--disable-fma4",
+  # "--disable-armv5te",
+  # "--disable-armv6",
+  # "--disable-armv6t2",
+  # "--disable-vfp",
+  # "--disable-neon",
+  # "--disable-vis",
+  # "--enable-inline-asm",
+  # "--disable-yasm",
+  # "--disable-mips32r2",
+  # "--disable-mipsdspr1",
+  # "--disable-mipsdspr2",
+  # "--disable-mipsfpu",
+  # "--disable-fast-unaligned",
 
-# ./configure --list-demuxers
-" --disable-demuxers",
-" --enable-demuxer=aac",
-" --enable-demuxer=concat",
-" --enable-demuxer=data",
-" --enable-demuxer=flv",
-" --enable-demuxer=hls",
-" --enable-demuxer=live_flv",
-" --enable-demuxer=mov",
-" --enable-demuxer=mp3",
-" --enable-demuxer=mpegps",
-" --enable-demuxer=mpegts",
-" --enable-demuxer=mpegvideo",
-" --enable-demuxer=flac",
-" --enable-demuxer=hevc",
-" --enable-demuxer=webm_dash_manifest",
+  # Developer options (useful when working on FFmpeg itself):
+  # "--enable-coverage",
+  # "--disable-debug",
+  # "--enable-debug=LEVEL",
+  # "--disable-optimizations",
+  # "--enable-extra-warnings",
+  # "--disable-stripping",
+  # "--assert-level=level",
+  # "--enable-memory-poisoning",
+  # "--valgrind=VALGRIND",
+  # "--enable-ftrapv",
+  # "--samples=PATH",
+  # "--enable-xmm-clobber-test",
+  # "--enable-random",
+  # "--disable-random",
+  # "--enable-random=LIST",
+  # "--disable-random=LIST",
+  # "--random-seed=VALUE",
+  "--disable-linux-perf",
+  "--disable-bzlib",
+]
+
+# configs/ffconfig/auto-detect-third-libs.sh adds these per platform
+PLATFORM_FLAGS = {
+  "android": [
+    # enable mediacodec hwaccel
+    "--enable-jni",
+    "--enable-mediacodec",
+    "--enable-decoder=h264_mediacodec",
+    "--enable-hwaccel=h264_mediacodec",
+    "--enable-decoder=hevc_mediacodec",
+    "--enable-hwaccel=hevc_mediacodec",
+    "--disable-iconv",
+    "--disable-bzlib",
+  ],
+  "android/arm64": ["--enable-neon", "--enable-asm", "--enable-inline-asm"],
+  "android/armv7a": ["--enable-neon", "--enable-asm", "--enable-inline-asm"],
+  "android/x86": ["--disable-neon", "--disable-asm", "--disable-inline-asm"],
+  "android/x86_64": ["--disable-neon", "--disable-asm", "--disable-inline-asm"],
+}
+for _plat in ["ios", "tvos", "macos"]:
+  PLATFORM_FLAGS[_plat] = [
+    "--enable-neon",
+    "--enable-asm",
+    "--enable-inline-asm",
+    # enable videotoolbox hwaccel
+    "--enable-videotoolbox",
+    "--enable-hwaccel=*_videotoolbox",
+    "--enable-iconv",
+  ]
 
-# ./configure --list-parsers
-" --disable-parsers",
-" --enable-parser=aac",
-" --enable-parser=aac_latm",
-" --enable-parser=h264",
-" --enable-parser=flac",
-" --enable-parser=hevc",
+LITE_FLAGS = [
+  # Individual component options:
+  # "--disable-everything",
+  "--disable-encoders",
+  "--enable-encoder=png",
 
-# ./configure --list-bsf
-" --enable-bsfs",
-" --disable-bsf=chomp",
-" --disable-bsf=dca_core",
-" --disable-bsf=dump_extradata",
-" --disable-bsf=hevc_mp4toannexb",
-" --disable-bsf=imx_dump_header",
-" --disable-bsf=mjpeg2jpeg",
-" --disable-bsf=mjpega_dump_header",
-" --disable-bsf=mov2textsub",
-" --disable-bsf=mp3_header_decompress",
-" --disable-bsf=mpeg4_unpack_bframes",
-" --disable-bsf=noise",
-" --disable-bsf=remove_extradata",
-" --disable-bsf=text2movsub",
-" --disable-bsf=vp9_superframe",
-" --disable-bsf=eac3_core",
+  # ./configure --list-decoders
+  "--disable-decoders",
+  "--enable-decoder=aac",
+  "--enable-decoder=aac_latm",
+  "--enable-decoder=flv",
+  "--enable-decoder=h264",
+  "--enable-decoder=mp3*",
+  "--enable-decoder=vp6f",
+  "--enable-decoder=flac",
+  "--enable-decoder=hevc",
+  "--enable-decoder=vp8",
+  "--enable-decoder=vp9",
+  # "--enable-demuxer=ijk*", cancelled by --disable-demuxers below
 
-# ./configure --list-protocols
-" --enable-protocols",
-" --enable-protocol=async",
-" --disable-protocol=bluray",
-" --disable-protocol=concat",
-" --disable-protocol=crypto",
-" --disable-protocol=ffrtmpcrypt",
-" --enable-protocol=ffrtmphttp",
-" --disable-protocol=gopher",
-" --disable-protocol=icecast",
-" --disable-protocol=librtmp*",
-" --disable-protocol=libssh",
-" --disable-protocol=md5",
-" --disable-protocol=mmsh",
-" --disable-protocol=mmst",
-" --disable-protocol=rtmp*",
-" --enable-protocol=rtmp",
-" --enable-protocol=rtmpt",
-" --disable-protocol=rtp",
-" --disable-protocol=sctp",
-" --disable-protocol=srtp",
-" --disable-protocol=subfile",
-" --disable-protocol=unix",
+  "--disable-hwaccels",
 
-#
-" --disable-devices",
-" --disable-filters",
+  # ./configure --list-muxers
+  "--disable-muxers",
+  "--enable-muxer=mp4",
 
-# External library support:
-" --disable-iconv",
-" --disable-audiotoolbox",
-" --disable-videotoolbox",
+  # ./configure --list-demuxers
+  "--disable-demuxers",
+  "--enable-demuxer=aac",
+  "--enable-demuxer=concat",
+  "--enable-demuxer=data",
+  "--enable-demuxer=flv",
+  "--enable-demuxer=hls",
+  "--enable-demuxer=live_flv",
+  "--enable-demuxer=mov",
+  "--enable-demuxer=mp3",
+  "--enable-demuxer=mpegps",
+  "--enable-demuxer=mpegts",
+  "--enable-demuxer=mpegvideo",
+  "--enable-demuxer=flac",
+  "--enable-demuxer=hevc",
+  "--enable-demuxer=webm_dash_manifest",
 
-# ...
+  # ./configure --list-parsers
+  "--disable-parsers",
+  "--enable-parser=aac",
+  "--enable-parser=aac_latm",
+  "--enable-parser=h264",
+  "--enable-parser=flac",
+  "--enable-parser=hevc",
 
-# Advanced options (experts only):
-# " --cross-prefix=${FF_CROSS_PREFIX}-",
-# " --enable-cross-compile",
-# " --sysroot=PATH",
-# " --sysinclude=PATH",
-# " --target-os=TAGET_OS",
-# " --target-exec=CMD",
-# " --target-path=DIR",
-# " --toolchain=NAME",
-# " --nm=NM",
-# " --ar=AR",
-# " --as=AS",
-# " --yasmexe=EXE",
-# " --cc=CC",
-# " --cxx=CXX",
-# " --dep-cc=DEPCC",
-# " --ld=LD",
-# " --host-cc=HOSTCC",
-# " --host-cflags=HCFLAGS",
-# " --host-cppflags=HCPPFLAGS",
-# " --host-ld=HOSTLD",
-# " --host-ldflags=HLDFLAGS",
-# " --host-libs=HLIBS",
-# " --host-os=OS",
-# " --extra-cflags=ECFLAGS",
-# " --extra-cxxflags=ECFLAGS",
-# " --extra-ldflags=ELDFLAGS",
-# " --extra-libs=ELIBS",
-# " --extra-version=STRING",
-# " --optflags=OPTFLAGS",
-# " --build-suffix=SUFFIX",
-# " --malloc-prefix=PREFIX",
-# " --progs-suffix=SUFFIX",
-# " --arch=ARCH",
-# " --cpu=CPU",
-# " --enable-pic",
-# " --enable-sram",
-# " --enable-thumb",
-# " --disable-symver",
-# " --enable-hardcoded-tables",
-# " --disable-safe-bitstream-reader",
-# " --enable-memalign-hack",
-# " --enable-lto",
+  # ./configure --list-bsf
+  "--enable-bsfs",
+  "--disable-bsf=chomp",
+  "--disable-bsf=dca_core",
+  "--disable-bsf=dump_extradata",
+  "--disable-bsf=hevc_mp4toannexb",
+  "--disable-bsf=imx_dump_header",
+  "--disable-bsf=mjpeg2jpeg",
+  "--disable-bsf=mjpega_dump_header",
+  "--disable-bsf=mov2textsub",
+  "--disable-bsf=mp3_header_decompress",
+  "--disable-bsf=mpeg4_unpack_bframes",
+  "--disable-bsf=noise",
+  "--disable-bsf=remove_extradata",
+  "--disable-bsf=text2movsub",
+  "--disable-bsf=vp9_superframe",
+  "--disable-bsf=eac3_core",
 
-# Optimization options (experts only):
-# " --enable-asm",
-# " --disable-altivec",
-# " --disable-amd3dnow",
-# " --disable-amd3dnowext",
-# " --disable-mmx",
-# " --disable-mmxext",
-# " --disable-sse",
-# " --disable-sse2",
-# " --disable-sse3",
-# " --disable-ssse3",
-# " --disable-sse4",
-# " --disable-sse42",
-# " --disable-avx",
-# " --disable-fma4",
-# " --disable-armv5te",
-# " --disable-armv6",
-# " --disable-armv6t2",
-# " --disable-vfp",
-# " --disable-neon",
-# " --disable-vis",
-# " --enable-inline-asm",
-# " --disable-yasm",
-# " --disable-mips32r2",
-# " --disable-mipsdspr1",
-# " --disable-mipsdspr2",
-# " --disable-mipsfpu",
-# " --disable-fast-unaligned",
+  # ./configure --list-protocols
+  "--enable-protocols",
+  "--enable-protocol=async",
+  "--disable-protocol=bluray",
+  "--disable-protocol=concat",
+  "--disable-protocol=crypto",
+  "--disable-protocol=ffrtmpcrypt",
+  "--enable-protocol=ffrtmphttp",
+  "--disable-protocol=gopher",
+  "--disable-protocol=icecast",
+  "--disable-protocol=librtmp*",
+  "--disable-protocol=libssh",
+  "--disable-protocol=md5",
+  "--disable-protocol=mmsh",
+  "--disable-protocol=mmst",
+  "--disable-protocol=rtmp*",
+  "--enable-protocol=rtmp",
+  "--enable-protocol=rtmpt",
+  "--disable-protocol=rtp",
+  "--disable-protocol=sctp",
+  "--disable-protocol=srtp",
+  "--disable-protocol=subfile",
+  "--disable-protocol=unix",
 
-# Developer options (useful when working on FFmpeg itself):
-# " --enable-coverage",
-# " --disable-debug",
-# " --enable-debug=LEVEL",
-# " --disable-optimizations",
-# " --enable-extra-warnings",
-# " --disable-stripping",
-# " --assert-level=level",
-# " --enable-memory-poisoning",
-# " --valgrind=VALGRIND",
-# " --enable-ftrapv",
-# " --samples=PATH",
-# " --enable-xmm-clobber-test",
-# " --enable-random",
-# " --disable-random",
-# " --enable-random=LIST",
-# " --disable-random=LIST",
-# " --random-seed=VALUE",
-" --disable-linux-perf",
-" --disable-bzlib",
+  "--disable-devices",
+  "--disable-filters",
 ]
+
+PROFILES = {
+  "common": Profile("common", flags=COMMON_FLAGS, conditions=PLATFORM_FLAGS),
+  "lite": Profile("lite", "common", LITE_FLAGS),
+  # configs/ffconfig/module-program.sh
+  "program": Profile("program", "shell:module-full", [
+    "--enable-avdevice",
+    "--enable-avfilter",
+    "--enable-sdl2",
+    "--enable-ffmpeg",
+    "--enable-ffplay",
+    "--enable-ffprobe",
+  ]),
+}
+DEFAULT_PROFILE = "lite"
@@ -0,0 +1,271 @@
+"""compile the ffmpeg configure profiles into an argument vector
+
+a profile is a list of configure flags, the profile it inherits from and the
+flags added on a platform ("android") or an arch ("android/arm64"). compiling
+resolves the chain and normalizes the result the way ./configure reads it:
+
+  - the last flag of the same switch or option wins, duplicates go away
+  - a blanket flag (--disable-decoders) cancels the earlier flags of its kind,
+    a wildcard (--disable-protocol=rtmp*) the earlier names it matches and a
+    disabled group of components (--disable-everything) the earlier components
+  - the output is ordered: switches, the group switches and their members
+    (--disable-programs, --enable-ffmpeg) in the order they are given, then per
+    component kind the blanket, wildcards and names, then options. the rest is sorted
+
+so two profiles which mean the same thing give the same vector, which keeps
+the configure fingerprint and the build cache key stable.
+"""
+from dataclasses import dataclass, field
+from fnmatch import fnmatchcase
+import os
+import re
+
+from base import ConfigureError
+
+# kind of `--enable-<kind>=<names>`, with the plural of the blanket switch
+COMPONENT_KINDS = {
+  "encoder": "encoders",
+  "decoder": "decoders",
+  "hwaccel": "hwaccels",
+  "muxer": "muxers",
+  "demuxer": "demuxers",
+  "parser": "parsers",
+  "bsf": "bsfs",
+  "protocol": "protocols",
+  "indev": "indevs",
+  "outdev": "outdevs",
+  "filter": "filters",
+}
+BLANKETS = {plural: kind for kind, plural in COMPONENT_KINDS.items()}
+# switches which turn on or off a group of other switches or component kinds. a group and
+# its member switches keep the order they are given in, disabling a group overrides the
+# components of the group given before it. autodetect only changes the default of the
+# libraries which are not given
+GROUP_SWITCHES = {
+  "everything": ([], list(COMPONENT_KINDS)),
+  "autodetect": ([], []),
+  "programs": (["ffmpeg", "ffprobe", "ffplay"], []),
+  "doc": (["htmlpages", "manpages", "podpages", "txtpages"], []),
+  "devices": ([], ["indev", "outdev"]),
+}
+
+# what a container, codec or protocol needs, see derive_flags
+CONTAINERS = {
+  "mp4": {"demuxer": ["mov"]},
+  "mov": {"demuxer": ["mov"]},
+  "flv": {"demuxer": ["flv", "live_flv"]},
+  "hls": {"demuxer": ["hls"]},
+  "dash": {"demuxer": ["dash"]},
+  "mpegts": {"demuxer": ["mpegts"]},
+  "mpegps": {"demuxer": ["mpegps"]},
+  "matroska": {"demuxer": ["matroska"]},
+  "webm": {"demuxer": ["matroska"]},
+  "avi": {"demuxer": ["avi"]},
+  "ogg": {"demuxer": ["ogg"]},
+  "wav": {"demuxer": ["wav"]},
+  "mp3": {"demuxer": ["mp3"]},
+  "aac": {"demuxer": ["aac"]},
+  "flac": {"demuxer": ["flac"]},
+  "h264": {"demuxer": ["h264"]},
+  "hevc": {"demuxer": ["hevc"]},
+  "concat": {"demuxer": ["concat"]},
+}
+CODECS = {
+  "h264": {"decoder": ["h264"], "parser": ["h264"]},
+  "hevc": {"decoder": ["hevc"], "parser": ["hevc"]},
+  "vp8": {"decoder": ["vp8"], "parser": ["vp8"]},
+  "vp9": {"decoder": ["vp9"], "parser": ["vp9"]},
+  "av1": {"decoder": ["av1"], "parser": ["av1"]},
+  "mpeg4": {"decoder": ["mpeg4"], "parser": ["mpeg4video"]},
+  "vp6f": {"decoder": ["vp6f"]},
+  "flv1": {"decoder": ["flv"]},
+  "png": {"decoder": ["png"], "parser": ["png"]},
+  "aac": {"decoder": ["aac", "aac_latm"], "parser": ["aac", "aac_latm"]},
+  "mp3": {"decoder": ["mp3", "mp3float"], "parser": ["mpegaudio"]},
+  "ac3": {"decoder": ["ac3", "eac3"], "parser": ["ac3"]},
+  "opus": {"decoder": ["opus"], "parser": ["opus"]},
+  "vorbis": {"decoder": ["vorbis"], "parser": ["vorbis"]},
+  "flac": {"decoder": ["flac"], "parser": ["flac"]},
+}
+PROTOCOLS = {
+  "file": {"protocol": ["file"]},
+  "http": {"protocol": ["http", "tcp"]},
+  "https": {"protocol": ["https", "http", "tls", "tcp"]},
+  "rtmp": {"protocol": ["rtmp", "rtmpt", "tcp"]},
+  "udp": {"protocol": ["udp"]},
+  "async": {"protocol": ["async"]},
+  "crypto": {"protocol": ["crypto"]},
+  "data": {"protocol": ["data"]},
+}
+
+
+@dataclass(frozen=True)
+class Flag(object):
+  # enable, disable or "" for an option with a value, e.g. --cc=clang
+  action: str
+  # the switch, component kind or option name
+  name: str
+  # the component or option value, empty for a switch
+  value: str = ""
+
+  @property
+  def is_component(self) -> bool:
+    return bool(self.action) and self.name in COMPONENT_KINDS
+
+  def __str__(self):
+    if not self.action:
+      return f"--{self.name}={self.value}"
+    return f"--{self.action}-{self.name}" + (f"={self.value}" if self.value else "")
+
+
+def parse_flag(text: str) -> list[Flag]:
+  """one flag, a component list like --enable-decoder=aac,h264 gives one Flag per name
+  """
+  text = text.strip()
+  match = re.match(r"^--(enable|disable)-([\w-]+?)(?:=(.*))?$", text)
+  if match:
+    action, name, value = match.groups()
+    if value and name in COMPONENT_KINDS:
+      return [Flag(action, name, v) for v in value.split(",") if v]
+    return [Flag(action, name, value or "")]
+  match = re.match(r"^--([\w-]+)(?:=(.*))?$", text)
+  if not match:
+    raise ConfigureError(f"Bad configure flag {text!r}")
+  return [Flag("", match.group(1), match.group(2) or "")]
+
+
+def normalize(flags: list) -> list[str]:
+  """the normalized argument vector of flags in the order they would be given to ./configure
+  """
+  switches = {}
+  options = {}
+  # kind: {value: action}, the blanket is the value "", in the order they win
+  components = {}
+  for text in flags:
+    for flag in parse_flag(text):
+      if not flag.action:
+        options[flag.name] = flag.value
+      elif flag.name in BLANKETS:
+        # everything of this kind given before is overridden
+        components[BLANKETS[flag.name]] = {"": flag.action}
+      elif flag.is_component:
+        entries = components.setdefault(flag.name, {})
+        if any(c in flag.value for c in "*?["):
+          for name in [n for n in entries if n and fnmatchcase(n, flag.value)]:
+            del entries[name]
+        entries.pop(flag.value, None)
+        entries[flag.value] = flag.action
+      else:
+        if flag.name in GROUP_SWITCHES and flag.action == "disable":
+          # the components come after the switches, the ones it overrides must go
+          for kind in GROUP_SWITCHES[flag.name][1]:
+            components.pop(kind, None)
+        # the last one wins, so it takes the place of the last one
+        switches.pop(flag.name, None)
+        switches[flag.name] = flag.action
+  ordered = set(GROUP_SWITCHES) | {n for members, _ in GROUP_SWITCHES.values() for n in members}
+  res = [str(Flag(switches[name], name)) for name in sorted(switches) if name not in ordered]
+  res.extend(str(Flag(action, name)) for name, action in switches.items() if name in ordered)
+  for kind in COMPONENT_KINDS:
+    entries = components.get(kind, {})
+    if "" in entries:
+      res.append(str(Flag(entries[""], COMPONENT_KINDS[kind])))
+    wildcards = sorted(n for n in entries if n and any(c in n for c in "*?["))
+    names = sorted(n for n in entries if n and n not in wildcards)
+    res.extend(str(Flag(entries[n], kind, n)) for n in wildcards + names)
+  res.extend(str(Flag("", name, options[name])) for name in sorted(options))
+  return res
+
+
+@dataclass
+class Profile(object):
+  name: str
+  inherits: str = ""
+  flags: list = field(default_factory=list)
+  # "<platform>" or "<platform>/<arch>": flags added there
+  conditions: dict = field(default_factory=dict)
+
+
+def load_shell_profile(path: str) -> Profile:
+  """a profile from one of configs/ffconfig/module-*.sh, the flags added to COMMON_FF_CFG_FLAGS
+  """
+  try:
+    with open(path) as f:
+      lines = f.readlines()
+  except OSError:
+    raise ConfigureError(f"{path} does not exist")
+  flags = []
+  for line in lines:
+    if line.lstrip().startswith("#") or "COMMON_FF_CFG_FLAGS" not in line:
+      continue
+    flags.extend(re.findall(r"--[a-z][^\s\"]*", line))
+  return Profile(os.path.splitext(os.path.basename(path))[0], flags=flags)
+
+
+def _chain(profiles: dict, name: str, shell_dir: str) -> list[Profile]:
+  """profile `name` and the ones it inherits from, the root first
+  """
+  chain = []
+  while name:
+    if name in [p.name for p in chain]:
+      raise ConfigureError(f"Profile {name} inherits from itself")
+    if name.startswith("shell:") and shell_dir:
+      profile = load_shell_profile(os.path.join(shell_dir, f"{name[len('shell:'):]}.sh"))
+      profile.name = name
+    elif name in profiles:
+      profile = profiles[name]
+    else:
+      raise ConfigureError(f"Unknown configure profile {name}, available: {', '.join(sorted(profiles))}")
+    chain.append(profile)
+    name = profile.inherits
+  return chain[::-1]
+
+
+def resolve(profiles: dict, name: str, platform: str = "", arch: str = "", shell_dir: str = "",
+            extra: list = None) -> list[str]:
+  """the flags of profile `name` with the ones it inherits first, then extra, then the platform and arch ones
+
+  Args:
+      shell_dir (str): where `shell:<name>` profiles are read from, configs/ffconfig
+  """
+  chain = _chain(profiles, name, shell_dir)
+  res = [f for profile in chain for f in profile.flags] + list(extra or [])
+  # like THIRD_CFG_FLAGS of the shell, the platform flags come after the profile
+  for key in [platform, f"{platform}/{arch}"]:
+    res.extend(f for profile in chain for f in profile.conditions.get(key, []))
+  return res
+
+
+def derive_flags(formats: list) -> list[str]:
+  """the minimal components for the formats, e.g. ["mp4", "hls", "h264", "aac", "https"]
+
+  a name is looked up as container, codec and protocol; `codec:aac` picks one table.
+  the kinds it names are disabled first and only the needed names are enabled.
+  """
+  tables = {"container": CONTAINERS, "codec": CODECS, "protocol": PROTOCOLS}
+  needed = {}
+  for fmt in formats:
+    kind, _, name = fmt.rpartition(":")
+    found = False
+    for table_name, table in tables.items():
+      if kind and kind != table_name:
+        continue
+      for component, names in table.get(name, {}).items():
+        needed.setdefault(component, set()).update(names)
+        found = True
+    if not found:
+      raise ConfigureError(f"Unknown format {fmt}")
+  res = []
+  for component in COMPONENT_KINDS:
+    if component in needed:
+      res.append(f"--disable-{COMPONENT_KINDS[component]}")
+      res.extend(f"--enable-{component}={n}" for n in sorted(needed[component]))
+  return res
+
+
+def compile_profile(profiles: dict, name: str, platform: str = "", arch: str = "", formats: list = None,
+                    shell_dir: str = "") -> list[str]:
+  """the normalized flags of a profile, formats replace the decoders, demuxers, parsers and
+  protocols of the profile by the ones they need, the platform ones such as mediacodec are kept
+  """
+  return normalize(resolve(profiles, name, platform, arch, shell_dir, derive_flags(formats or [])))